@@ -1,33 +1,153 @@
+import argparse
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 
-df_1 = pd.read_csv("/Users/omduggineni/Downloads/final report data/blockgroup_areas.csv", dtype={"GEOID10": str})
-df_2 = pd.read_csv("/Users/omduggineni/Downloads/final report data/blockgroup_poi-no-list.csv", dtype={"GEOID10": str})
-df_3 = pd.read_csv("/Users/omduggineni/Downloads/final report data/iso_features.csv", dtype={"GEOID10": str})
+# Merges the per-isochrone outputs (average areas, POI averages and the
+# notebook's iso_features) into one table keyed by GEOID10, profile and
+# time_limit. Every input is read with a declared schema, so a missing column
+# or a value of the wrong type fails at read time instead of in the merge.
+# Inputs and output default to the files next to this script, wherever it is
+# run from.
 
-df_1["GEOID10"] = df_1["GEOID10"].str.replace(".0", "").astype(int)
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+KEYS = ["GEOID10", "profile", "time_limit"]
 
-df_2["GEOID10"] = df_2["GEOID10"].str.replace(".0", "").astype(int)
-df_2["profile"] = df_2["profile"].astype("category")
+AREAS_SCHEMA = {
+    "GEOID10": str,
+    "profile": str,
+    "time_limit": "int64",
+    "average_area": "float64",
+}
+POI_SCHEMA = {
+    "GEOID10": str,
+    "profile": str,
+    "time_limit": "int64",
+    "average_num_poi": "float64",
+    "average_rating_poi": "float64",
+}
+ISO_FEATURES_SCHEMA = {
+    "isochrone": str,  # "<GEOID10>-<time_limit>-<profile>"
+    "center": str,  # "<latitude>,<longitude>"
+    "area_m2": "float64",
+    "avg_stars": "float64",
+    "choice": "bool",
+    "no_truck_length": "float64",
+    "distance_pool": "float64",
+    "avg_housing_price": "float64",
+    "foreclosure_count": "int64",
+    "foreclosure_over_area": "float64",
+}
 
-df_3 = df_3.rename(columns={"choice": "is_choice_neighborhood"})
-df_3["GEOID10"] = df_3["isochrone"].str.split("-").apply(lambda x: x[0]).astype(int)
-df_3["isochrone_type"] = df_3["isochrone"].str.split("-").apply(lambda x: f"{x[1]}-{x[2]}")
-df_3["profile"] = df_3["isochrone_type"].str.split("-").apply(lambda x: x[1])
-df_3["time_limit"] = df_3["isochrone_type"].str.split("-").apply(lambda x: int(x[0]))
-del df_3["isochrone_type"]
-del df_3["Unnamed: 0"]
-del df_3["isochrone"]
-df_3["center_latitude"] = df_3["center"].str.split(",").apply(lambda x: x[0]).astype(float)
-df_3["center_longitude"] = df_3["center"].str.split(",").apply(lambda x: x[0]).astype(float)
-del df_3["center"]
+ROW_GROUP_SIZE = 10000
 
-df_merged = pd.merge(df_1, df_2, on=["GEOID10", "profile", "time_limit"], how="inner")
-df_merged = pd.merge(df_merged, df_3, on=["GEOID10", "profile", "time_limit"], how="inner")
 
-assert (set(df_merged["GEOID10"]) - set(df_1["GEOID10"])) == set()
-assert (set(df_merged["GEOID10"]) - set(df_2["GEOID10"])) == set()
-assert (set(df_merged["GEOID10"]) - set(df_3["GEOID10"])) == set()
+def read_csv(path, schema):
+    columns = pd.read_csv(path, nrows=0).columns
+    missing = [column for column in schema if column not in columns]
+    if missing:
+        raise ValueError(f"{path} is missing columns {missing}")
+    return pd.read_csv(path, usecols=list(schema), dtype=schema)
 
-print(df_merged.columns)
 
-df_merged.to_parquet("blockgroup-data.parquet", compression="zstd", compression_level=122)
\ No newline at end of file
+def parse_geoid(values):
+    # GEOIDs were written from float columns ("421010260001.0"); only a zero
+    # fraction is accepted, anything else is a corrupted id
+    parts = values.str.split(".", n=1, expand=True)
+    if parts.shape[1] > 1:
+        fraction = parts[1]
+        bad = fraction.notna() & (fraction.str.strip("0") != "")
+        if bad.any():
+            raise ValueError(f"Non-integer GEOID10 values: {values[bad].head().tolist()}")
+    return parts[0].astype("int64")
+
+
+def read_areas(path):
+    df = read_csv(path, AREAS_SCHEMA)
+    df["GEOID10"] = parse_geoid(df["GEOID10"])
+    return df
+
+
+def read_poi(path):
+    df = read_csv(path, POI_SCHEMA)
+    df["GEOID10"] = parse_geoid(df["GEOID10"])
+    return df
+
+
+def read_iso_features(path):
+    df = read_csv(path, ISO_FEATURES_SCHEMA)
+    df = df.rename(columns={"choice": "is_choice_neighborhood"})
+
+    isochrone = df.pop("isochrone").str.split("-", n=2, expand=True)
+    df["GEOID10"] = isochrone[0].astype("int64")
+    df["profile"] = isochrone[2]
+    df["time_limit"] = isochrone[1].astype("int64")
+
+    center = df.pop("center").str.split(",", n=1, expand=True)
+    df["center_latitude"] = center[0].astype("float64")
+    df["center_longitude"] = center[1].astype("float64")
+    return df
+
+
+def merge_features(areas, poi, iso_features=None, verbose=False):
+    merged = pd.merge(areas, poi, on=KEYS, how="inner")
+    if iso_features is not None:
+        merged = pd.merge(merged, iso_features, on=KEYS, how="inner")
+    if verbose:
+        for name, df in (("areas", areas), ("poi", poi), ("iso_features", iso_features)):
+            if df is not None and len(df) != len(merged):
+                print(f"{len(df) - len(merged)} rows of {name} had no match in the other inputs")
+    return merged
+
+
+def write_parquet(df, path, row_group_size=ROW_GROUP_SIZE):
+    df = df.assign(profile=df["profile"].astype("category"))
+    df.to_parquet(path, compression="zstd", row_group_size=row_group_size, write_statistics=True)
+
+
+def write_partitioned(df, path, row_group_size=ROW_GROUP_SIZE):
+    # One directory per profile/time_limit (hive style), rows sorted by
+    # GEOID10 so row-group statistics can prune GEOID filters as well
+    table = pa.Table.from_pandas(df.sort_values(KEYS, kind="stable"), preserve_index=False)
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        table,
+        path,
+        format=file_format,
+        partitioning=ds.partitioning(pa.schema([table.schema.field("profile"), table.schema.field("time_limit")]), flavor="hive"),
+        existing_data_behavior="delete_matching",
+        max_rows_per_group=row_group_size,
+        file_options=file_format.make_write_options(compression="zstd", write_statistics=True),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge block group areas, POI averages and isochrone features into Parquet")
+    parser.add_argument("--areas", default=os.path.join(ANALYSIS_DIR, "blockgroup_areas.csv"), help="Output of geojson2areas.py (default: blockgroup_areas.csv next to this script)")
+    parser.add_argument("--poi", default=os.path.join(ANALYSIS_DIR, "blockgroup_poi-no-list.csv"), help="Output of geojson2poi.py without POI lists (default: blockgroup_poi-no-list.csv next to this script)")
+    parser.add_argument("--iso-features", default=os.path.join(ANALYSIS_DIR, "iso_features.csv"), help="Isochrone features from the notebook (default: iso_features.csv next to this script)")
+    parser.add_argument("--no-iso-features", action="store_true", help="Merge only areas and POI averages")
+    parser.add_argument("-o", "--output", default=os.path.join(ANALYSIS_DIR, "blockgroup-data.parquet"), help="Merged Parquet file (default: blockgroup-data.parquet next to this script)")
+    parser.add_argument("--partitioned", default=None, help="Also write a dataset partitioned by profile/time_limit to this directory")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help=f"Rows per Parquet row group (default: {ROW_GROUP_SIZE})")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    args = parser.parse_args()
+
+    areas = read_areas(args.areas)
+    poi = read_poi(args.poi)
+    iso_features = None if args.no_iso_features else read_iso_features(args.iso_features)
+    merged = merge_features(areas, poi, iso_features, args.verbose)
+    if args.verbose:
+        print(f"Merged columns: {list(merged.columns)}")
+
+    write_parquet(merged, args.output, args.row_group_size)
+    if args.verbose:
+        print(f"Saved {len(merged)} rows to {args.output}")
+    if args.partitioned:
+        write_partitioned(merged, args.partitioned, args.row_group_size)
+        if args.verbose:
+            print(f"Saved partitioned dataset to {args.partitioned}")
+
+if __name__ == "__main__":
+    main()
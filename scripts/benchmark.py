@@ -0,0 +1,281 @@
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import mock_graphhopper
+
+# End-to-end benchmark of the block group pipeline on synthetic inputs.
+# Fixtures are built from the Philadelphia block groups (tiled eastwards
+# when more are asked for than the city has, so one run can go from a city
+# to a metro area), isochrones come from the mock GraphHopper, and every
+# stage runs as its own process so wall time, CPU time and peak RSS are
+# measured per stage. Results go to a JSON file that --compare can diff
+# against a run from another commit.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(SCRIPTS_DIR)
+CENSUS_FILE = os.path.join(ROOT_DIR, "data", "Census_Block_Groups_2010.geojson")
+CATEGORIES_FILE = os.path.join(ROOT_DIR, "data", "categories")
+MERGE_SCRIPT = os.path.join(ROOT_DIR, "analysis", "merge_into_parquet.py")
+WORK_DIR = "benchmark_work"
+OUTPUT_FILE = "benchmark.json"
+PROFILES = ["foot", "car", "pt"]
+TIME_LIMITS = [600, 1200, 1800]
+SEED = 403
+
+
+# ---- FIXTURES ----
+def make_block_groups(census_path, n, path):
+    gdf = gpd.read_file(census_path)[["GEOID10", "geometry"]]
+    width = gdf.total_bounds[2] - gdf.total_bounds[0]
+    copies = []
+    for k in range(math.ceil(n / len(gdf))):
+        # Copy k sits k city-widths east, with GEOIDs offset past the real ones
+        copy = gdf.copy()
+        copy["geometry"] = copy.geometry.translate(xoff=k * width)
+        copy["GEOID10"] = (copy["GEOID10"].astype("int64") + k * 10 ** 12).astype(str)
+        copies.append(copy)
+    block_groups = gpd.GeoDataFrame(pd.concat(copies, ignore_index=True).iloc[:n], crs=gdf.crs)
+    if os.path.exists(path):
+        os.remove(path)
+    block_groups.to_file(path, driver="GeoJSON")
+    return block_groups
+
+
+def load_categories(path):
+    categories = []
+    with open(path) as f:
+        for line in f:
+            name = line.rsplit(":", 1)[0].strip()
+            if name:
+                categories.append(name)
+    return categories
+
+
+def make_businesses(bounds, k, categories, rng, path):
+    min_lon, min_lat, max_lon, max_lat = bounds
+    picks = rng.integers(0, len(categories), size=(k, 3))
+    df = pd.DataFrame({
+        "business_id": [f"b{i:08d}" for i in range(k)],
+        "name": "Synthetic",
+        "city": "Philadelphia",
+        "latitude": rng.uniform(min_lat, max_lat, k),
+        "longitude": rng.uniform(min_lon, max_lon, k),
+        "stars": rng.integers(2, 11, k) / 2,
+        "review_count": rng.integers(1, 500, k),
+        "categories": [", ".join(categories[j] for j in row) for row in picks],
+    })
+    df.to_json(path, orient="records", lines=True)
+
+
+def make_transfers(bounds, k, rng, path):
+    min_lon, min_lat, max_lon, max_lat = bounds
+    document_types = np.array(["DEED", "SHERIFF'S DEED", "DEED SHERIFF", "MORTGAGE", "SATISFACTION"])
+    dates = pd.Timestamp("2005-01-01") + pd.to_timedelta(rng.integers(0, 7000, k), unit="D")
+    df = pd.DataFrame({
+        "objectid": np.arange(k),
+        "document_type": document_types[rng.integers(0, len(document_types), k)],
+        "display_date": dates.strftime("%Y-%m-%d %H:%M:%S"),
+        "assessed_value": np.where(rng.random(k) < 0.2, np.nan, rng.integers(10000, 1000000, k)),
+        "lat": rng.uniform(min_lat, max_lat, k),
+        "lng": rng.uniform(min_lon, max_lon, k),
+    })
+    df.to_csv(path, index=False)
+
+
+def make_iso_features(block_groups, profiles, time_limits, rng, path):
+    # Stand-in for the notebook's iso_features.csv, one row per center isochrone
+    centers = block_groups.geometry.representative_point()
+    rows = [
+        (f"{geoid}-{time_limit}-{profile}", f"{point.y},{point.x}")
+        for geoid, point in zip(block_groups["GEOID10"], centers)
+        for profile in profiles
+        for time_limit in time_limits
+    ]
+    n = len(rows)
+    df = pd.DataFrame(rows, columns=["isochrone", "center"])
+    df["area_m2"] = rng.uniform(1e5, 1e9, n)
+    df["avg_stars"] = rng.uniform(1, 5, n)
+    df["choice"] = rng.random(n) < 0.1
+    df["no_truck_length"] = rng.uniform(0, 1e6, n)
+    df["distance_pool"] = rng.uniform(0, 5000, n)
+    df["avg_housing_price"] = rng.uniform(1e4, 1e6, n)
+    df["foreclosure_count"] = rng.integers(0, 3000, n)
+    df["foreclosure_over_area"] = df["foreclosure_count"] / df["area_m2"]
+    df.to_csv(path)
+
+
+# ---- STAGES ----
+# Linux carries the RSS high-water mark of the forking process across exec,
+# so stages launched straight from this (geopandas-sized) process would all
+# report its peak. A bare interpreter spawns each stage instead and reports
+# the stage's own wall time and rusage.
+LAUNCHER = """
+import json, os, sys, time
+start = time.perf_counter()
+pid = os.posix_spawn(sys.argv[2], sys.argv[2:], os.environ)
+_, status, usage = os.wait4(pid, 0)
+with open(sys.argv[1], "w") as f:
+    json.dump([time.perf_counter() - start, os.waitstatus_to_exitcode(status), usage.ru_utime, usage.ru_stime, usage.ru_maxrss], f)
+"""
+
+
+def run_stage(name, command, cwd, verbose=False):
+    log_path = os.path.join(cwd, f"{name}.log")
+    usage_path = os.path.join(cwd, f"{name}.rusage.json")
+    with open(log_path, "w") as log:
+        subprocess.run([sys.executable, "-c", LAUNCHER, os.path.abspath(usage_path)] + command,
+                       cwd=cwd, stdout=log, stderr=subprocess.STDOUT, check=True)
+    with open(usage_path) as f:
+        seconds, exit_code, user_seconds, system_seconds, max_rss = json.load(f)
+
+    result = {
+        "stage": name,
+        "seconds": seconds,
+        "user_seconds": user_seconds,
+        "system_seconds": system_seconds,
+        "peak_rss_mb": max_rss / 1024,  # ru_maxrss is in KiB on Linux
+        "exit_code": exit_code,
+    }
+    if verbose:
+        print(f"{name}: {seconds:.2f}s, {result['peak_rss_mb']:.0f} MB peak RSS, exit {exit_code}")
+    if exit_code != 0:
+        with open(log_path) as log:
+            tail = log.read()[-2000:]
+        raise RuntimeError(f"Stage {name} failed with exit code {exit_code}:\n{tail}")
+    return result
+
+
+def stage_commands(args, url):
+    script = lambda name: [sys.executable, os.path.join(SCRIPTS_DIR, name)]
+    workers = ["-w", str(args.workers)]
+    isochrones = {"parquet": "isochrones.parquet", "ragged": "isochrones.ragged"}.get(args.isochrone_format, "isochrones.geojson")
+    return [
+        ("shape2points", script("shape2points.py") + ["block_groups.geojson"] + (["--fast"] if args.fast_points else workers)),
+        ("isochrone", script("isochrone.py") + [
+            "--csv", "blockgroup_centers.csv", "--output", isochrones, "--url", url,
+            "--profiles", *args.profiles, "--time-limits", *map(str, args.time_limits),
+            "--max-in-flight", str(args.max_in_flight), "--fresh", "--no-cache",
+        ] + (["--batch-buckets"] if args.batch_buckets else [])),
+        ("geojson2areas", script("geojson2areas.py") + [isochrones, "-o", "blockgroup_areas.csv"] + workers),
+        ("geojson2poi", script("geojson2poi.py") + [isochrones, "yelp.json", "-o", "blockgroup_poi.csv"] + workers),
+        ("rtt_ingest", script("rtt_ingest.py") + ["rtt_data.csv", "-o", "rtt_deeds"]),
+        ("merge_into_parquet", [sys.executable, MERGE_SCRIPT, "--areas", "blockgroup_areas.csv",
+                                "--poi", "blockgroup_poi.csv", "--iso-features", "iso_features.csv",
+                                "-o", "blockgroup-data.parquet", "--partitioned", "blockgroup-data"]),
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    print(f"{'stage':<20}{'seconds':>10}{'baseline':>10}{'ratio':>8}{'peak MB':>10}{'baseline':>10}")
+    for stage in results["stages"]:
+        old = baseline.get(stage["stage"])
+        if old is None:
+            print(f"{stage['stage']:<20}{stage['seconds']:>10.2f}{'-':>10}{'-':>8}{stage['peak_rss_mb']:>10.0f}{'-':>10}")
+            continue
+        ratio = stage["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+        print(f"{stage['stage']:<20}{stage['seconds']:>10.2f}{old['seconds']:>10.2f}{ratio:>8.2f}"
+              f"{stage['peak_rss_mb']:>10.0f}{old['peak_rss_mb']:>10.0f}")
+
+
+# ---- MAIN ----
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic fixtures and a mock GraphHopper")
+    parser.add_argument("--block-groups", type=int, default=100, help="Block groups to generate; past 1336 the city is tiled (default: 100)")
+    parser.add_argument("--pois", type=int, default=20000, help="Synthetic Yelp businesses (default: 20000)")
+    parser.add_argument("--deeds", type=int, default=50000, help="Synthetic RTT rows (default: 50000)")
+    parser.add_argument("--profiles", nargs="+", default=PROFILES, help="Routing profiles; isochrones = block groups x 5 points x profiles x time limits")
+    parser.add_argument("--time-limits", type=int, nargs="+", default=TIME_LIMITS, help="Isochrone time limits in seconds")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock GraphHopper response time in seconds (default: 0)")
+    parser.add_argument("--max-in-flight", type=int, default=16, help="Concurrent isochrone requests (default: 16)")
+    parser.add_argument("--batch-buckets", action="store_true", help="Fetch isochrones with bucketed requests")
+    parser.add_argument("--isochrone-format", choices=["geojson", "parquet", "ragged"], default="geojson", help="Isochrone output format (default: geojson)")
+    parser.add_argument("--fast-points", action="store_true", help="Run shape2points with --fast")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes for the stages that support them (default: 1)")
+    parser.add_argument("--stages", nargs="+", default=None, help="Only time these stages (earlier outputs must exist in the work dir)")
+    parser.add_argument("--census", default=CENSUS_FILE, help="Block group GeoJSON the fixtures are built from")
+    parser.add_argument("--work-dir", default=WORK_DIR, help=f"Directory for fixtures and stage outputs (default: {WORK_DIR})")
+    parser.add_argument("--seed", type=int, default=SEED, help=f"Random seed for the fixtures (default: {SEED})")
+    parser.add_argument("-o", "--output", default=OUTPUT_FILE, help=f"Results JSON (default: {OUTPUT_FILE})")
+    parser.add_argument("--compare", default=None, help="Print timings next to an earlier results JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+
+    start = time.perf_counter()
+    block_groups = make_block_groups(args.census, args.block_groups, os.path.join(args.work_dir, "block_groups.geojson"))
+    bounds = block_groups.total_bounds
+    make_businesses(bounds, args.pois, load_categories(CATEGORIES_FILE), rng, os.path.join(args.work_dir, "yelp.json"))
+    make_transfers(bounds, args.deeds, rng, os.path.join(args.work_dir, "rtt_data.csv"))
+    make_iso_features(block_groups, args.profiles, args.time_limits, rng, os.path.join(args.work_dir, "iso_features.csv"))
+    fixture_seconds = time.perf_counter() - start
+    if args.verbose:
+        print(f"Built fixtures for {len(block_groups)} block groups in {fixture_seconds:.2f}s")
+
+    server, url = mock_graphhopper.start_in_thread(latency=args.latency, capacity=args.max_in_flight)
+    stages = []
+    try:
+        for name, command in stage_commands(args, url):
+            if args.stages is not None and name not in args.stages:
+                continue
+            requests_before = server.request_count
+            stage = run_stage(name, command, args.work_dir, args.verbose)
+            if name == "isochrone":
+                stage["requests"] = server.request_count - requests_before
+            stages.append(stage)
+    finally:
+        server.shutdown()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "block_groups": len(block_groups),
+            "isochrones": len(block_groups) * 5 * len(args.profiles) * len(args.time_limits),
+            "pois": args.pois,
+            "deeds": args.deeds,
+            "profiles": args.profiles,
+            "time_limits": args.time_limits,
+            "latency": args.latency,
+            "max_in_flight": args.max_in_flight,
+            "batch_buckets": args.batch_buckets,
+            "isochrone_format": args.isochrone_format,
+            "fast_points": args.fast_points,
+            "workers": args.workers,
+            "seed": args.seed,
+        },
+        "fixture_seconds": fixture_seconds,
+        "stages": stages,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.verbose:
+        print(f"Results saved to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+import argparse
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import shapely
+from shapely.geometry import shape
+
+import isochrone
+import metrics
+from spatial_features import NOTEBOOK_FEATURES, FeatureIndex
+
+# Isochrone features for ad-hoc points, for a long-lived process (library or
+# local HTTP endpoint) instead of the block-group batch pipeline.
+#
+# A query is (lat, lon, profile, time_limit). If a point within reuse_meters
+# was already routed with the same profile and time limit, its isochrone is
+# reused; otherwise GraphHopper is asked through isochrone.fetch_isochrone
+# (with its retries and, if init_cache was called, its on-disk response
+# cache). Features come from a FeatureIndex whose layer trees are built once
+# at startup. Isochrones and feature vectors sit in two bounded LRUs keyed by
+# the routed point, so the geometry can be dropped long before the (much
+# smaller) features are.
+
+REUSE_METERS = 50.0
+ISOCHRONE_CACHE_SIZE = 2000
+FEATURE_CACHE_SIZE = 100000
+FETCH_WORKERS = 8
+HOST = "127.0.0.1"
+PORT = 8990
+METRES_PER_DEGREE = 111320.0
+MAX_BODY_BYTES = 10 * 1024 ** 2
+
+
+class LRUCache:
+    """Bounded mapping that drops the least recently used entry when full."""
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            evicted, _ = self.entries.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+
+class NearbyPoints:
+    """Routed points per profile and time limit, bucketed into cells of radius metres."""
+
+    def __init__(self, radius=REUSE_METERS):
+        self.radius = radius
+        self.cell_size = max(radius, 1.0) / METRES_PER_DEGREE  # degrees of latitude
+        self.cells = {}
+
+    def _cell(self, lat, lon):
+        # Longitude scaled to metres at the point's latitude so cells are roughly square
+        return (math.floor(lat / self.cell_size), math.floor(lon * math.cos(math.radians(lat)) / self.cell_size))
+
+    def add(self, key):
+        profile, time_limit, lat, lon = key
+        self.cells.setdefault((profile, time_limit, self._cell(lat, lon)), set()).add(key)
+
+    def remove(self, key):
+        profile, time_limit, lat, lon = key
+        cell = (profile, time_limit, self._cell(lat, lon))
+        keys = self.cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+
+    def find(self, profile, time_limit, lat, lon):
+        # Closest routed point within radius, or None
+        row, col = self._cell(lat, lon)
+        best, best_distance = None, self.radius
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                for key in self.cells.get((profile, time_limit, (row + d_row, col + d_col)), ()):
+                    distance = distance_meters(lat, lon, key[2], key[3])
+                    if distance <= best_distance:
+                        best, best_distance = key, distance
+        return best
+
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation, plenty for the few metres reuse is about
+    x = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(x, lat2 - lat1) * METRES_PER_DEGREE
+
+
+def isochrone_geometry(response):
+    # One polygon per requested time limit; union in case GraphHopper splits it
+    polygons = [shape(poly["geometry"]) for poly in response.get("polygons", [])]
+    if not polygons:
+        return shapely.Polygon()
+    return polygons[0] if len(polygons) == 1 else shapely.union_all(polygons)
+
+
+def parse_query(query):
+    # (lat, lon, profile, time_limit) from a dict of strings or numbers
+    try:
+        lat, lon = float(query["lat"]), float(query["lon"])
+        profile = str(query["profile"])
+        time_limit = int(float(query["time_limit"]))
+    except KeyError as e:
+        raise ValueError(f"Missing {e.args[0]!r}")
+    except (TypeError, ValueError):
+        raise ValueError(f"Bad query {query!r}")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Coordinates out of range: {lat},{lon}")
+    if time_limit <= 0:
+        raise ValueError(f"time_limit must be positive, got {time_limit}")
+    return lat, lon, profile, time_limit
+
+
+class FeatureService:
+    def __init__(self, layers, spec=NOTEBOOK_FEATURES, reuse_meters=REUSE_METERS,
+                 isochrone_cache_size=ISOCHRONE_CACHE_SIZE, feature_cache_size=FEATURE_CACHE_SIZE,
+                 workers=FETCH_WORKERS, fetch=None):
+        # fetch(lat, lon, profile, time_limit) returns a GraphHopper response or None;
+        # the default goes through isochrone.fetch_isochrone
+        self.index = FeatureIndex(layers, spec, crs="EPSG:4326")
+        self.spec = spec
+        self.workers = workers
+        self.fetch = fetch or fetch_graphhopper
+        if self.fetch is fetch_graphhopper:
+            # Set up the shared session before _fetch_all's threads need it
+            isochrone.ensure_fetcher(max(workers, 1))
+        self.lock = threading.Lock()
+        self.nearby = NearbyPoints(reuse_meters)
+        self.isochrones = LRUCache(isochrone_cache_size, on_evict=self._forget)
+        self.features = LRUCache(feature_cache_size, on_evict=self._forget)
+        self.counts = {"queries": 0, "feature_hits": 0, "isochrone_hits": 0, "reused": 0, "fetched": 0, "errors": 0}
+
+    def _forget(self, key):
+        # A routed point stays findable while either cache still holds it
+        if key not in self.isochrones and key not in self.features:
+            self.nearby.remove(key)
+
+    def _count(self, name, n=1):
+        self.counts[name] += n
+        metrics.count(f"feature_service_{name}", n)
+
+    def query(self, lat, lon, profile, time_limit):
+        return self.batch([{"lat": lat, "lon": lon, "profile": profile, "time_limit": time_limit}])[0]
+
+    def batch(self, queries):
+        # One result dict per query, in order. Misses are fetched concurrently,
+        # nearby misses within the batch share one fetch, and every new
+        # isochrone goes through the layer trees in a single bulk query.
+        start = time.monotonic()
+        results = [None] * len(queries)
+        keys = [None] * len(queries)
+        to_fetch = set()
+        pending = NearbyPoints(self.nearby.radius)
+
+        with self.lock:
+            self._count("queries", len(queries))
+            for i, query in enumerate(queries):
+                try:
+                    lat, lon, profile, time_limit = parse_query(query)
+                except ValueError as e:
+                    results[i] = {"error": str(e)}
+                    self._count("errors")
+                    continue
+                key = self.nearby.find(profile, time_limit, lat, lon)
+                if key is None:
+                    key = pending.find(profile, time_limit, lat, lon)
+                    if key is None:
+                        key = (profile, time_limit, lat, lon)
+                        pending.add(key)
+                        to_fetch.add(key)
+                keys[i] = key
+                results[i] = {"lat": lat, "lon": lon, "profile": profile, "time_limit": time_limit}
+
+            cached_features = {}
+            to_compute = {}
+            for key in set(keys) - set(to_fetch) - {None}:
+                features = self.features.get(key)
+                if features is not None:
+                    cached_features[key] = features
+                    continue
+                geometry = self.isochrones.get(key)
+                if geometry is not None:
+                    to_compute[key] = geometry
+                else:
+                    # Dropped from both caches by another thread since the lookup
+                    to_fetch.add(key)
+
+        fetched = self._fetch_all(list(to_fetch))
+        failed = {key for key, geometry in fetched.items() if geometry is None}
+        to_compute.update((key, geometry) for key, geometry in fetched.items() if geometry is not None)
+
+        computed = {}
+        if to_compute:
+            frame = self.index.compute(list(to_compute.values()))
+            computed = dict(zip(to_compute, json_records(frame)))
+
+        with self.lock:
+            self._count("fetched", len(fetched) - len(failed))
+            for key, geometry in to_compute.items():
+                self.isochrones.put(key, geometry)
+                self.features.put(key, computed[key])
+                self.nearby.add(key)
+            for i, key in enumerate(keys):
+                if key is None:
+                    continue
+                result = results[i]
+                if key in failed:
+                    result["error"] = "GraphHopper request failed"
+                    self._count("errors")
+                    continue
+                result["center"] = f"{key[2]},{key[3]}"
+                result["reused"] = (key[2], key[3]) != (result["lat"], result["lon"])
+                result["cached"] = key not in to_fetch
+                result["features"] = cached_features.get(key) or computed[key]
+                if result["reused"]:
+                    self._count("reused")
+                if key in cached_features:
+                    self._count("feature_hits")
+                elif key in to_compute and key not in fetched:
+                    self._count("isochrone_hits")
+
+        metrics.observe("feature_service_batch_seconds", time.monotonic() - start)
+        return results
+
+    def _fetch_all(self, keys):
+        # key -> isochrone geometry, None where GraphHopper failed
+        if not keys:
+            return {}
+        def fetch(key):
+            profile, time_limit, lat, lon = key
+            return self.fetch(lat, lon, profile, time_limit)
+
+        if len(keys) == 1 or self.workers <= 1:
+            responses = [fetch(key) for key in keys]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(keys))) as executor:
+                responses = list(executor.map(fetch, keys))
+        return {key: None if response is None else isochrone_geometry(response) for key, response in zip(keys, responses)}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, isochrones_cached=len(self.isochrones), features_cached=len(self.features))
+
+
+def fetch_graphhopper(lat, lon, profile, time_limit):
+    result = isochrone.fetch_isochrone({
+        "geoid": None,
+        "point_label": "query",
+        "profile": profile,
+        "time_limit": time_limit,
+        "coordinates": f"{lat},{lon}",
+    })
+    return None if result is None else result["isochrone"]
+
+
+def json_records(frame):
+    # Feature rows as plain Python values, NaN as None
+    return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+
+def load_layers(yelp=None, rtt=None, choice=None, no_trucks=None, pools=None, city=None, verbose=False):
+    # The notebook's layers from whichever sources are given, keyed like NOTEBOOK_FEATURES
+    import geopandas as gpd
+    from rtt_ingest import load_transfers
+    from yelp_loader import load_businesses
+
+    layers = {}
+    if yelp is not None:
+        df = load_businesses(yelp, columns=["latitude", "longitude", "stars"], city=city,
+                             required=["latitude", "longitude", "stars"], verbose=verbose)
+        layers["yelp"] = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["longitude"], df["latitude"]), crs="EPSG:4326")
+    if rtt is not None:
+        layers["deeds"] = load_transfers(rtt, "deed", columns=["assessed_value"])
+        layers["foreclosures"] = load_transfers(rtt, "foreclosure", columns=["assessed_value"])
+    for name, path in (("choice", choice), ("no_trucks", no_trucks), ("pools", pools)):
+        if path is not None:
+            layers[name] = gpd.read_file(path)
+    if verbose:
+        for name, layer in layers.items():
+            print(f"Loaded {len(layer)} {name} geometries")
+    return layers
+
+
+class FeatureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == "/stats":
+            self.send_json(200, service.stats())
+        elif url.path == "/features":
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            result = service.batch([query])[0]
+            self.send_json(status_for(result), result)
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        # Body: a JSON list of queries, or {"queries": [...]}
+        url = urlparse(self.path)
+        if url.path != "/batch":
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_BODY_BYTES:
+            self.send_json(413, {"error": f"Body over {MAX_BODY_BYTES} bytes"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"null")
+            queries = body["queries"] if isinstance(body, dict) else body
+            if not isinstance(queries, list) or not all(isinstance(q, dict) for q in queries):
+                raise ValueError
+        except (ValueError, KeyError):
+            self.send_json(400, {"error": "Expected a JSON list of {lat, lon, profile, time_limit} objects"})
+            return
+        self.send_json(200, {"results": self.server.service.batch(queries)})
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def status_for(result):
+    if "error" not in result:
+        return 200
+    return 502 if "center" not in result and "lat" in result else 400
+
+
+def make_server(service, host=HOST, port=PORT, verbose=False):
+    server = ThreadingHTTPServer((host, port), FeatureHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def start_in_thread(service, **kwargs):
+    # Returns (server, url) with the server running in a daemon thread
+    server = make_server(service, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve isochrone features for arbitrary points over local HTTP")
+    parser.add_argument("--yelp", default=None, help="Yelp business JSON lines file (avg_stars)")
+    parser.add_argument("--city", default=None, help="Only keep Yelp businesses in this city (e.g. Philadelphia)")
+    parser.add_argument("--rtt", default=None, help="rtt_ingest.py output dataset (avg_housing_price, foreclosure_count)")
+    parser.add_argument("--choice", default=None, help="Choice Neighborhoods GeoJSON (choice)")
+    parser.add_argument("--no-trucks", default=None, help="No thru trucks GeoJSON (no_truck_length)")
+    parser.add_argument("--pools", default=None, help="Swimming pools GeoJSON (distance_pool)")
+    parser.add_argument("--url", default=isochrone.GRAPH_HOPPER_URL, help=f"GraphHopper isochrone endpoint (default: {isochrone.GRAPH_HOPPER_URL})")
+    parser.add_argument("--host", default=HOST, help=f"Interface to bind (default: {HOST})")
+    parser.add_argument("--port", type=int, default=PORT, help=f"Port to listen on (default: {PORT})")
+    parser.add_argument("--reuse-meters", type=float, default=REUSE_METERS, help=f"Reuse the isochrone of a routed point this close (default: {REUSE_METERS:g}; 0 for exact matches only)")
+    parser.add_argument("--isochrone-cache-size", type=int, default=ISOCHRONE_CACHE_SIZE, help=f"Isochrones kept in memory (default: {ISOCHRONE_CACHE_SIZE})")
+    parser.add_argument("--feature-cache-size", type=int, default=FEATURE_CACHE_SIZE, help=f"Feature vectors kept in memory (default: {FEATURE_CACHE_SIZE})")
+    parser.add_argument("--workers", type=int, default=FETCH_WORKERS, help=f"Concurrent GraphHopper requests per batch (default: {FETCH_WORKERS})")
+    parser.add_argument("--cache", default=None, help="Also keep GraphHopper responses in this response cache database")
+    parser.add_argument("--cache-max-mb", type=float, default=isochrone.CACHE_MAX_MB, help=f"Response cache size limit (default: {isochrone.CACHE_MAX_MB})")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.enable_from_args(args)
+    layers = load_layers(args.yelp, args.rtt, args.choice, args.no_trucks, args.pools, args.city, args.verbose)
+    spec = [entry for entry in NOTEBOOK_FEATURES if entry["layer"] in layers]
+    if not spec:
+        parser.error("No layers given; pass at least one of --yelp, --rtt, --choice, --no-trucks, --pools")
+
+    isochrone.GRAPH_HOPPER_URL = args.url
+    isochrone.init_fetcher(max(args.workers, 1))
+    if args.cache:
+        isochrone.init_cache(args.cache, args.cache_max_mb)
+
+    service = FeatureService(layers, spec, args.reuse_meters, args.isochrone_cache_size,
+                             args.feature_cache_size, args.workers)
+    server = make_server(service, args.host, args.port, args.verbose)
+    print(f"Serving {', '.join(entry['name'] for entry in spec)} on http://{args.host}:{args.port}/features")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Answered {service.stats()}")
+
+
+if __name__ == "__main__":
+    main()
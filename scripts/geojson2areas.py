@@ -1,99 +1,98 @@
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import argparse
+import time
+import metrics
+from isochrone_store import geoid_int64, partition_frame, partition_state, partition_task, read_isochrones
+from parallel import WorkerPool
 
-def main():
-    parser = argparse.ArgumentParser(description="Calculate area and output csv for census block groups from isochrone geojson")
-    parser.add_argument("geojson", help="Input GeoJSON file (e.g. isochrones.geojson)")
-    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
-    args = parser.parse_args()
-
-    if args.verbose:
-            print("Loading geojson.")
+# Web Mercator matches the original output; it inflates areas by roughly
+# 1/cos(latitude)^2 (~1.7x at Philadelphia), so use equal-area for true m^2
+PROJECTIONS = {
+    "web-mercator": "EPSG:3857",
+    "equal-area": "EPSG:5070",
+}
 
-    gdf = gpd.read_file(args.geojson)
+GROUP_COLUMNS = ["geoid", "profile", "time_limit"]
 
+def area_sums(gdf, crs):
     if gdf.crs != "EPSG:4326":
         gdf = gdf.to_crs("EPSG:4326")
-        if args.verbose:
-            print("Reprojected to EPSG:4326")
-
-    gdf = gdf.to_crs(epsg=3857) # de facto standard used in GPS and on web
-
-    if args.verbose:
-            print("Done loading geojson.")
-
-    # Unique sets of geoids, point labels, profiles, and time limits
-    geoids = set()
-    point_labels = set()
-    profiles = set()
-    time_limits = set()
-
-    # Calculate all geoid, point_label, profile, and time_limit types.
-    if args.verbose:
-            print("Finding all geoid, point_label, profile, and time_limit types.")
-    for index, row in gdf.iterrows():
-        geoids.add(row["geoid"])
-        point_labels.add(row["point_label"])
-        profiles.add(row["profile"])
-        time_limits.add(row["time_limit"])
-
-    if args.verbose:
-        print(f'Geoids: {geoids}, point labels: {point_labels}, profiles: {profiles}, time limits: {time_limits}')
+    # GeoJSON geoids are floats; group on the int64 ids the stores use so
+    # GEOID10 is written the same whatever the input format
+    gdf = gdf.assign(geoid=geoid_int64(gdf["geoid"]).to_numpy())
+
+    with metrics.timer("area_projection_seconds"):
+        areas = gdf.geometry.to_crs(crs).area.to_numpy()
+    metrics.count("area_features", len(gdf))
+
+    # bincount adds in row order like the original per-group sum(); pandas'
+    # groupby sum is compensated and can differ from it in the last bit
+    codes, groups = pd.MultiIndex.from_frame(gdf[GROUP_COLUMNS]).factorize()
+    return pd.DataFrame({
+        "sum": np.bincount(codes, weights=areas, minlength=len(groups)),
+        "count": np.bincount(codes, minlength=len(groups)),
+    }, index=groups.set_names(GROUP_COLUMNS))
+
+def area_sums_partition(state, rows):
+    return area_sums(partition_frame(state, rows), state["crs"])
+
+def average_areas(chunks, crs, verbose=False, workers=1):
+    # Sum and count per group for each chunk, combined at the end, so only one
+    # chunk of geometries is in memory at a time
+    totals = None
+    with WorkerPool(workers) as pool:
+        for gdf in chunks:
+            start = time.perf_counter()
+            if workers > 1:
+                # Each geoid lands in one partition, so its sum is unchanged
+                state = partition_state(gdf, crs=crs)
+                parts = pool.map_by_key(area_sums_partition, gdf["geoid"], lambda rows: partition_task(state, rows))
+                sums = pd.concat(parts)
+            else:
+                sums = area_sums(gdf, crs)
+            totals = sums if totals is None else totals.add(sums, fill_value=0)
+            metrics.observe("area_chunk_seconds", time.perf_counter() - start)
+            if verbose:
+                print(f"Processed chunk of {len(gdf)} geometries.")
+
+    if totals is None:
+        return pd.DataFrame(columns=["GEOID10", "profile", "time_limit", "average_area"])
+
+    totals = totals[totals["sum"] != 0].sort_index()
+    df = (totals["sum"] / totals["count"]).rename("average_area").reset_index()
+    df["time_limit"] = df["time_limit"].astype(int)
+    return df.rename(columns={"geoid": "GEOID10"})
 
-    if args.verbose:
-        print("Calcuating area of geometries, sorting by geoid")
-
-    # Sort the gdf rows into appropriate geoid lists, calculate area
-    shapes_by_geoid = {}
-    for geoid in geoids:
-        shapes_by_geoid[geoid] = []
-
-    for index, row in gdf.iterrows():
-        shape_dict = {
-          "profile": row["profile"],
-          "time_limit": row["time_limit"],
-          "point_label": row["point_label"],
-          "area": row["geometry"].area
-        }
-        shapes_by_geoid[row["geoid"]].append(shape_dict)
-
-    if args.verbose:
-        print("Done calcuating area of geometries.")
+def main():
+    parser = argparse.ArgumentParser(description="Calculate area and output csv for census block groups from isochrone geojson")
+    parser.add_argument("geojson", help="Input GeoJSON file, isochrone parquet store or ragged store (e.g. isochrones.geojson)")
+    parser.add_argument("-p", "--projection", choices=sorted(PROJECTIONS), default="web-mercator", help="Projection areas are measured in (default: web-mercator)")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Read GeoJSON this many features at a time (parquet is read per row group)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes, partitioned by geoid (default: 1)")
+    parser.add_argument("-o", "--output", default="blockgroup_areas.csv",
+                        help="Output CSV, one row per GEOID10, profile and time_limit in that sort order, GEOID10 written as an integer "
+                             "(421010260001, not the original script's 421010260001.0) (default: blockgroup_areas.csv)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
 
-    if args.verbose:
-        print("Calculating average areas of isochrone types by geoid")
-
-    # Calculate average area by geoid, profile, time_limit; add to rows
-    rows = []
-    for geoid in geoids:
-        for profile in profiles:
-            for time_limit in time_limits:
-                areas = []
-                for shape in shapes_by_geoid[geoid]:
-                    if (shape["profile"] == profile and shape["time_limit"] == time_limit):
-                        areas.append(shape["area"])
-                sum_area = sum(areas)
-                if (sum_area != 0):
-                    average_area = sum_area / len(areas)
-                    rows.append([geoid, profile, time_limit, average_area])
+    metrics.enable_from_args(args)
 
     if args.verbose:
-        print("Done calculating average areas and sorting geometries. Writing to disk.")
+        print(f"Calculating average areas by geoid, profile, time limit in {PROJECTIONS[args.projection]}")
 
-    columns = [
-        "GEOID10",
-        "profile",
-        "time_limit",
-        "average_area",
-    ]
+    # With workers, a ragged store's geometries are built in the workers
+    chunks = read_isochrones(args.geojson, args.chunk_size, columns=GROUP_COLUMNS, geometry=args.workers <= 1)
+    df = average_areas(chunks, PROJECTIONS[args.projection], args.verbose, args.workers)
 
-    # Save dataframe
-    df = pd.DataFrame(rows, columns=columns)
-    df.to_csv("blockgroup_areas.csv", index=False)
+    # Save dataframe. Unlike the original script's float GEOID10 in set
+    # iteration order, rows are sorted and GEOID10 is an integer;
+    # merge_into_parquet reads either form
+    df.to_csv(args.output, index=False)
 
     if args.verbose:
-        print("Output saved to blockgroup_areas.csv")
+        print(f"Output saved to {args.output}")
 
 if __name__ == "__main__":
     main()
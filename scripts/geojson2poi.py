@@ -1,9 +1,21 @@
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import argparse
 import json
+import re
+import shapely
 from shapely.geometry import Point
+import metrics
+from isochrone_store import geoid_int64, partition_frame, partition_positions, partition_state, partition_task, read_isochrones
+from parallel import WorkerPool
+from yelp_loader import load_businesses
 
+GROUP_COLUMNS = ["geoid", "profile", "time_limit"]
+TOP_CATEGORIES = 20
+CATEGORY_METADATA_KEY = b"poi_categories"
+
+@metrics.timed("poi_find_in_shape_seconds")
 def find_poi_in_shape(shape, geo_df):
     # Filter points inside the shape
     points_in_shape = geo_df[geo_df.geometry.within(shape)]
@@ -15,6 +27,8 @@ def find_poi_in_shape(shape, geo_df):
 
     return total_pois, average_stars, business_ids
 
+# The original per-group averages; aggregate_poi computes the same for all
+# groups at once and is tested against this
 def calculate_poi_averages(num_poi, rating_poi):
     if (len(num_poi) != len(rating_poi)):
         raise Exception("num_poi and rating_poi must have same number of elements!")
@@ -27,65 +41,272 @@ def calculate_poi_averages(num_poi, rating_poi):
         return 0,0
 
     average_num_poi = sum_num_poi / num_shapes
-    
+
     average_rating_poi = 0
     for i in range(num_shapes):
         if num_poi[i] != None and rating_poi[i] != None:
             average_rating_poi += num_poi[i] * rating_poi[i]
     average_rating_poi /= sum_num_poi
-    
+
     return average_num_poi, average_rating_poi
 
-def main():
-    parser = argparse.ArgumentParser(description="Calculate point of interests and output csv for census block groups from isochrone geojson")
-    parser.add_argument("geojson", help="Input GeoJSON file (e.g. isochrones.geojson)")
-    parser.add_argument("json", help="Input Yelp json file (e.g. yelp.json)")
-    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
-    args = parser.parse_args()
+def split_categories(categories):
+    # Yelp's "A, B, C" strings as lists, split the way json-read.py counts them
+    return categories.fillna("").str.split(",").apply(lambda names: [name.strip() for name in names if name.strip()])
 
-    if args.verbose:
-            print("Loading geojson.")
+def top_category_groups(categories, top=TOP_CATEGORIES):
+    # {category: [category]} for the `top` most common categories
+    counts = split_categories(categories).explode().value_counts()
+    return {name: [name] for name in counts.index[:top]}
+
+def load_category_groups(path):
+    # JSON object mapping a group name to the Yelp categories it covers
+    with open(path) as f:
+        groups = json.load(f)
+    if not isinstance(groups, dict) or not all(isinstance(names, list) for names in groups.values()):
+        raise ValueError(f"{path} must map group names to lists of categories")
+    return groups
+
+def category_membership(categories, groups):
+    # CSR arrays (offsets, group codes): business i belongs to
+    # codes[offsets[i]:offsets[i + 1]], each group at most once
+    group_of = {}
+    for code, names in enumerate(groups.values()):
+        for name in names:
+            group_of.setdefault(name, []).append(code)
+    lengths = []
+    codes = []
+    for names in split_categories(categories):
+        member = sorted({code for name in names for code in group_of.get(name, ())})
+        lengths.append(len(member))
+        codes.extend(member)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets, np.array(codes, dtype=np.int64)
+
+def category_column(prefix, name):
+    return f"{prefix}_{re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')}"
+
+class PoiIndex:
+    """POI points in one STRtree, queried in bulk with whole batches of isochrones.
+
+    With `groups` ({name: [Yelp categories]}), the same query also yields
+    per-group counts and star sums for every polygon.
+    """
+
+    def __init__(self, geo_df, groups=None):
+        self.tree = shapely.STRtree(geo_df.geometry.values)
+        self.stars = geo_df["stars"].to_numpy(dtype=float)
+        self.business_ids = geo_df["business_id"].to_numpy(dtype=object)
+        self.group_names = list(groups) if groups else []
+        if groups:
+            self.group_offsets, self.group_codes = category_membership(geo_df["categories"], groups)
 
-    gdf = gpd.read_file(args.geojson)
+    def query(self, polygons):
+        # (polygon index, poi index) pairs for every POI within a polygon,
+        # ordered like the row order of a per-polygon within() filter
+        polygons = np.asarray(polygons, dtype=object)
+        shapely.prepare(polygons)
+        polygon_idx, poi_idx = self.tree.query(polygons, predicate="contains")
+        order = np.lexsort((poi_idx, polygon_idx))
+        return polygon_idx[order], poi_idx[order]
 
+    def count(self, polygons, want_ids=None):
+        # Same (total_pois, average_stars, business_ids) as find_poi_in_shape,
+        # for a whole batch. Yelp stars are multiples of 0.5, so the per-polygon
+        # sums are exact whatever the summation order and the means match
+        # pandas' bit for bit.
+        polygon_idx, poi_idx = self.query(polygons)
+        return self.summarize(polygon_idx, poi_idx, len(polygons), want_ids)
+
+    def summarize(self, polygon_idx, poi_idx, n, want_ids=None):
+        num_poi = np.bincount(polygon_idx, minlength=n)
+        star_sums = np.bincount(polygon_idx, weights=self.stars[poi_idx], minlength=n)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rating_poi = np.where(num_poi > 0, star_sums / num_poi, np.nan)
+
+        poi_lists = None
+        if want_ids is not None:
+            splits = np.split(poi_idx, np.cumsum(num_poi)[:-1])
+            poi_lists = [
+                self.business_ids[ids].tolist() if want else None
+                for ids, want in zip(splits, want_ids)
+            ]
+        return num_poi, rating_poi, poi_lists
+
+    def group_sums(self, polygon_idx, poi_idx, n):
+        # (n, groups) POI counts and star sums, from the same match pairs:
+        # every pair is repeated once per group its business belongs to
+        starts = self.group_offsets[poi_idx]
+        lengths = self.group_offsets[poi_idx + 1] - starts
+        pair = np.repeat(np.arange(len(poi_idx)), lengths)
+        member = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[pair]
+        cell = polygon_idx[pair] * len(self.group_names) + self.group_codes[member]
+        size = n * len(self.group_names)
+        counts = np.bincount(cell, minlength=size).reshape(n, -1)
+        star_sums = np.bincount(cell, weights=self.stars[poi_idx[pair]], minlength=size).reshape(n, -1)
+        return counts, star_sums
+
+def shape_results(gdf, poi_index, poi_lists=True):
+    # Per-isochrone POI results for one chunk of the input, plus
+    # count:<group> / stars:<group> columns when the index has groups
     if gdf.crs != "EPSG:4326":
         gdf = gdf.to_crs("EPSG:4326")
-        if args.verbose:
-            print("Reprojected to EPSG:4326")
 
-    if args.verbose:
-            print("Done loading geojson.")
+    is_center = (gdf["point_label"] == "center").to_numpy() if poi_lists else None
+    with metrics.timer("poi_strtree_batch_seconds"):
+        polygon_idx, poi_idx = poi_index.query(gdf.geometry.values)
+        num_poi, rating_poi, poi_list = poi_index.summarize(polygon_idx, poi_idx, len(gdf), want_ids=is_center)
+        columns = {
+            "geoid": gdf["geoid"].to_numpy(),
+            "profile": gdf["profile"].to_numpy(),
+            "time_limit": gdf["time_limit"].to_numpy(),
+            "point_label": gdf["point_label"].to_numpy(),
+            "num_poi": num_poi,
+            "rating_poi": rating_poi,
+            "poi_list": poi_list,
+        }
+        if poi_index.group_names:
+            counts, star_sums = poi_index.group_sums(polygon_idx, poi_idx, len(gdf))
+            for i, name in enumerate(poi_index.group_names):
+                columns[f"count:{name}"] = counts[:, i]
+                columns[f"stars:{name}"] = star_sums[:, i]
+    metrics.count("poi_isochrones", len(gdf))
+    return pd.DataFrame(columns)
 
-    # Unique sets of geoids, point labels, profiles, and time limits
-    geoids = set()
-    point_labels = set()
-    profiles = set()
-    time_limits = set()
+def shape_results_scan(gdf, yelp_geo_df, verbose=False):
+    # Reference path: one full scan of the POIs per isochrone
+    if gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
 
-    # Calculate all geoid, point_label, profile, and time_limit types.
-    if args.verbose:
-            print("Finding all geoid, point_label, profile, and time_limit types.")
+    rows = []
+    progress = metrics.Progress("poi_isochrones", len(gdf), unit="isochrones", enabled=verbose)
     for index, row in gdf.iterrows():
-        geoids.add(row["geoid"])
-        point_labels.add(row["point_label"])
-        profiles.add(row["profile"])
-        time_limits.add(row["time_limit"])
+        num_poi, rating_poi, poi_list = find_poi_in_shape(row["geometry"], yelp_geo_df)
+        rows.append([row["geoid"], row["profile"], row["time_limit"], row["point_label"],
+                     num_poi, np.nan if rating_poi is None else rating_poi,
+                     poi_list if row["point_label"] == "center" else None])
+        progress.update()
+    metrics.count("poi_isochrones", len(gdf))
+    return pd.DataFrame(rows, columns=["geoid", "profile", "time_limit", "point_label", "num_poi", "rating_poi", "poi_list"])
 
-    if args.verbose:
-        print(f'Geoids: {geoids}, point labels: {point_labels}, profiles: {profiles}, time limits: {time_limits}')
+def shape_results_partition(state, rows):
+    gdf = partition_frame(state, rows)
+    if "poi_index" in state:
+        results = shape_results(gdf, state["poi_index"], state.get("poi_lists", True))
+    else:
+        results = shape_results_scan(gdf, state["yelp_geo_df"])
+    results.index = partition_positions(state, rows)
+    return results
+
+def aggregate_poi(shapes):
+    # Grouped equivalent of calculate_poi_averages over every
+    # geoid x profile x time_limit combination, including empty ones
+    num_poi = shapes["num_poi"].to_numpy(dtype=float)
+    products = np.where(num_poi > 0, num_poi * shapes["rating_poi"].to_numpy(), 0.0)
+
+    # bincount accumulates in row order, like the sequential sums in calculate_poi_averages
+    codes, groups = pd.MultiIndex.from_frame(shapes[GROUP_COLUMNS]).factorize()
+    num_shapes = np.bincount(codes, minlength=len(groups))
+    sum_num_poi = np.bincount(codes, weights=num_poi, minlength=len(groups))
+    sum_products = np.bincount(codes, weights=products, minlength=len(groups))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        has_poi = sum_num_poi != 0
+        average_num_poi = np.where(has_poi, sum_num_poi / num_shapes, 0)
+        average_rating_poi = np.where(has_poi, sum_products / sum_num_poi, 0)
+
+    # The center isochrone's business ids (the last one, if a group has several)
+    centers = shapes["point_label"].to_numpy() == "center"
+    poi_list_center = [[] for _ in range(len(groups))]
+    for code, poi_list in zip(codes[centers], shapes["poi_list"].to_numpy()[centers]):
+        poi_list_center[code] = poi_list
+
+    df = pd.DataFrame({
+        "average_num_poi": average_num_poi,
+        "average_rating_poi": average_rating_poi,
+        "poi_list_center": poi_list_center,
+    }, index=groups.set_names(GROUP_COLUMNS))
+
+    full_index = pd.MultiIndex.from_product(
+        [sorted(shapes[column].unique()) for column in GROUP_COLUMNS], names=GROUP_COLUMNS)
+    df = df.reindex(full_index)
+    missing = df["average_num_poi"].isna()
+    df.loc[missing, ["average_num_poi", "average_rating_poi"]] = 0
+    df.loc[missing, "poi_list_center"] = pd.Series([[] for _ in range(missing.sum())], index=df.index[missing], dtype=object)
+
+    df = df.reset_index().rename(columns={"geoid": "GEOID10"})
+    df["time_limit"] = df["time_limit"].astype(int)
+    return df
+
+def aggregate_categories(shapes, group_names):
+    # Per-group version of aggregate_poi's averages, one num_poi_<group> and
+    # rating_poi_<group> column per group, over the same full key product
+    codes, groups = pd.MultiIndex.from_frame(shapes[GROUP_COLUMNS]).factorize()
+    num_shapes = np.bincount(codes, minlength=len(groups))
+    columns = {}
+    for name in group_names:
+        sum_num_poi = np.bincount(codes, weights=shapes[f"count:{name}"].to_numpy(dtype=float), minlength=len(groups))
+        sum_stars = np.bincount(codes, weights=shapes[f"stars:{name}"].to_numpy(dtype=float), minlength=len(groups))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            has_poi = sum_num_poi != 0
+            columns[category_column("num_poi", name)] = np.where(has_poi, sum_num_poi / num_shapes, 0)
+            columns[category_column("rating_poi", name)] = np.where(has_poi, sum_stars / sum_num_poi, 0)
+    df = pd.DataFrame(columns, index=groups.set_names(GROUP_COLUMNS))
+
+    full_index = pd.MultiIndex.from_product(
+        [sorted(shapes[column].unique()) for column in GROUP_COLUMNS], names=GROUP_COLUMNS)
+    df = df.reindex(full_index, fill_value=0)
+    df = df.reset_index().rename(columns={"geoid": "GEOID10"})
+    df["time_limit"] = df["time_limit"].astype(int)
+    return df
+
+def write_categories(df, groups, path):
+    # Columnar, one float column per group and measure; the group definitions
+    # travel in the schema metadata
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CATEGORY_METADATA_KEY] = json.dumps(groups).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), path, compression="zstd")
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate point of interests and output csv for census block groups from isochrone geojson")
+    parser.add_argument("geojson", help="Input GeoJSON file, isochrone parquet store or ragged store (e.g. isochrones.geojson)")
+    parser.add_argument("json", help="Input Yelp json file (e.g. yelp.json)")
+    parser.add_argument("--city", default=None, help="Only keep businesses in this city (e.g. Philadelphia)")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"), default=None, help="Only keep businesses inside this box")
+    parser.add_argument("--yelp-cache", default=None, help="Parquet file caching the filtered businesses between runs")
+    parser.add_argument("--engine", choices=["strtree", "scan"], default="strtree", help="strtree: bulk spatial-index join (default); scan: per-isochrone full scan")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Read GeoJSON this many isochrones at a time (parquet is read per row group)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes, partitioned by geoid (default: 1)")
+    parser.add_argument("-o", "--output", default="blockgroup_poi.csv", help="Output CSV (default: blockgroup_poi.csv)")
+    parser.add_argument("--no-poi-list", action="store_true", help="Leave out poi_list_center (what remove-column.py strips)")
+    parser.add_argument("--top-categories", type=int, default=None, help="Also roll up POIs by the N most common Yelp categories")
+    parser.add_argument("--category-groups", default=None, help="JSON file mapping group names to lists of Yelp categories to roll up by")
+    parser.add_argument("--categories-output", default="blockgroup_poi_categories.parquet", help="Per-category Parquet output (default: blockgroup_poi_categories.parquet)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.enable_from_args(args)
+    by_category = args.top_categories is not None or args.category_groups is not None
+    if by_category and args.engine != "strtree":
+        parser.error("category rollups need the strtree engine")
 
     if args.verbose:
         print("Loading json")
 
-    # Load the JSON file (newline-delimited JSON objects)
-    yelp_df = pd.read_json(args.json, lines=True)
+    # Stream the newline-delimited JSON, keeping only complete POI rows
+    yelp_df = load_businesses(args.json, city=args.city, bbox=args.bbox, cache_path=args.yelp_cache, verbose=args.verbose)
 
-    # Drop missing values in 'categories' column
-    yelp_df = yelp_df.dropna(subset=['categories'])
-    yelp_df = yelp_df.dropna(subset=['latitude'])
-    yelp_df = yelp_df.dropna(subset=['longitude'])
-    yelp_df = yelp_df.dropna(subset=['stars'])
-    yelp_df = yelp_df.dropna(subset=['business_id'])
+    groups = None
+    if args.category_groups is not None:
+        groups = load_category_groups(args.category_groups)
+    elif args.top_categories is not None:
+        groups = top_category_groups(yelp_df["categories"], args.top_categories)
 
     # Convert DataFrame to GeoDataFrame
     yelp_geometry = [Point(xy) for xy in zip(yelp_df['longitude'], yelp_df['latitude'])]
@@ -95,70 +316,57 @@ def main():
         print("Done loading json")
 
     if args.verbose:
-        print("Calcuating point of interests in geometries, sorting by geoid")
+        print("Calcuating point of interests in geometries")
 
-    # Sort the gdf rows into appropriate geoid lists, calculate POIs in shapes
-    shapes_by_geoid = {}
-    for geoid in geoids:
-        shapes_by_geoid[geoid] = []
-
-    for index, row in gdf.iterrows():
-        num_poi, rating_poi, poi_list = find_poi_in_shape(row["geometry"], yelp_geo_df)
-        shape_dict = {
-          "profile": row["profile"],
-          "time_limit": row["time_limit"],
-          "point_label": row["point_label"],
-          "num_poi": num_poi,
-          "rating_poi": rating_poi,
-          "poi_list": poi_list
-        }
-        shapes_by_geoid[row["geoid"]].append(shape_dict)
-        if args.verbose:
-            print(row["geoid"], shape_dict["profile"], shape_dict["time_limit"], shape_dict["num_poi"], shape_dict["rating_poi"])
+    if args.engine == "strtree":
+        poi_index = PoiIndex(yelp_geo_df, groups)
 
-    if args.verbose:
-        print("Done calcuating point of interests in geometries.")
+    # Per-isochrone results are small; keep them all so the grouped sums run
+    # in input order no matter how the geometries were chunked
+    results = []
+    columns = GROUP_COLUMNS + ["point_label"]
+    # POI data reaches the workers once, through the pool initializer; the
+    # pool serves every chunk
+    pool_state = {"poi_lists": not args.no_poi_list}
+    if args.workers > 1:
+        if args.engine == "strtree":
+            pool_state["poi_index"] = poi_index
+        else:
+            pool_state["yelp_geo_df"] = yelp_geo_df
+    with WorkerPool(args.workers, pool_state) as pool:
+        # With workers, a ragged store's geometries are built in the workers
+        for gdf in read_isochrones(args.geojson, args.chunk_size, columns=columns, geometry=args.workers <= 1):
+            if args.workers > 1:
+                state = partition_state(gdf)
+                parts = pool.map_by_key(shape_results_partition, gdf["geoid"], lambda rows: partition_task(state, rows))
+                results.append(pd.concat(parts).sort_index())
+            elif args.engine == "strtree":
+                results.append(shape_results(gdf, poi_index, not args.no_poi_list))
+            else:
+                results.append(shape_results_scan(gdf, yelp_geo_df, args.verbose))
+            if args.verbose:
+                print(f"Processed chunk of {len(gdf)} geometries.")
 
     if args.verbose:
         print("Calculating average POI data of isochrone types by geoid")
 
-    # Calculate average POI by geoid, profile, time_limit; add to rows
-    rows = []
-    for geoid in geoids:
-        for profile in profiles:
-            for time_limit in time_limits:
-                num_poi = []
-                rating_poi = []
-                poi_list_center = []
-                for shape in shapes_by_geoid[geoid]:
-                    if (shape["profile"] == profile and shape["time_limit"] == time_limit):
-                        num_poi.append(shape["num_poi"])
-                        rating_poi.append(shape["rating_poi"])
-                        if (shape["point_label"] == "center"):
-                            poi_list_center = shape["poi_list"]
-                average_num_poi, average_rating_poi = calculate_poi_averages(num_poi, rating_poi) 
-                rows.append([geoid, profile, time_limit, average_num_poi, average_rating_poi, poi_list_center])
-                if args.verbose:
-                    print([geoid, profile, time_limit, average_num_poi, average_rating_poi])
-
-    if args.verbose:
-        print("Done calculating average POI data and sorting geometries. Writing to disk.")
-
-    columns = [
-        "GEOID10",
-        "profile",
-        "time_limit",
-        "average_num_poi",
-        "average_rating_poi",
-        "poi_list_center"
-    ]
+    shapes = pd.concat(results, ignore_index=True)
+    # GeoJSON geoids are floats; write the int64 ids the stores use
+    shapes["geoid"] = geoid_int64(shapes["geoid"])
+    df = aggregate_poi(shapes)
+    if args.no_poi_list:
+        df = df.drop(columns="poi_list_center")
 
     # Save dataframe
-    df = pd.DataFrame(rows, columns=columns)
-    df.to_csv("blockgroup_poi.csv", index=False)
+    df.to_csv(args.output, index=False)
 
     if args.verbose:
-        print("Output saved to blockgroup_poi.csv")
+        print(f"Output saved to {args.output}")
+
+    if groups:
+        write_categories(aggregate_categories(shapes, poi_index.group_names), groups, args.categories_output)
+        if args.verbose:
+            print(f"Category rollups for {len(groups)} groups saved to {args.categories_output}")
 
 if __name__ == "__main__":
     main()
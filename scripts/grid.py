@@ -0,0 +1,45 @@
+import numpy as np
+
+# Square grid cells shared by rtt_ingest.py (--grid-size, --cells) and the
+# approximate mode of spatial_features.py, so cell ids written by one can be
+# read by the other. A cell is the square [col, col + 1) x [row, row + 1) in
+# units of cell_size, and its id packs both indices into one int64.
+
+CELL_ROW = 2 ** 31  # cell id = row * CELL_ROW + col
+MAX_INDEX = CELL_ROW // 2  # rows and cols must lie in [-MAX_INDEX, MAX_INDEX)
+
+
+def pack_cells(row, col):
+    # Cell ids of integer rows and cols; out-of-range indices would decode to
+    # a different cell, so they are refused
+    row, col = np.asarray(row, dtype=np.int64), np.asarray(col, dtype=np.int64)
+    if np.any((row < -MAX_INDEX) | (row >= MAX_INDEX) | (col < -MAX_INDEX) | (col >= MAX_INDEX)):
+        raise ValueError(f"Grid rows and cols must lie in [-{MAX_INDEX}, {MAX_INDEX}); use a larger cell size")
+    return row * CELL_ROW + col
+
+
+def cell_ids(x, y, cell_size):
+    # Id of the cell containing each point; NaN coordinates give meaningless ids
+    row = np.floor(np.asarray(y, dtype=float) / cell_size)
+    col = np.floor(np.asarray(x, dtype=float) / cell_size)
+    if np.any((row < -MAX_INDEX) | (row >= MAX_INDEX) | (col < -MAX_INDEX) | (col >= MAX_INDEX)):
+        raise ValueError(f"Cell size {cell_size} is too small for these coordinates: grid rows and cols must lie in [-{MAX_INDEX}, {MAX_INDEX})")
+    with np.errstate(invalid="ignore"):
+        return row.astype(np.int64) * CELL_ROW + col.astype(np.int64)
+
+
+def rows_cols(ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    row = np.floor_divide(ids + CELL_ROW // 2, CELL_ROW)
+    return row, ids - row * CELL_ROW
+
+
+class GridLayer:
+    """Per-cell aggregates of one layer, keyed by cell id."""
+
+    def __init__(self, ids, values, covered, cell_size=None, crs=None):
+        self.ids = ids
+        self.values = values  # name -> array aligned with ids
+        self.covered = covered  # ids of the cells any geometry of the layer touches
+        self.cell_size = cell_size
+        self.crs = crs
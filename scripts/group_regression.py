@@ -0,0 +1,279 @@
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import stats
+from parallel import map_partitions
+
+# Every per-group OLS of Regression.ipynb (one model per time limit and
+# profile) fitted in one vectorized pass. The rows are grouped once into a
+# zero-padded (groups, rows, columns) stack; a specification then masks out
+# the rows run_regression's dropna would drop, and since zero rows change
+# nothing in least squares, one batched SVD gives every group's
+# pseudo-inverse solution exactly as sm.OLS(y, sm.add_constant(X)).fit()
+# computes it: same rcond cut-off, rank, degrees of freedom and standard
+# errors. fit_specifications() reuses the stack for any number of feature
+# lists.
+#
+# Bootstrap and cross-validation replicates reuse the same stack. Each
+# replicate draws from its own seed, so results don't depend on how the
+# replicates are split across --workers.
+
+BY = ["time_limit", "profile"]
+FEATURES = ["area_m2", "avg_stars", "choice", "no_truck_length", "distance_pool", "foreclosure_count", "foreclosure_over_area"]
+TARGET = "avg_housing_price"
+RCOND = 1e-15  # statsmodels' pinv_extended default
+REPLICATE_BATCH = 50
+
+
+class GroupDesign:
+    """Every group's rows as one zero-padded stack, missing values kept."""
+
+    def __init__(self, df, columns, target, by=BY):
+        self.columns = list(dict.fromkeys(columns))
+        self.target = target
+        codes = df.groupby(list(by), sort=False).ngroup().to_numpy()
+        rows = np.flatnonzero(codes >= 0)
+        codes = codes[rows]
+        first = np.unique(codes, return_index=True)[1]
+        keys = df[list(by)].iloc[rows[first]]
+        self.groups = pd.MultiIndex.from_frame(keys.reset_index(drop=True)) if len(by) > 1 else pd.Index(keys[by[0]].to_numpy(), name=by[0])
+        counts = np.bincount(codes, minlength=len(self.groups))
+
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        position = np.arange(len(order)) - (np.cumsum(counts) - counts)[sorted_codes]
+        shape = (len(self.groups), int(counts.max()) if len(order) else 0)
+        self.values = np.full(shape + (len(self.columns),), np.nan)
+        self.y = np.full(shape, np.nan)
+        self.values[sorted_codes, position] = df[self.columns].iloc[rows[order]].astype(float).to_numpy()
+        self.y[sorted_codes, position] = df[target].iloc[rows[order]].to_numpy(dtype=float)
+
+    def select(self, features):
+        # (X, y, nobs, has_const) of one specification, constant first. Rows
+        # missing any of its columns or the target are dropped as in
+        # run_regression, the rest moved to the front of their group
+        values = self.values[:, :, [self.columns.index(feature) for feature in features]]
+        valid = ~np.isnan(values).any(axis=2) & ~np.isnan(self.y)
+        order = np.argsort(~valid, axis=1, kind="stable")
+        valid = np.take_along_axis(valid, order, axis=1)
+        values = np.where(valid[:, :, None], np.take_along_axis(values, order[:, :, None], axis=1), 0.0)
+        y = np.where(valid, np.take_along_axis(self.y, order, axis=1), 0.0)
+        nobs = valid.sum(axis=1)
+
+        # sm.add_constant skips the constant when a column is already a
+        # nonzero constant; a zeroed column drops out of the pseudo-inverse
+        low = np.where(valid[:, :, None], values, np.inf).min(axis=1)
+        high = np.where(valid[:, :, None], values, -np.inf).max(axis=1)
+        nonzero = ~(valid[:, :, None] & (values == 0)).any(axis=1)
+        has_const = ~((low == high) & nonzero).any(axis=1)
+        X = np.concatenate([(valid & has_const[:, None])[:, :, None].astype(float), values], axis=2)
+        return X, y, nobs, has_const
+
+
+def _solve(X, y, rcond=RCOND):
+    # Batched pinv solution; returns params, normalized covariance and rank
+    u, s, vt = np.linalg.svd(X, full_matrices=False)
+    largest = s.max(axis=1, keepdims=True) if s.size else s
+    inverse = np.divide(1.0, s, out=np.zeros_like(s), where=s > rcond * largest)
+    params = np.einsum("bji,bj->bi", vt, inverse * np.einsum("bnj,bn->bj", u, y))
+    normalized_cov = np.einsum("bji,bj,bjl->bil", vt, inverse ** 2, vt)
+    # np.linalg.matrix_rank(np.diag(s)), as statsmodels computes it
+    rank = (s > largest * s.shape[1] * np.finfo(float).eps).sum(axis=1)
+    return params, normalized_cov, rank
+
+
+def _fit(X, y, nobs, has_const):
+    # sm.OLS results of every group as arrays
+    params, normalized_cov, rank = _solve(X, y)
+    # Columns that are all zero in a group get the minimum-norm answer
+    # exactly; the SVD only gets it to within rounding noise
+    zero = ~X.any(axis=1)
+    params[zero] = 0.0
+    normalized_cov[zero] = 0.0
+    normalized_cov.transpose(0, 2, 1)[zero] = 0.0
+
+    resid = y - np.einsum("bnk,bk->bn", X, params)
+    ssr = (resid ** 2).sum(axis=1)
+    df_resid = nobs - rank
+    mask = np.arange(y.shape[1]) < nobs[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scale = ssr / df_resid
+        bse = np.sqrt(scale[:, None] * np.diagonal(normalized_cov, axis1=1, axis2=2))
+        tvalues = params / bse
+        centered_tss = (((y - (y.sum(axis=1) / nobs)[:, None]) * mask) ** 2).sum(axis=1)
+        rsquared = 1 - ssr / centered_tss
+        rsquared_adj = 1 - (nobs - 1) / df_resid * (1 - rsquared)
+
+    # Groups fitted without the added constant report it as missing
+    for values in (params, bse, tvalues):
+        values[~has_const, 0] = np.nan
+    return {
+        "params": params, "bse": bse, "tvalues": tvalues, "pvalues": 2 * stats.t.sf(np.abs(tvalues), df_resid[:, None]),
+        "nobs": nobs, "rank": rank, "df_resid": df_resid, "ssr": ssr, "rsquared": rsquared, "rsquared_adj": rsquared_adj,
+    }
+
+
+def _summary_frame(groups, terms, fit, alpha=0.05):
+    # One row per group and term
+    q = stats.t.ppf(1 - alpha / 2, fit["df_resid"])[:, None]
+    columns = {
+        "coef": fit["params"], "std_err": fit["bse"], "t": fit["tvalues"], "p_value": fit["pvalues"],
+        "ci_lower": fit["params"] - q * fit["bse"], "ci_upper": fit["params"] + q * fit["bse"],
+    }
+    keys = groups.to_frame(index=False).iloc[np.repeat(np.arange(len(groups)), len(terms))]
+    index = pd.MultiIndex.from_arrays([keys[column].to_numpy() for column in keys.columns] + [np.tile(terms, len(groups))],
+                                      names=list(keys.columns) + ["term"])
+    return pd.DataFrame({name: values.ravel() for name, values in columns.items()}, index=index)
+
+
+class GroupOLS:
+    """sm.OLS results for every group, as DataFrames indexed by group."""
+
+    def __init__(self, design, features):
+        self.groups = design.groups
+        self.terms = ["const"] + list(features)
+        self.fit = _fit(*design.select(features))
+        for name in ("params", "bse", "tvalues", "pvalues"):
+            setattr(self, name, pd.DataFrame(self.fit[name], index=self.groups, columns=self.terms))
+        for name in ("nobs", "rank", "df_resid", "ssr", "rsquared", "rsquared_adj"):
+            setattr(self, name, pd.Series(self.fit[name], index=self.groups))
+
+    def conf_int(self, alpha=0.05):
+        # Lower and upper bounds, columns like params
+        q = stats.t.ppf(1 - alpha / 2, self.df_resid.to_numpy())[:, None]
+        return self.params - q * self.bse, self.params + q * self.bse
+
+    def summary_frame(self, alpha=0.05):
+        return _summary_frame(self.groups, self.terms, self.fit, alpha)
+
+
+def fit_groups(df, features=FEATURES, target=TARGET, by=BY):
+    return GroupOLS(GroupDesign(df, features, target, by), features)
+
+
+def fit_specifications(df, specifications, target=TARGET, by=BY):
+    # {name: feature list} -> one summary frame with a `specification` level.
+    # The groups are stacked once; each specification only masks its rows
+    design = GroupDesign(df, [feature for features in specifications.values() for feature in features], target, by)
+    frames = {name: _summary_frame(design.groups, ["const"] + list(features), _fit(*design.select(features)))
+              for name, features in specifications.items()}
+    return pd.concat(frames, names=["specification"])
+
+
+def _replicates(state, replicates):
+    # Params of the given bootstrap replicates, or fold scores of the given
+    # cross-validation repeats
+    X, y, nobs, seed, kind, folds = (state[key] for key in ("X", "y", "nobs", "seed", "kind", "folds"))
+    groups, rows, terms = X.shape
+    inside = np.arange(rows) < nobs[:, None]
+    results = []
+    for replicate in replicates:
+        rng = np.random.default_rng([seed, int(replicate)])
+        if kind == "bootstrap":
+            # Resample each group's rows; padding slots point at the zero row
+            draw = np.floor(rng.random((groups, rows)) * nobs[:, None]).astype(np.int64)
+            draw = np.where(inside, draw, rows)
+            padded_X = np.concatenate([X, np.zeros((groups, 1, terms))], axis=1)
+            padded_y = np.concatenate([y, np.zeros((groups, 1))], axis=1)
+            params, _, _ = _solve(np.take_along_axis(padded_X, draw[:, :, None], axis=1), np.take_along_axis(padded_y, draw, axis=1))
+            results.append(params)
+        else:
+            # Shuffled ranks within each group, padding ranked last
+            shuffle = np.where(inside, rng.random((groups, rows)), 2.0)
+            fold_of = np.where(inside, np.argsort(np.argsort(shuffle, axis=1), axis=1) % folds, -1)
+            for fold in range(folds):
+                train = (fold_of != fold) & inside
+                test = fold_of == fold
+                params, _, _ = _solve(X * train[:, :, None], y * train)
+                error = (y - np.einsum("bnk,bk->bn", X, params)) * test
+                n_test = test.sum(axis=1)
+                test_mean = np.divide((y * test).sum(axis=1), n_test, out=np.zeros(groups), where=n_test > 0)
+                tss = (((y - test_mean[:, None]) * test) ** 2).sum(axis=1)
+                results.append(np.column_stack([train.sum(axis=1), n_test, (error ** 2).sum(axis=1), tss]))
+    return np.array(results)
+
+
+def _run_replicates(X, y, nobs, kind, replicates, seed, workers, folds=None):
+    state = {"X": X, "y": y, "nobs": nobs, "seed": seed, "kind": kind, "folds": folds}
+    batches = np.array_split(np.arange(replicates), max(1, -(-replicates // REPLICATE_BATCH)))
+    return np.concatenate(map_partitions(_replicates, state, batches, workers))
+
+
+def bootstrap(df, features=FEATURES, target=TARGET, by=BY, replicates=200, seed=0, workers=1):
+    # Params of each pairs-bootstrap replicate, indexed by (group..., replicate).
+    # Resamples keep their group's constant; std() over replicates gives the
+    # bootstrap standard errors
+    design = GroupDesign(df, features, target, by)
+    X, y, nobs, has_const = design.select(features)
+    draws = _run_replicates(X, y, nobs, "bootstrap", replicates, seed, workers)
+    draws[:, ~has_const, 0] = np.nan
+    index = pd.MultiIndex.from_product([range(replicates), range(len(design.groups))], names=["replicate", "group"])
+    frame = pd.DataFrame(draws.reshape(-1, X.shape[2]), index=index, columns=["const"] + list(features))
+    return _with_groups(frame, design.groups).sort_index(level=["group", "replicate"]).droplevel("group")
+
+
+def cross_validate(df, features=FEATURES, target=TARGET, by=BY, folds=5, repeats=1, seed=0, workers=1):
+    # Out-of-sample error of each group's model over k shuffled folds,
+    # indexed by (group..., repeat, fold)
+    design = GroupDesign(df, features, target, by)
+    X, y, nobs, _ = design.select(features)
+    scores = _run_replicates(X, y, nobs, "cross_validation", repeats, seed, workers, folds)
+    index = pd.MultiIndex.from_product([range(repeats), range(folds), range(len(design.groups))], names=["repeat", "fold", "group"])
+    frame = pd.DataFrame(scores.reshape(-1, 4), index=index, columns=["nobs_train", "nobs_test", "sse", "tss"])
+    frame["rmse"] = np.sqrt(frame["sse"] / frame["nobs_test"])
+    frame["r2"] = 1 - frame["sse"] / frame["tss"]
+    frame = frame.astype({"nobs_train": int, "nobs_test": int})
+    return _with_groups(frame, design.groups).sort_index(level=["group", "repeat", "fold"]).droplevel("group")
+
+
+def _with_groups(frame, groups):
+    # Prepend the group keys for the positional `group` level
+    keys = groups.to_frame(index=False).iloc[frame.index.get_level_values("group")]
+    levels = [keys[column].to_numpy() for column in keys.columns] + [frame.index.get_level_values(name) for name in frame.index.names]
+    frame.index = pd.MultiIndex.from_arrays(levels, names=list(keys.columns) + list(frame.index.names))
+    return frame
+
+
+def read_table(path):
+    return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+
+
+def split_isochrone(df):
+    # iso_features.csv names isochrones "<geoid>-<time_limit>-<profile>"
+    parts = df["isochrone"].str.split("-", n=2, expand=True)
+    return df.assign(time_limit=parts[1].astype(int), profile=parts[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the per-(time limit, profile) OLS models of Regression.ipynb in one batched pass")
+    parser.add_argument("input", help="Feature table, CSV or parquet (e.g. iso_features.csv)")
+    parser.add_argument("-o", "--output", required=True, help="CSV of coefficients, standard errors, t and p values per group and term")
+    parser.add_argument("--features", nargs="+", default=FEATURES, help="Regressors (default: the notebook's seven)")
+    parser.add_argument("--target", default=TARGET, help=f"Dependent variable (default: {TARGET})")
+    parser.add_argument("--by", nargs="+", default=BY, help=f"Group columns (default: {' '.join(BY)})")
+    parser.add_argument("--bootstrap", type=int, default=0, help="Also write this many bootstrap replicates of the params")
+    parser.add_argument("--bootstrap-output", default=None, help="CSV for the bootstrap params (default: <output>.bootstrap.csv)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the bootstrap replicates")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Processes for the bootstrap replicates")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    args = parser.parse_args()
+
+    df = read_table(args.input)
+    if "isochrone" in df.columns and not set(args.by) <= set(df.columns):
+        df = split_isochrone(df)
+
+    results = fit_groups(df, args.features, args.target, args.by)
+    results.summary_frame().to_csv(args.output)
+    if args.verbose:
+        print(pd.DataFrame({"nobs": results.nobs, "r2": results.rsquared, "r2_adj": results.rsquared_adj}).to_string())
+        print(f"Wrote {len(results.params)} group models to {args.output}")
+
+    if args.bootstrap:
+        draws = bootstrap(df, args.features, args.target, args.by, args.bootstrap, args.seed, args.workers)
+        path = args.bootstrap_output or args.output.rsplit(".", 1)[0] + ".bootstrap.csv"
+        draws.to_csv(path)
+        if args.verbose:
+            print(f"Wrote {args.bootstrap} bootstrap replicates to {path}")
+
+if __name__ == "__main__":
+    main()
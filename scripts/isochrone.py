@@ -1,24 +1,122 @@
 import pandas as pd
 import requests
 import json
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import argparse
 import multiprocessing
+import queue
+import random
 import threading
 import time
+from requests.adapters import HTTPAdapter
+import metrics
+from ledger import COMPACT_SUPERSEDED, TaskLedger, task_key
+from response_cache import normalize_params, open_cache
 
 # Global lock for error file access
 error_file_lock = threading.Lock()
+# Guards the lazy init_fetcher of callers that never set one up
+fetcher_lock = threading.Lock()
 
 # ---- CONFIG ----
 GRAPH_HOPPER_URL = "http://localhost:8989/isochrone"
 TIME_LIMITS = [600, 1200, 1800]
 PROFILES = ["foot", "car", "pt"]
 POINT_LABELS = ["center", "north", "east", "south", "west"]
-NUM_WORKERS = multiprocessing.cpu_count()
+NUM_WORKERS = 64                     # Upper bound on requests in flight
+INITIAL_IN_FLIGHT = multiprocessing.cpu_count()
+MIN_IN_FLIGHT = 1
+LATENCY_TARGET = 2.0                 # Seconds; slower responses shrink the in-flight limit
+CONNECT_TIMEOUT = 10.0               # Seconds to open a connection to GraphHopper
+READ_TIMEOUT = 120.0                 # Seconds to wait for a response; a timeout counts as a failure
+RETRIES = 5
+BACKOFF_BASE = 0.5                   # Seconds, doubled on every failed attempt
+BACKOFF_CAP = 30.0
 CSV_FILE = "blockgroup_centers.csv"  # Update this if needed
 OUTPUT_FILE = "isochrones.geojson"   # Update this if needed
 ERROR_LOG_PATH = "error_file.log"    # Update this if needed
+LEDGER_FILE = "isochrones.ledger.ndjson"
+CACHE_FILE = "isochrone_cache.sqlite"
+CACHE_MAX_MB = 2048
+DEPARTURE_TIME = "2025-03-31T14:00:00Z"
+WRITE_QUEUE_SIZE = 1024              # Finished results waiting for the writer; fetchers block past this
+WRITE_BATCH_SIZE = 256               # Results journalled per write
+WRITE_BUFFER_BYTES = 1 << 20
+
+# ---- FETCHER STATE ----
+class AdaptiveLimiter:
+    """Caps the number of requests in flight, adjusting the cap from feedback.
+
+    Additive increase / multiplicative decrease: every fast success grows the
+    limit by roughly one per window, an error or a response slower than
+    latency_target halves it (at most once per latency_target seconds, so a
+    burst of failures from the same overload only counts once).
+    """
+
+    def __init__(self, initial, minimum, maximum, latency_target):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if not ok or latency > self.latency_target:
+                if now - self.last_decrease > self.latency_target:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+session = None
+limiter = None
+cache = None
+snap_decimals = None
+request_timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+def init_fetcher(max_in_flight=NUM_WORKERS, initial_in_flight=INITIAL_IN_FLIGHT,
+                 min_in_flight=MIN_IN_FLIGHT, latency_target=LATENCY_TARGET,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+    # One keep-alive session shared by all threads, pool sized to the max in flight
+    global session, limiter, request_timeout
+    request_timeout = (connect_timeout, read_timeout)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    limiter = AdaptiveLimiter(initial_in_flight, min_in_flight, max_in_flight, latency_target)
+
+def ensure_fetcher(max_in_flight=NUM_WORKERS):
+    # init_fetcher once, however many threads get here first; returns the
+    # (session, limiter) pair a request should use from start to finish
+    with fetcher_lock:
+        if session is None:
+            init_fetcher(max_in_flight)
+        return session, limiter
+
+def init_cache(path=CACHE_FILE, max_mb=CACHE_MAX_MB, snap=None):
+    # snap rounds request coordinates so nearly identical points share a response
+    global cache, snap_decimals
+    cache = open_cache(path, max_mb)
+    snap_decimals = snap
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # Exponential backoff with full jitter so retries from many threads spread out
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
 
 # ---- HELPERS ----
 def build_requests_from_csv(file_path):
@@ -46,103 +144,333 @@ def log_error(message, error_log_path=ERROR_LOG_PATH):
     with open(error_log_path, "a") as error_file:
         print(message, file=error_file)
 
+def make_result(params, isochrone):
+    return {
+        "geoid": params["geoid"],
+        "point_label": params["point_label"],
+        "profile": params["profile"],
+        "time_limit": params["time_limit"],
+        "coordinates": params["coordinates"],
+        "isochrone": isochrone
+    }
+
+@metrics.timed("isochrone_fetch_seconds")
 def fetch_isochrone(params):
-    retries = 5
+    # Local references, so a request releases the limiter it acquired
+    fetch_session, fetch_limiter = ensure_fetcher()
+
+    lat, lon = params["coordinates"].split(",")
+    extra = {"buckets": params["buckets"]} if "buckets" in params else {}
+    cache_params = None
+    if cache is not None:
+        cache_params = normalize_params(lat, lon, params["profile"], params["time_limit"], DEPARTURE_TIME, snap_decimals, **extra)
+        cached = cache.get(cache_params)
+        if cached is not None:
+            metrics.count("isochrone_cache_hits")
+            return make_result(params, cached)
+        metrics.count("isochrone_cache_misses")
+        if snap_decimals is not None:
+            lat, lon = cache_params["point"]
+
+    retries = RETRIES
 
     for attempt in range(1, retries + 1):
         try:
-            lat, lon = params["coordinates"].split(",")
             url = (
                 f"{GRAPH_HOPPER_URL}"
                 f"?profile={params['profile']}"
                 f"&point={lat},{lon}"
                 f"&time_limit={params['time_limit']}"
-                f"&pt.earliest_departure_time=2025-03-31T14:00:00Z"
+                f"&pt.earliest_departure_time={DEPARTURE_TIME}"
             )
+            if extra:
+                url += f"&buckets={extra['buckets']}"
 
-            #print(f"[→] Requesting: GEOID={params['geoid']} | Point={params['point_label']} | Profile={params['profile']} | Time={params['time_limit']}s")
+            fetch_limiter.acquire()
+            start = time.monotonic()
+            ok = False
+            try:
+                metrics.count("isochrone_requests")
+                # A hung request raises Timeout and is released as a failure
+                response = fetch_session.get(url, timeout=request_timeout)
+                response.raise_for_status()
+                isochrone = response.json()
+                ok = True
+            finally:
+                latency = time.monotonic() - start
+                fetch_limiter.release(latency, ok)
+                metrics.observe("isochrone_request_seconds", latency)
+                metrics.gauge("isochrone_in_flight_limit", fetch_limiter.limit)
 
-            response = requests.get(url)
-            response.raise_for_status()
+            if cache is not None:
+                cache.put(cache_params, isochrone)
 
-
-            #print(f"[✓] Success: GEOID={params['geoid']} | Point={params['point_label']} | Profile={params['profile']} | Time={params['time_limit']}s")
-
-            return {
-                "geoid": params["geoid"],
-                "point_label": params["point_label"],
-                "profile": params["profile"],
-                "time_limit": params["time_limit"],
-                "coordinates": params["coordinates"],
-                "isochrone": response.json()
-            }
+            return make_result(params, isochrone)
 
         except Exception as e:
+            metrics.count("isochrone_request_errors")
+            if isinstance(e, requests.Timeout):
+                metrics.count("isochrone_timeouts")
+            delay = backoff_delay(attempt)
             with error_file_lock:
                 log_error(f"[!] Error on attempt {attempt} for {params}: {e}")
                 if attempt < retries:
-                    log_error(f"[!] Retrying in 2 seconds... (Attempt {attempt + 1} of {retries})")
+                    log_error(f"[!] Retrying in {delay:.1f} seconds... (Attempt {attempt + 1} of {retries})")
                 else:
                     log_error(f"[!] Max retries reached. Giving up.")
             if attempt < retries:
-                time.sleep(2)
+                metrics.count("isochrone_retries")
+                time.sleep(delay)
             else:
+                metrics.count("isochrone_failures")
                 return None
 
+def write_geojson(ledger, output_path, keys=None):
+    # Rebuild the FeatureCollection from every successful task in the ledger,
+    # in the order of keys when given so the file doesn't depend on which
+    # requests happened to finish first. Written to a temporary file and
+    # renamed, so output_path is always a complete document.
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", buffering=WRITE_BUFFER_BYTES) as f:
+        # Write the initial structure of the geojson (beginning of the FeatureCollection)
+        f.write('{"type": "FeatureCollection", "features": [')
+
+        first_feature = True  # To handle commas between features
+
+        for record in ledger.records(status="ok", keys=keys):
+            features = [
+                json.dumps({
+                    "type": "Feature",
+                    "geometry": poly["geometry"],
+                    "properties": {
+                        "geoid": record["geoid"],
+                        "point_label": record["point_label"],
+                        "profile": record["profile"],
+                        "time_limit": record["time_limit"],
+                        "center": record["coordinates"]
+                    }
+                }, indent=2)
+                for poly in record["polygons"]
+            ]
+            if not features:
+                continue
+
+            # Serialize a whole record's features at once, with commas between features
+            if not first_feature:
+                f.write(",\n")
+            f.write(",\n".join(features))
+            first_feature = False
+
+        # Close the geojson structure (closing the feature array and the whole object)
+        f.write("\n]}")
+    os.replace(tmp_path, output_path)
+
+def output_keys(request_data, ledger):
+    # This run's tasks in CSV order, then anything else the ledger holds
+    keys = list(dict.fromkeys(task_key(params) for params in request_data))
+    requested = set(keys)
+    return keys + [key for key in ledger.latest if key not in requested]
+
+def bucket_limits(time_limits):
+    # GraphHopper buckets split time_limit into equal steps, so batching only
+    # reproduces our limits when they are multiples of the smallest one
+    limits = sorted(time_limits)
+    if any(limit != limits[0] * (i + 1) for i, limit in enumerate(limits)):
+        return None
+    return limits
+
+def batch_by_point(tasks):
+    # Group per-time_limit tasks into one batch per (geoid, point_label, profile)
+    batches = {}
+    for params in tasks:
+        key = (str(params["geoid"]), params["point_label"], params["profile"])
+        batches.setdefault(key, []).append(params)
+    return list(batches.values())
+
+def fetch_isochrone_buckets(batch):
+    # One traversal per point and profile; the nested bucket polygons are split
+    # back into the per-time_limit results the unbatched path produces
+    limits = bucket_limits(TIME_LIMITS)
+    params = dict(batch[0], time_limit=limits[-1], buckets=len(limits))
+    result = fetch_isochrone(params)
+    if result is None:
+        return [None] * len(batch)
+
+    polygons_by_limit = {limit: [] for limit in limits}
+    for poly in result["isochrone"].get("polygons", []):
+        bucket = poly.get("properties", {}).get("bucket", 0)
+        polygons_by_limit[limits[bucket]].append(poly)
+
+    return [
+        make_result(task, {"polygons": polygons_by_limit[int(task["time_limit"])]})
+        for task in batch
+    ]
+
+def fetch_isochrone_single(batch):
+    return [fetch_isochrone(params) for params in batch]
+
+class ResultWriter(threading.Thread):
+    """Journals finished results from a bounded queue in batches, off the fetch threads."""
+
+    def __init__(self, ledger, results, progress, batch_size=WRITE_BATCH_SIZE):
+        super().__init__(daemon=True)
+        self.ledger = ledger
+        self.results = results
+        self.progress = progress
+        self.batch_size = batch_size
+        self.failed_count = 0
+        self.error = None
+
+    def run(self):
+        done = False
+        while not done:
+            # Block for one result, then take whatever else is already waiting
+            batch = [self.results.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.results.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:  # end of input
+                batch.pop()
+                done = True
+            # After an error keep draining, so fetch threads never block on a dead writer
+            if batch and self.error is None:
+                try:
+                    self.write(batch)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, batch):
+        with metrics.timer("isochrone_write_batch_seconds"):
+            records = []
+            for params, result in batch:
+                if result is None:
+                    records.append(self.ledger.failure_record(params))
+                    self.failed_count += 1
+                else:
+                    records.append(self.ledger.success_record(result))
+            self.ledger.append(records)
+        metrics.gauge("isochrone_write_queue_depth", self.results.qsize())
+        self.progress.update(len(batch))
+
+def run_tasks(pending, ledger, max_in_flight=NUM_WORKERS, batch_buckets=False, queue_size=WRITE_QUEUE_SIZE):
+    # Fetch every pending task, journalling each outcome; returns the failure count
+    if batch_buckets:
+        batches = batch_by_point(pending)
+        fetch_batch = fetch_isochrone_buckets
+        print(f"[+] Batching {len(pending)} tasks into {len(batches)} bucketed requests")
+    else:
+        batches = [[params] for params in pending]
+        fetch_batch = fetch_isochrone_single
+
+    # Results are handed over as they finish, in any order; when the writer
+    # falls behind the queue fills up and fetch threads wait on put()
+    results = queue.Queue(maxsize=queue_size)
+    writer = ResultWriter(ledger, results, metrics.Progress("isochrone_tasks", len(pending)))
+    writer.start()
+
+    def fetch_and_queue(batch):
+        # Nothing more can be journalled once a ledger write failed
+        if writer.error is not None:
+            return
+        for params, result in zip(batch, fetch_batch(batch)):
+            results.put((params, result))
+
+    try:
+        # Threads only wait on the network; the limiter decides how many actually send
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = [executor.submit(fetch_and_queue, batch) for batch in batches]
+            for future in as_completed(futures):
+                future.result()
+                if writer.error is not None:
+                    # Drop the tasks not started yet; only those in flight finish
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+    finally:
+        results.put(None)
+        writer.join()
+
+    if writer.error is not None:
+        raise writer.error
+    return writer.failed_count
+
 # ---- MAIN ----
 def main():
-    request_data = build_requests_from_csv(CSV_FILE)
+    global GRAPH_HOPPER_URL, PROFILES, TIME_LIMITS
+    parser = argparse.ArgumentParser(description="Fetch isochrones from GraphHopper for census block group points")
+    parser.add_argument("--csv", default=CSV_FILE, help=f"Input points CSV (default: {CSV_FILE})")
+    parser.add_argument("--output", default=OUTPUT_FILE, help=f"Output GeoJSON file (default: {OUTPUT_FILE})")
+    parser.add_argument("--format", choices=["geojson", "parquet", "ragged"], default=None, help="Output format; ragged writes the memory-mapped store directory (default: from the output file extension)")
+    parser.add_argument("--url", default=GRAPH_HOPPER_URL, help=f"GraphHopper isochrone endpoint (default: {GRAPH_HOPPER_URL})")
+    parser.add_argument("--profiles", nargs="+", default=PROFILES, help=f"Routing profiles (default: {' '.join(PROFILES)})")
+    parser.add_argument("--time-limits", type=int, nargs="+", default=TIME_LIMITS, help=f"Time limits in seconds (default: {' '.join(map(str, TIME_LIMITS))})")
+    parser.add_argument("--max-in-flight", type=int, default=NUM_WORKERS, help="Upper bound on concurrent requests")
+    parser.add_argument("--min-in-flight", type=int, default=MIN_IN_FLIGHT, help="Lower bound the adaptive limit backs off to")
+    parser.add_argument("--initial-in-flight", type=int, default=INITIAL_IN_FLIGHT, help="Starting concurrent request limit")
+    parser.add_argument("--ledger", default=LEDGER_FILE, help=f"Task journal used to resume runs (default: {LEDGER_FILE})")
+    parser.add_argument("--retry-failed-only", action="store_true", help="Only retry tasks the ledger records as failed")
+    parser.add_argument("--fresh", action="store_true", help="Discard the existing ledger and fetch everything")
+    parser.add_argument("--compact-after", type=int, default=COMPACT_SUPERSEDED, help=f"Rewrite the ledger without superseded records once more than this many pile up (default: {COMPACT_SUPERSEDED})")
+    parser.add_argument("--batch-buckets", action="store_true", help="Fetch all time limits of a point and profile in one bucketed request")
+    parser.add_argument("--cache", default=CACHE_FILE, help=f"Response cache database (default: {CACHE_FILE})")
+    parser.add_argument("--no-cache", action="store_true", help="Always query GraphHopper, bypassing the response cache")
+    parser.add_argument("--cache-max-mb", type=float, default=CACHE_MAX_MB, help=f"Evict least recently used responses past this size (default: {CACHE_MAX_MB})")
+    parser.add_argument("--snap-decimals", type=int, default=None, help="Round coordinates to this many decimals before lookup and request")
+    parser.add_argument("--latency-target", type=float, default=LATENCY_TARGET, help="Response time in seconds above which concurrency is reduced")
+    parser.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT, help=f"Seconds to wait for a connection (default: {CONNECT_TIMEOUT:g})")
+    parser.add_argument("--timeout", type=float, default=READ_TIMEOUT, help=f"Seconds to wait for a response before the request fails and is retried (default: {READ_TIMEOUT:g})")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.enable_from_args(args)
+    PROFILES = args.profiles
+    TIME_LIMITS = args.time_limits
+    if args.batch_buckets and bucket_limits(TIME_LIMITS) is None:
+        parser.error(f"--batch-buckets needs time limits that are multiples of the smallest one, got {TIME_LIMITS}")
+
+    GRAPH_HOPPER_URL = args.url
+    init_fetcher(args.max_in_flight, args.initial_in_flight, args.min_in_flight, args.latency_target,
+                 args.connect_timeout, args.timeout)
+    if not args.no_cache:
+        init_cache(args.cache, args.cache_max_mb, args.snap_decimals)
+
+    request_data = build_requests_from_csv(args.csv)
     total_requests = len(request_data)
     print(f"[+] Generated {total_requests} request tasks...")
 
-    processed_count = 0  # Counter for processed features
-    lock = threading.Lock()  # Lock for synchronizing writes to the file
-
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        # Open the output file once before starting to write
-        with open(OUTPUT_FILE, "w") as f:
-            # Write the initial structure of the geojson (beginning of the FeatureCollection)
-            f.write('{"type": "FeatureCollection", "features": [')
+    ledger = TaskLedger(args.ledger, fresh=args.fresh)
+    if args.retry_failed_only:
+        failed = ledger.failed
+        pending = [params for params in request_data if task_key(params) in failed]
+    else:
+        completed = ledger.completed
+        pending = [params for params in request_data if task_key(params) not in completed]
+    print(f"[+] {total_requests - len(pending)} tasks already in {args.ledger}, {len(pending)} to fetch")
 
-            first_feature = True  # To handle commas between features
+    failed_count = run_tasks(pending, ledger, args.max_in_flight, args.batch_buckets)
 
-            for result in executor.map(fetch_isochrone, request_data):
-                if result is None:
-                    continue
-                for poly in result["isochrone"].get("polygons", []):
-                    geometry = poly["geometry"]
-
-                    #print(f"[+] Adding polygon: GEOID={result['geoid']} | Point={result['point_label']} | Profile={result['profile']} | Time={result['time_limit']}s")
-
-                    feature = {
-                        "type": "Feature",
-                        "geometry": geometry,
-                        "properties": {
-                            "geoid": result["geoid"],
-                            "point_label": result["point_label"],
-                            "profile": result["profile"],
-                            "time_limit": result["time_limit"],
-                            "center": result["coordinates"]
-                        }
-                    }
+    if ledger.superseded > args.compact_after:
+        print(f"[+] Compacting {args.ledger}: dropping {ledger.superseded} superseded records")
+        ledger.compact()
+    ledger.close()
+    print(f"[+] Final in-flight limit: {limiter.limit:.1f}")
+    if cache is not None:
+        stats = cache.stats()
+        print(f"[+] Cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+              f"{stats['evictions']} evicted, {stats['entries']} entries / {stats['bytes'] / 1024 ** 2:.1f} MB")
+        cache.close()
+    if failed_count:
+        print(f"[!] {failed_count} tasks failed; rerun with --retry-failed-only to retry them")
 
-                    # Use lock to ensure that only one thread writes to the file at a time
-                    with lock:
-                        # Write the feature, ensuring proper formatting (comma between features)
-                        if not first_feature:
-                            f.write(",\n")  # Add a comma before new features except the first one
-                        f.write(json.dumps(feature, indent=2))
-                        first_feature = False  # After the first feature, set the flag to False
-
-                        # Update the processed count and check for progress
-                        processed_count += 1
-                        progress_percent = (processed_count / total_requests) * 100
-                        print(f"[{int(progress_percent)}%] {processed_count}/{total_requests} features processed")
-
-            # Close the geojson structure (closing the feature array and the whole object)
-            with lock:
-                f.write("\n]}")
-            print(f"[✓] Incrementally saved features to {OUTPUT_FILE}")
+    output_format = args.format or {".parquet": "parquet", ".ragged": "ragged"}.get(os.path.splitext(args.output)[1], "geojson")
+    if output_format in ("parquet", "ragged"):
+        from isochrone_store import write_parquet
+        rows = write_parquet(ledger, args.output, keys=output_keys(request_data, ledger), ragged=output_format == "ragged")
+        print(f"[✓] Saved {rows} features to {args.output}")
+    else:
+        write_geojson(ledger, args.output, output_keys(request_data, ledger))
+        print(f"[✓] Saved features to {args.output}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,425 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyproj import Transformer
+from shapely.geometry import shape
+
+# Columnar isochrone store: GeoParquet with WKB geometry and typed attribute
+# columns, written one row group at a time so a full-city run never has to
+# sit in memory or in a pretty-printed text file.
+#
+# The ragged store (a directory, conventionally *.ragged) keeps the same
+# attributes next to raw little-endian geometry arrays: flat x/y coordinates
+# plus ring, polygon and geometry offsets, the layout of
+# shapely.to_ragged_array. The arrays are memory-mapped, so opening a store
+# reads nothing but the manifest and attribute table, processes reading the
+# same store share its pages, and geometries are built in bulk with
+# shapely.from_ragged_array instead of parsing WKB or GeoJSON row by row.
+
+ROW_GROUP_SIZE = 10000
+AREA_CRS = "EPSG:5070"  # NAD83 Conus Albers, equal-area with metre units
+
+SCHEMA = pa.schema([
+    ("geoid", pa.int64()),
+    ("point_label", pa.dictionary(pa.int8(), pa.string())),
+    ("profile", pa.dictionary(pa.int8(), pa.string())),
+    ("time_limit", pa.int32()),
+    ("center_latitude", pa.float64()),
+    ("center_longitude", pa.float64()),
+    ("isochrone_area_square_meters", pa.float64()),
+    ("geometry", pa.binary()),
+])
+
+RAGGED_MANIFEST = "store.json"
+RAGGED_ARRAYS = {
+    # name -> dtype; every offsets array starts at 0 and has one more entry than items
+    "coords": "<f8",
+    "ring_offsets": "<i8",
+    "polygon_offsets": "<i8",
+    "geometry_offsets": "<i8",
+}
+RAGGED_SCHEMA = pa.schema([field for field in SCHEMA if field.name != "geometry"] + [("multipart", pa.bool_())])
+
+GEO_METADATA = {
+    "version": "1.0.0",
+    "primary_column": "geometry",
+    "columns": {
+        "geometry": {
+            "encoding": "WKB",
+            "geometry_types": ["Polygon", "MultiPolygon"],
+        }
+    },
+}
+
+
+def projected_area(geometries, crs=AREA_CRS):
+    transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    projected = shapely.transform(geometries, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+    return shapely.area(projected)
+
+
+class IsochroneParquetWriter:
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.row_count = 0
+        self.writer = self.open_writer()
+
+    def open_writer(self):
+        schema = SCHEMA.with_metadata({"geo": json.dumps(GEO_METADATA)})
+        return pq.ParquetWriter(self.path, schema, compression="zstd")
+
+    def add_record(self, record):
+        # One row per polygon of a successful ledger record
+        lat, lon = (float(v) for v in record["coordinates"].split(","))
+        for poly in record["polygons"]:
+            self.rows.append((
+                int(float(record["geoid"])),
+                record["point_label"],
+                record["profile"],
+                int(record["time_limit"]),
+                lat,
+                lon,
+                poly["geometry"],
+            ))
+            if len(self.rows) >= self.row_group_size:
+                self.flush()
+
+    def add_frame(self, gdf):
+        # One row per geometry of a GeoDataFrame in the read_isochrones layout
+        # (center_latitude/center_longitude, or GeoJSON's "lat,lon" center)
+        if "center_latitude" in gdf:
+            centers = zip(gdf["center_latitude"], gdf["center_longitude"])
+        else:
+            centers = (tuple(float(v) for v in center.split(",")) for center in gdf["center"])
+        for geoid, point_label, profile, time_limit, (lat, lon), geometry in zip(
+                gdf["geoid"], gdf["point_label"], gdf["profile"], gdf["time_limit"], centers, gdf.geometry.values):
+            self.rows.append((int(float(geoid)), point_label, profile, int(time_limit), lat, lon, geometry))
+            if len(self.rows) >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        # Rows hold GeoJSON mappings from the ledger or shapely geometries from add_frame
+        geometries = np.array([geometry if isinstance(geometry, shapely.Geometry) else shape(geometry)
+                               for geometry in columns[6]], dtype=object)
+        self.write_rows(columns, geometries)
+        self.row_count += len(self.rows)
+        self.rows = []
+
+    @staticmethod
+    def attribute_arrays(columns, geometries):
+        return [
+            pa.array(columns[0], pa.int64()),
+            pa.array(columns[1], pa.string()).dictionary_encode(),
+            pa.array(columns[2], pa.string()).dictionary_encode(),
+            pa.array(columns[3], pa.int32()),
+            pa.array(columns[4], pa.float64()),
+            pa.array(columns[5], pa.float64()),
+            pa.array(projected_area(geometries), pa.float64()),
+        ]
+
+    def write_rows(self, columns, geometries):
+        arrays = self.attribute_arrays(columns, geometries) + [pa.array(shapely.to_wkb(geometries), pa.binary())]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.writer.schema))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class RaggedStoreWriter(IsochroneParquetWriter):
+    """Writes a ragged store, appending each row group to the flat arrays."""
+
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE):
+        super().__init__(path, row_group_size)
+        self.files = {name: open(os.path.join(path, f"{name}.bin"), "wb") for name in RAGGED_ARRAYS}
+        self.counts = {name: 0 for name in RAGGED_ARRAYS}
+        for name in RAGGED_ARRAYS:
+            if name != "coords":
+                self.files[name].write(np.zeros(1, dtype=RAGGED_ARRAYS[name]).tobytes())
+
+    def open_writer(self):
+        # The attributes go to a Parquet file inside the store directory
+        os.makedirs(self.path, exist_ok=True)
+        # A store is only complete once its manifest is written
+        if os.path.exists(os.path.join(self.path, RAGGED_MANIFEST)):
+            os.remove(os.path.join(self.path, RAGGED_MANIFEST))
+        return pq.ParquetWriter(os.path.join(self.path, "attributes.parquet"), RAGGED_SCHEMA, compression="zstd")
+
+    def write_rows(self, columns, geometries):
+        arrays = self.attribute_arrays(columns, geometries)
+        arrays.append(pa.array(shapely.get_type_id(geometries) == shapely.GeometryType.MULTIPOLYGON, pa.bool_()))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=RAGGED_SCHEMA))
+
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries)
+        if geometry_type == shapely.GeometryType.POLYGON:
+            # All single polygons: one polygon per geometry
+            offsets = offsets + (np.arange(len(geometries) + 1),)
+        ring_offsets, polygon_offsets, geometry_offsets = offsets
+        # Empty polygons come out as a polygon without rings, which
+        # from_ragged_array can't read back; store them with no polygons
+        has_rings = np.diff(polygon_offsets) > 0
+        if not has_rings.all():
+            kept = np.concatenate([[0], np.cumsum(has_rings)])
+            polygon_offsets = np.concatenate([[0], np.cumsum(np.diff(polygon_offsets)[has_rings])])
+            geometry_offsets = kept[geometry_offsets]
+
+        # Each level's offsets continue from what earlier row groups wrote of the level below
+        levels = [("ring_offsets", "coords", ring_offsets), ("polygon_offsets", "ring_offsets", polygon_offsets),
+                  ("geometry_offsets", "polygon_offsets", geometry_offsets)]
+        for name, below, values in levels:
+            self.files[name].write((values[1:] + self.counts[below]).astype(RAGGED_ARRAYS[name]).tobytes())
+        for name, _, values in levels:
+            self.counts[name] += len(values) - 1
+        self.files["coords"].write(np.ascontiguousarray(coords, dtype=RAGGED_ARRAYS["coords"]).tobytes())
+        self.counts["coords"] += len(coords)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        for f in self.files.values():
+            f.close()
+        manifest = {"version": 1, "rows": self.row_count, "counts": self.counts, "dtypes": RAGGED_ARRAYS}
+        with open(os.path.join(self.path, RAGGED_MANIFEST + ".tmp"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(os.path.join(self.path, RAGGED_MANIFEST + ".tmp"), os.path.join(self.path, RAGGED_MANIFEST))
+
+
+def is_ragged(path):
+    return os.path.isfile(os.path.join(path, RAGGED_MANIFEST))
+
+
+def _ragged_take(offsets, idx):
+    # Offsets of items idx of one ragged level, and the positions of their elements
+    starts = offsets[idx]
+    lengths = offsets[idx + 1] - starts
+    new_offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, positions
+
+
+class RaggedStore:
+    """Read side of a ragged store; the geometry arrays stay memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, RAGGED_MANIFEST)) as f:
+            manifest = json.load(f)
+        counts = manifest["counts"]
+        self.arrays = {}
+        for name, dtype in manifest["dtypes"].items():
+            shape = (counts[name], 2) if name == "coords" else (counts[name] + 1,)
+            # np.memmap can't map an empty file
+            self.arrays[name] = np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode="r", shape=shape) \
+                if counts[name] or name != "coords" else np.zeros(shape, dtype=dtype)
+        self.attributes = pq.read_table(os.path.join(path, "attributes.parquet")).to_pandas()
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def geometries(self, rows=None):
+        # Shapely geometries of rows (a slice, positions, or all) built in one
+        # from_ragged_array call; a contiguous slice only views the mapped arrays
+        ring_offsets, polygon_offsets, geometry_offsets = (self.arrays[name] for name in ("ring_offsets", "polygon_offsets", "geometry_offsets"))
+        if rows is None:
+            rows = slice(0, len(self))
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(len(self))
+            stop = max(start, stop)
+            geometry_part = geometry_offsets[start:stop + 1]
+            polygon_part = polygon_offsets[geometry_part[0]:geometry_part[-1] + 1]
+            ring_part = ring_offsets[polygon_part[0]:polygon_part[-1] + 1]
+            coords = self.arrays["coords"][ring_part[0]:ring_part[-1]]
+            offsets = (ring_part - ring_part[0], polygon_part - polygon_part[0], geometry_part - geometry_part[0])
+            multipart = self.attributes["multipart"].to_numpy()[start:stop]
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            geometry_part, polygons = _ragged_take(geometry_offsets, rows)
+            polygon_part, rings = _ragged_take(polygon_offsets, polygons)
+            ring_part, positions = _ragged_take(ring_offsets, rings)
+            coords = self.arrays["coords"][positions]
+            offsets = (ring_part, polygon_part, geometry_part)
+            multipart = self.attributes["multipart"].to_numpy()[rows]
+
+        geometries = shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, np.asarray(coords), offsets)
+        # Single polygons were stored as one-part multipolygons, empty ones with no parts
+        single = shapely.get_geometry(geometries, 0)
+        single = np.where(shapely.is_missing(single), shapely.Polygon(), single)
+        return np.where(multipart, geometries, single)
+
+    def bounds(self, rows=None):
+        # (n, 4) minx, miny, maxx, maxy straight from the coordinates, without
+        # building geometries; NaN for empty ones
+        coord_offsets = self.arrays["ring_offsets"][self.arrays["polygon_offsets"][self.arrays["geometry_offsets"]]]
+        if rows is None:
+            offsets, coords = coord_offsets, np.asarray(self.arrays["coords"])
+        else:
+            offsets, positions = _ragged_take(coord_offsets, np.asarray(rows, dtype=np.int64))
+            coords = np.asarray(self.arrays["coords"][positions])
+        result = np.full((len(offsets) - 1, 4), np.nan)
+        nonempty = offsets[1:] > offsets[:-1]
+        if nonempty.any():
+            starts = offsets[:-1][nonempty]
+            result[nonempty, :2] = np.minimum.reduceat(coords, starts)
+            result[nonempty, 2:] = np.maximum.reduceat(coords, starts)
+        return result
+
+    def frame(self, rows=None, columns=None, geometry=True):
+        # GeoDataFrame of rows with the requested attribute columns
+        import geopandas as gpd
+
+        attributes = self.attributes.drop(columns="multipart")
+        if columns is not None:
+            attributes = attributes[[column for column in columns if column != "geometry"]]
+        attributes = attributes.iloc[rows if rows is not None else slice(None)].reset_index(drop=True)
+        if not geometry:
+            return attributes
+        return gpd.GeoDataFrame(attributes, geometry=self.geometries(rows), crs="EPSG:4326")
+
+
+_open_stores = {}
+
+
+def open_ragged(path):
+    # One RaggedStore per path and process, so pool workers map a store once
+    if path not in _open_stores:
+        _open_stores[path] = RaggedStore(path)
+    return _open_stores[path]
+
+
+def partition_state(gdf, **state):
+    # Pool state for a chunk from read_isochrones. A chunk of a ragged store
+    # read with geometry=False sends the store path and the chunk's offset, and
+    # each worker builds only its own rows from the shared mapping; anything
+    # else sends the GeoDataFrame itself
+    if "ragged_store" in gdf.attrs:
+        state.update(store=gdf.attrs["ragged_store"], start=gdf.attrs["ragged_start"], columns=gdf.attrs["ragged_columns"])
+    else:
+        state["gdf"] = gdf
+    return state
+
+
+def partition_frame(state, rows):
+    # The isochrones at positions rows of the chunk a partition_state describes
+    if "store" in state:
+        return open_ragged(state["store"]).frame(state["start"] + np.asarray(rows), state["columns"])
+    return state["gdf"].iloc[rows]
+
+
+def partition_task(state, rows):
+    # (state, rows) of one partition for a parallel.WorkerPool, which outlives
+    # the chunk: a GeoDataFrame is cut down to the partition's rows, a ragged
+    # chunk already is just a path and offsets
+    if "gdf" in state:
+        return dict(state, gdf=state["gdf"].iloc[rows], positions=rows), np.arange(len(rows))
+    return state, rows
+
+
+def partition_positions(state, rows):
+    # Positions in the whole chunk of the rows a partition was given
+    return np.asarray(state["positions"])[rows] if "positions" in state else rows
+
+
+def geoid_int64(values):
+    # GeoJSON isochrones carry geoid as a float (421010108001.0), the parquet
+    # and ragged stores as int64; every output uses the int64 form
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values):
+        return values.astype("int64")
+    numbers = pd.to_numeric(values)
+    bad = numbers.isna() | (numbers % 1 != 0)
+    if bad.any():
+        raise ValueError(f"Non-integer geoid values: {values[bad].head().tolist()}")
+    return numbers.astype("int64")
+
+
+def write_parquet(ledger, output_path, row_group_size=ROW_GROUP_SIZE, keys=None, ragged=None):
+    # keys optionally restricts the output to these task keys, in that order;
+    # ragged (default: a .ragged output path) writes the ragged store instead
+    ragged = output_path.endswith(".ragged") if ragged is None else ragged
+    writer = (RaggedStoreWriter if ragged else IsochroneParquetWriter)(output_path, row_group_size)
+    for record in ledger.records(status="ok", keys=keys):
+        writer.add_record(record)
+    writer.close()
+    return writer.row_count
+
+
+def read_row_groups(path, columns=None):
+    # Yield one GeoDataFrame per row group so consumers can stream the store
+    import geopandas as gpd
+
+    parquet_file = pq.ParquetFile(path)
+    if columns is not None and "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+    for i in range(parquet_file.num_row_groups):
+        df = parquet_file.read_row_group(i, columns=columns).to_pandas()
+        df["geometry"] = shapely.from_wkb(df["geometry"].to_numpy())
+        yield gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
+
+
+def read_ragged(path, chunk_size=None, columns=None, geometry=True):
+    # Yield chunk_size rows (default ROW_GROUP_SIZE) at a time; with
+    # geometry=False only the attributes, tagged for partition_state
+    store = open_ragged(path)
+    chunk_size = chunk_size or ROW_GROUP_SIZE
+    for start in range(0, len(store), chunk_size):
+        chunk = store.frame(slice(start, start + chunk_size), columns, geometry)
+        if not geometry:
+            chunk.attrs.update(ragged_store=path, ragged_start=start, ragged_columns=columns)
+        yield chunk
+
+
+def read_isochrones(path, chunk_size=None, columns=None, geometry=True):
+    # Yield the isochrones at path as GeoDataFrames: one per row group for the
+    # parquet store, chunk_size at a time for a ragged store, chunk_size
+    # features at a time (or all at once) otherwise. geometry=False only
+    # skips building geometries for a ragged store
+    import geopandas as gpd
+
+    if is_ragged(path):
+        yield from read_ragged(path, chunk_size, columns, geometry)
+    elif path.endswith(".parquet"):
+        yield from read_row_groups(path, columns)
+    elif chunk_size is None:
+        yield gpd.read_file(path, columns=columns)
+    else:
+        offset = 0
+        while True:
+            chunk = gpd.read_file(path, columns=columns, skip_features=offset, max_features=chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+            offset += len(chunk)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert isochrones between GeoJSON, the parquet store and the memory-mapped ragged store")
+    parser.add_argument("input", help="Isochrone GeoJSON, parquet store or ragged store")
+    parser.add_argument("-o", "--output", required=True, help="Output store; a path ending in .ragged writes the ragged store, anything else GeoParquet")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Read GeoJSON this many isochrones at a time")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help=f"Rows per row group (default: {ROW_GROUP_SIZE})")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    args = parser.parse_args()
+
+    writer = (RaggedStoreWriter if args.output.endswith(".ragged") else IsochroneParquetWriter)(args.output, args.row_group_size)
+    for gdf in read_isochrones(args.input, args.chunk_size):
+        writer.add_frame(gdf)
+        if args.verbose:
+            print(f"Converted chunk of {len(gdf)} isochrones.")
+    writer.close()
+    if args.verbose:
+        print(f"Wrote {writer.row_count} isochrones to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,8 @@
-import pandas as pd
 from collections import Counter
+from yelp_loader import load_businesses
 
-# Load the JSON file (newline-delimited JSON objects)
-df = pd.read_json('yelp.json', lines=True)
-
-# Drop missing values in 'categories' column
-df = df.dropna(subset=['categories'])
-df = df.dropna(subset=['latitude'])
-df = df.dropna(subset=['longitude'])
-df = df.dropna(subset=['stars'])
+# Stream the JSON file (newline-delimited JSON objects), dropping missing values while parsing
+df = load_businesses('yelp.json', columns=['categories'], required=['categories', 'latitude', 'longitude', 'stars'])
 
 # Split categories, flatten into one list, and strip whitespace
 all_categories = df['categories'].str.split(',').explode().str.strip()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+
+# Append-only NDJSON journal of isochrone tasks. Each line records one attempt
+# at a task, keyed by (geoid, point_label, profile, time_limit); the latest line
+# for a key wins, earlier ones are skipped when reading. Successful lines carry
+# the returned polygons so the output file can be rebuilt without re-routing.
+# Byte offsets of the latest lines are kept so records can be read back in any
+# order, independent of the order tasks happened to finish in, and a digest
+# of each latest line identifies its content wherever it sits in the file.
+# Retries leave superseded lines behind; compact() rewrites the file without
+# them.
+
+SCAN_BLOCK_SIZE = 1 << 16  # bytes read per step when looking for the last newline
+COMPACT_SUPERSEDED = 1000  # superseded lines a run may leave before the file is compacted
+
+
+def task_key(params):
+    return (str(params["geoid"]), params["point_label"], params["profile"], int(params["time_limit"]))
+
+
+def line_digest(line):
+    return hashlib.blake2b(line, digest_size=16).hexdigest()
+
+
+class TaskLedger:
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.status = {}
+        self.latest = {}  # key -> line number of its latest record
+        self.offsets = {}  # key -> byte offset of its latest record
+        self.digests = {}  # key -> digest of its latest record's line
+        self.line_count = 0
+        self.size = 0
+
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            self._drop_partial_line()
+            for line_number, offset, line, record in self._read_lines():
+                self.status[task_key(record)] = record["status"]
+                self.latest[task_key(record)] = line_number
+                self.offsets[task_key(record)] = offset
+                self.digests[task_key(record)] = line_digest(line)
+
+        self.file = open(path, "ab")
+
+    def _drop_partial_line(self):
+        # A crash mid-write leaves a line without its newline; cut it off so
+        # the next append doesn't get glued onto it. Only the tail is read: the
+        # ledger holds every polygon and can be gigabytes.
+        with open(self.path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end == 0:
+                return
+            f.seek(end - 1)
+            if f.read(1) == b"\n":
+                return
+            position = end
+            while position > 0:
+                start = max(0, position - SCAN_BLOCK_SIZE)
+                f.seek(start)
+                newline = f.read(position - start).rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                position = start
+            f.truncate(0)
+
+    def _read_lines(self):
+        with open(self.path, "rb") as f:
+            for line_number, line in enumerate(f):
+                offset = self.size
+                self.line_count = line_number + 1
+                self.size += len(line)
+                try:
+                    yield line_number, offset, line, json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def records(self, status=None, keys=None):
+        # The latest record of every key in file order, or of each of `keys`
+        # in the order given (keys without a record are skipped)
+        if not os.path.exists(self.path):
+            return
+        if keys is not None:
+            if not self.file.closed:
+                self.file.flush()
+            with open(self.path, "rb") as f:
+                for key in keys:
+                    offset = self.offsets.get(key)
+                    if offset is None:
+                        continue
+                    f.seek(offset)
+                    record = json.loads(f.readline())
+                    if status is None or record["status"] == status:
+                        yield record
+            return
+        with open(self.path) as f:
+            for line_number, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if self.latest.get(task_key(record)) != line_number:
+                    continue
+                if status is None or record["status"] == status:
+                    yield record
+
+    @property
+    def superseded(self):
+        # Lines that are no longer the latest record of their key
+        return self.line_count - len(self.latest)
+
+    @property
+    def completed(self):
+        return {key for key, status in self.status.items() if status == "ok"}
+
+    @property
+    def failed(self):
+        return {key for key, status in self.status.items() if status == "failed"}
+
+    def append(self, records):
+        # One write and flush for the whole batch
+        lines = []
+        for record in records:
+            line = (json.dumps(record) + "\n").encode()
+            key = task_key(record)
+            self.status[key] = record["status"]
+            self.latest[key] = self.line_count
+            self.offsets[key] = self.size
+            self.digests[key] = line_digest(line)
+            self.line_count += 1
+            self.size += len(line)
+            lines.append(line)
+        self.file.write(b"".join(lines))
+        self.file.flush()
+
+    @staticmethod
+    def success_record(result):
+        return {
+            "status": "ok",
+            "geoid": result["geoid"],
+            "point_label": result["point_label"],
+            "profile": result["profile"],
+            "time_limit": result["time_limit"],
+            "coordinates": result["coordinates"],
+            "polygons": result["isochrone"].get("polygons", []),
+        }
+
+    @staticmethod
+    def failure_record(params):
+        return {
+            "status": "failed",
+            "geoid": params["geoid"],
+            "point_label": params["point_label"],
+            "profile": params["profile"],
+            "time_limit": params["time_limit"],
+            "coordinates": params["coordinates"],
+        }
+
+    def record_success(self, result):
+        self.append([self.success_record(result)])
+
+    def record_failure(self, params):
+        self.append([self.failure_record(params)])
+
+    def compact(self):
+        # Rewrite the file with only the latest line of every key, in file
+        # order. Lines are copied byte for byte, so their digests still hold;
+        # the new file replaces the old one only once it is complete.
+        self.file.flush()
+        tmp_path = self.path + ".tmp"
+        latest, offsets, size = {}, {}, 0
+        with open(self.path, "rb") as source, open(tmp_path, "wb") as target:
+            for line_number, (key, offset) in enumerate(sorted(self.offsets.items(), key=lambda item: item[1])):
+                source.seek(offset)
+                line = source.readline()
+                target.write(line)
+                latest[key] = line_number
+                offsets[key] = size
+                size += len(line)
+            target.flush()
+            os.fsync(target.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.latest, self.offsets = latest, offsets
+        self.line_count, self.size = len(latest), size
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
@@ -0,0 +1,254 @@
+import atexit
+import bisect
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+# Process-wide counters, latency histograms and rate-limited progress for the
+# pipeline scripts. Everything is off until enable() is called; until then
+# count/observe return straight away, timed() adds one flag check per call
+# and timer() hands back a shared no-op. Once enabled, a daemon thread writes
+# a snapshot every `interval` seconds (and once more at exit), as JSON or, for
+# a path ending in .prom, in the Prometheus text format.
+#
+# With --workers, only what the parent process records is exported.
+
+# Latency buckets in seconds, doubling from 100us to ~14min
+BUCKETS = [0.0001 * 2 ** i for i in range(24)]
+PROGRESS_INTERVAL = 1.0
+EXPORT_INTERVAL = 10.0
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_export_path = None
+_exporter = None
+_started = time.time()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, capped at max
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+def enabled():
+    return _enabled
+
+
+def enable(path=None, interval=EXPORT_INTERVAL):
+    # Start collecting; with a path, export periodically and at exit
+    global _enabled, _export_path, _exporter
+    _enabled = True
+    _export_path = path
+    if path is not None and _exporter is None:
+        _exporter = threading.Thread(target=_export_loop, args=(interval,), daemon=True)
+        _exporter.start()
+        atexit.register(export)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def gauge(name, value):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    # with timer("stage_seconds"): ... -- a shared no-op while disabled
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def timed(name):
+    # Decorator recording every call's duration in the `name` histogram
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class Progress:
+    """Progress line printed at most once per interval, with rate and ETA, instead of once per item."""
+
+    def __init__(self, name, total, unit="tasks", interval=PROGRESS_INTERVAL, enabled=True):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.enabled = enabled
+        self.done = 0
+        self.start = time.monotonic()
+        self.last_print = self.start
+
+    def update(self, n=1):
+        self.done += n
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self.last_print >= self.interval or self.done == self.total:
+            self.last_print = now
+            self.report(now)
+
+    def report(self, now=None):
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        percent = int(self.done / self.total * 100) if self.total else 100
+        line = f"[{percent}%] {self.done}/{self.total} {self.unit} processed ({rate:.1f}/s"
+        if rate > 0 and self.done < self.total:
+            line += f", ETA {(self.total - self.done) / rate:.0f}s"
+        print(line + ")", flush=True)
+        gauge(f"{self.name}_done", self.done)
+        gauge(f"{self.name}_per_second", rate)
+
+
+def snapshot():
+    with _lock:
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": time.time() - _started,
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {name: histogram.summary() for name, histogram in _histograms.items()},
+        }
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def prometheus_text():
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            name = _metric_name(name)
+            lines += [f"# TYPE {name}_total counter", f"{name}_total {value}"]
+        for name, value in sorted(_gauges.items()):
+            name = _metric_name(name)
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        for name, histogram in sorted(_histograms.items()):
+            name = _metric_name(name)
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(BUCKETS, histogram.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines += [f"{name}_sum {histogram.sum}", f"{name}_count {histogram.count}"]
+    return "\n".join(lines) + "\n"
+
+
+def export(path=None):
+    # Write-then-rename so a reader never sees a half-written snapshot
+    path = path or _export_path
+    if path is None:
+        return
+    text = prometheus_text() if path.endswith(".prom") else json.dumps(snapshot(), indent=2)
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def _export_loop(interval):
+    while True:
+        time.sleep(interval)
+        export()
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", default=None, help="Write counters and latency histograms here (.prom for Prometheus text, otherwise JSON)")
+    parser.add_argument("--metrics-interval", type=float, default=EXPORT_INTERVAL, help=f"Seconds between metrics snapshots (default: {EXPORT_INTERVAL:g})")
+
+
+def enable_from_args(args):
+    if args.metrics:
+        enable(args.metrics, args.metrics_interval)
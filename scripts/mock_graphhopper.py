@@ -0,0 +1,130 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Rough travel speeds (metres per second) used to size the fake isochrones
+SPEEDS = {"foot": 1.4, "car": 9.0, "pt": 5.0}
+METRES_PER_DEGREE = 111320.0
+
+
+def square_polygon(lat, lon, half_side_deg):
+    ring = [
+        [lon - half_side_deg, lat - half_side_deg],
+        [lon + half_side_deg, lat - half_side_deg],
+        [lon + half_side_deg, lat + half_side_deg],
+        [lon - half_side_deg, lat + half_side_deg],
+        [lon - half_side_deg, lat - half_side_deg],
+    ]
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def build_isochrone(lat, lon, profile, time_limit, buckets=1):
+    # GraphHopper splits time_limit into `buckets` equal steps, one polygon each
+    speed = SPEEDS.get(profile, 5.0)
+    polygons = []
+    for bucket in range(buckets):
+        seconds = time_limit * (bucket + 1) / buckets
+        half_side = speed * seconds / METRES_PER_DEGREE / 2
+        polygons.append({
+            "type": "Feature",
+            "geometry": square_polygon(lat, lon, half_side),
+            "properties": {"bucket": bucket},
+        })
+    return {"polygons": polygons, "info": {"copyrights": ["mock"], "took": 0}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real server
+
+    def do_GET(self):
+        server = self.server
+        with server.stats_lock:
+            server.request_count += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            in_flight = server.in_flight
+        try:
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            # Latency grows with concurrent load past `capacity`, like an overloaded router
+            overload = max(0, in_flight - server.capacity)
+            time.sleep(server.latency * (1 + overload))
+
+            if url.path != "/isochrone" or "point" not in query:
+                self.send_json(400, {"message": "point is required"})
+                return
+            if random.random() < server.error_rate:
+                self.send_json(500, {"message": "mock failure"})
+                return
+
+            lat, lon = (float(v) for v in query["point"][0].split(","))
+            profile = query.get("profile", ["car"])[0]
+            time_limit = float(query.get("time_limit", ["600"])[0])
+            buckets = int(query.get("buckets", ["1"])[0])
+            self.send_json(200, build_isochrone(lat, lon, profile, time_limit, buckets))
+        finally:
+            with server.stats_lock:
+                server.in_flight -= 1
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host="127.0.0.1", port=0, latency=0.0, capacity=8, error_rate=0.0, verbose=False):
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.capacity = capacity
+    server.error_rate = error_rate
+    server.verbose = verbose
+    server.stats_lock = threading.Lock()
+    server.request_count = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    return server
+
+
+def start_in_thread(**kwargs):
+    # Returns (server, url) with the server running in a daemon thread
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/isochrone"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fake GraphHopper isochrones for local testing and benchmarks")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8989, help="Port to listen on (default: 8989)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Base response time in seconds")
+    parser.add_argument("--capacity", type=int, default=8, help="Concurrent requests served before latency degrades")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.capacity, args.error_rate, args.verbose)
+    print(f"Mock GraphHopper listening on http://{args.host}:{args.port}/isochrone")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served {server.request_count} requests, peak {server.max_in_flight} in flight")
+
+
+if __name__ == "__main__":
+    main()
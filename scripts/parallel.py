@@ -0,0 +1,97 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# Process-pool fan-out shared by the polygon-processing scripts. Large
+# read-only inputs (the isochrones, the POI table and its STRtree) are handed
+# to the workers once through the pool initializer: under the fork start
+# method they are inherited without pickling, otherwise they are pickled once
+# per worker rather than once per task. Tasks only carry row positions.
+
+_state = {}
+
+
+def _init_worker(state):
+    _state.clear()
+    _state.update(state)
+
+
+def _run(task):
+    func, rows = task
+    return func(_state, rows)
+
+
+def _run_with_state(task):
+    func, state, rows = task
+    return func(dict(_state, **state), rows)
+
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("fork" if "fork" in methods else None)
+
+
+def partition_rows(keys, num_partitions):
+    # Row positions split so each key lands in exactly one partition; keys are
+    # assigned in sorted contiguous blocks and rows keep their input order
+    codes, uniques = pd.factorize(np.asarray(keys), sort=True)
+    if len(uniques) == 0:
+        return []
+    num_partitions = max(1, min(num_partitions, len(uniques)))
+    partition_of_key = np.arange(len(uniques)) * num_partitions // len(uniques)
+    partition = partition_of_key[codes]
+    return [np.flatnonzero(partition == i) for i in range(num_partitions)]
+
+
+def map_partitions(func, state, partitions, workers):
+    # func(state, rows) for every partition, results in partition order
+    if workers <= 1 or len(partitions) <= 1:
+        return [func(state, rows) for rows in partitions]
+
+    with _context().Pool(workers, initializer=_init_worker, initargs=(state,)) as pool:
+        return pool.map(_run, [(func, rows) for rows in partitions], chunksize=1)
+
+
+def map_by_key(func, state, keys, workers, partitions_per_worker=4):
+    # Partition by key (e.g. geoid), fan out, and return the results in order
+    partitions = partition_rows(keys, workers * partitions_per_worker)
+    return map_partitions(func, state, partitions, workers)
+
+
+class WorkerPool:
+    """A pool kept open across chunks, for the scripts that stream their input.
+
+    state is sent to the workers once, through the initializer, as in
+    map_partitions. What changes from chunk to chunk travels with the tasks:
+    split(rows) returns the (state, rows) one partition needs, so a task only
+    carries its own part of the chunk.
+    """
+
+    def __init__(self, workers, state=None):
+        self.workers = workers
+        self.state = state or {}
+        self.pool = None
+        if workers > 1:
+            self.pool = _context().Pool(workers, initializer=_init_worker, initargs=(self.state,))
+
+    def map_by_key(self, func, keys, split, partitions_per_worker=4):
+        # func(state, rows) per key partition, results in partition order
+        tasks = [(func, *split(rows)) for rows in partition_rows(keys, self.workers * partitions_per_worker)]
+        if self.pool is None:
+            return [func(dict(self.state, **state), rows) for _, state, rows in tasks]
+        return self.pool.map(_run_with_state, tasks, chunksize=1)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
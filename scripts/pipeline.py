@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+import isochrone
+from geojson2areas import PROJECTIONS, average_areas
+from geojson2poi import PoiIndex, aggregate_poi, shape_results
+from isochrone_store import write_parquet
+from ledger import COMPACT_SUPERSEDED, TaskLedger, task_key
+from shape2points import COLUMNS as CENTER_COLUMNS, get_centers, get_centers_vectorized
+from yelp_loader import load_businesses
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis"))
+import merge_into_parquet
+
+# Incremental runner for shape2points -> isochrone -> geojson2areas /
+# geojson2poi -> merge. Every stage records a content hash per partition
+# (block group for points, task for isochrones, (geoid, profile, time_limit)
+# for features) in the state file; a rerun recomputes only the partitions whose
+# inputs or parameters changed and splices them into the existing outputs.
+
+STATE_FILE = "pipeline_state.json"
+CENSUS_FILE = "Census_Block_Groups_2010.geojson"
+CENTERS_FILE = "blockgroup_centers.csv"
+AREAS_FILE = "blockgroup_areas.csv"
+POI_FILE = "blockgroup_poi.csv"
+POI_NO_LIST_FILE = "blockgroup_poi-no-list.csv"
+ISO_FEATURES_FILE = "iso_features.csv"
+ISOCHRONES_FILE = "isochrones.parquet"
+MERGED_FILE = "blockgroup-data.parquet"
+FEATURE_KEYS = ["GEOID10", "profile", "time_limit"]
+GEOID_CONVERTERS = {"GEOID10": lambda value: int(float(value))}
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def key_string(key):
+    return "|".join(str(part) for part in key)
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    # Write-then-rename so an interrupted save never corrupts the state
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def changed_partitions(hashes, old_hashes, output_path):
+    if not os.path.exists(output_path):
+        return set(hashes), set()
+    changed = {key for key, value in hashes.items() if old_hashes.get(key) != value}
+    removed = set(old_hashes) - set(hashes)
+    return changed, removed
+
+
+def splice_csv(path, new_rows, drop_keys, key_columns, key_of, order=None, dtype=None, converters=None):
+    # Replace the rows of drop_keys in the CSV at path with new_rows.
+    # round_trip keeps untouched floats byte-identical when written back
+    if os.path.exists(path):
+        existing = pd.read_csv(path, dtype=dtype, converters=converters, float_precision="round_trip")
+        if len(existing):
+            existing = existing[~existing.apply(key_of, axis=1).isin(drop_keys)]
+        df = pd.concat([existing, new_rows], ignore_index=True)
+    else:
+        df = new_rows
+    if order is not None:
+        df = df.iloc[df[key_columns[0]].map(order).argsort(kind="stable")]
+    else:
+        df = df.sort_values(key_columns, kind="stable")
+    df.to_csv(path, index=False)
+
+
+# ---- STAGES ----
+def stage_points(args, state):
+    gdf = gpd.read_file(args.census)
+    if gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
+
+    geoids = gdf["GEOID10"].astype(str)
+    hashes = {
+        geoid: digest(wkb, {"fast": args.fast_points})
+        for geoid, wkb in zip(geoids, shapely.to_wkb(gdf.geometry.values))
+    }
+    changed, removed = changed_partitions(hashes, state.get("points", {}), args.centers)
+
+    if changed or removed:
+        sub = gdf[geoids.isin(changed)]
+        if args.fast_points:
+            centers = get_centers_vectorized(sub.geometry.values).tolist()
+        else:
+            centers = [[coord for latlon in get_centers(geometry) for coord in latlon] for geometry in sub.geometry]
+        new_rows = pd.DataFrame([[geoid] + coords for geoid, coords in zip(sub["GEOID10"].astype(str), centers)],
+                                columns=CENTER_COLUMNS)
+        order = {geoid: i for i, geoid in enumerate(geoids)}
+        splice_csv(args.centers, new_rows, changed | removed, ["GEOID10"],
+                   lambda row: str(row["GEOID10"]), order=order, dtype={"GEOID10": str})
+
+    state["points"] = hashes
+    return len(changed) + len(removed)
+
+
+def stage_isochrones(args, state):
+    tasks = isochrone.build_requests_from_csv(args.centers)
+    ledger = TaskLedger(args.ledger)
+    hashes = {
+        key_string(task_key(params)): digest(params["coordinates"], params["profile"], params["time_limit"], isochrone.DEPARTURE_TIME)
+        for params in tasks
+    }
+    old = state.get("isochrones", {})
+    pending = [
+        params for params in tasks
+        if old.get(key_string(task_key(params))) != hashes[key_string(task_key(params))]
+        or ledger.status.get(task_key(params)) != "ok"
+    ]
+
+    if pending:
+        print(f"[+] {len(pending)} of {len(tasks)} isochrone tasks to fetch")
+        isochrone.init_fetcher(args.max_in_flight, read_timeout=args.timeout)
+        if not args.no_cache:
+            isochrone.init_cache(args.cache)
+        failed = isochrone.run_tasks(pending, ledger, args.max_in_flight, args.batch_buckets)
+        if failed:
+            print(f"[!] {failed} tasks failed; they are retried on the next run")
+        if isochrone.cache is not None:
+            isochrone.cache.close()
+            isochrone.cache = None
+    if ledger.superseded > COMPACT_SUPERSEDED:
+        ledger.compact()
+    ledger.close()
+
+    # Keep hashes of dropped tasks too: if they come back unchanged, their
+    # ledger entries are still valid and need no refetch
+    task_set_changed = sorted(hashes) != state.get("tasks")
+    state["isochrones"] = {**old, **hashes}
+    state["tasks"] = sorted(hashes)
+    return tasks, ledger, len(pending), task_set_changed
+
+
+def geoid_int(geoid):
+    # Ledger geoids are floats (421010108001.0); feature outputs use int64
+    return int(float(geoid))
+
+
+def feature_partition(geoid, profile, time_limit):
+    return key_string((geoid_int(geoid), profile, int(time_limit)))
+
+
+def feature_partitions(tasks, ledger, params):
+    # Hash of each (geoid, profile, time_limit) from the content digests of
+    # its member tasks' latest ledger records, so a refetch that returns
+    # different polygons changes the hash wherever the record lands in the file
+    members = {}
+    for task in tasks:
+        key = task_key(task)
+        partition = feature_partition(key[0], key[2], key[3])
+        members.setdefault(partition, []).append((key_string(key), ledger.digests.get(key)))
+    return {partition: digest(sorted(entries, key=str), params) for partition, entries in members.items()}
+
+
+def load_isochrones(tasks, ledger, partitions):
+    # Read in task order: the ledger is in completion order, and area sums
+    # depend on row order in the last bit
+    rows = []
+    for record in ledger.records(status="ok", keys=list(dict.fromkeys(task_key(task) for task in tasks))):
+        if feature_partition(record["geoid"], record["profile"], record["time_limit"]) not in partitions:
+            continue
+        for poly in record["polygons"]:
+            rows.append((geoid_int(record["geoid"]), record["point_label"], record["profile"], int(record["time_limit"]), shape(poly["geometry"])))
+    df = pd.DataFrame(rows, columns=["geoid", "point_label", "profile", "time_limit", "geometry"])
+    return gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
+
+
+def feature_key(row):
+    return feature_partition(row["GEOID10"], row["profile"], row["time_limit"])
+
+
+def stage_features(args, state, tasks, ledger):
+    yelp_stat = os.stat(args.yelp)
+    area_hashes = feature_partitions(tasks, ledger, {"projection": args.projection})
+    poi_hashes = feature_partitions(tasks, ledger, {"yelp": [yelp_stat.st_size, yelp_stat.st_mtime], "city": args.city})
+    area_changed, area_removed = changed_partitions(area_hashes, state.get("areas", {}), args.areas)
+    poi_changed, poi_removed = changed_partitions(poi_hashes, state.get("poi", {}), args.poi)
+
+    gdf = load_isochrones(tasks, ledger, area_changed | poi_changed)
+    partition_of = pd.Series(
+        [feature_partition(geoid, profile, time_limit) for geoid, profile, time_limit in zip(gdf["geoid"], gdf["profile"], gdf["time_limit"])],
+        index=gdf.index, dtype=object)
+
+    if area_changed or area_removed:
+        sub = gdf[partition_of.isin(area_changed)]
+        new_rows = average_areas([sub], PROJECTIONS[args.projection]) if len(sub) else pd.DataFrame(columns=FEATURE_KEYS)
+        splice_csv(args.areas, new_rows, area_changed | area_removed, FEATURE_KEYS, feature_key, converters=GEOID_CONVERTERS)
+
+    if poi_changed or poi_removed:
+        sub = gdf[partition_of.isin(poi_changed)]
+        new_rows = pd.DataFrame(columns=FEATURE_KEYS)
+        if len(sub):
+            yelp_df = load_businesses(args.yelp, city=args.city, cache_path=args.yelp_cache)
+            yelp_geo_df = gpd.GeoDataFrame(yelp_df, geometry=gpd.points_from_xy(yelp_df["longitude"], yelp_df["latitude"]), crs="EPSG:4326")
+            new_rows = aggregate_poi(shape_results(sub, PoiIndex(yelp_geo_df)))
+            new_rows = new_rows[new_rows.apply(feature_key, axis=1).isin(poi_changed)]
+        splice_csv(args.poi, new_rows, poi_changed | poi_removed, FEATURE_KEYS, feature_key, converters=GEOID_CONVERTERS)
+        pd.read_csv(args.poi, float_precision="round_trip").drop(columns="poi_list_center").to_csv(args.poi_no_list, index=False)
+
+    state["areas"] = area_hashes
+    state["poi"] = poi_hashes
+    return len(area_changed | area_removed), len(poi_changed | poi_removed)
+
+
+def file_stamp(path):
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def stage_merge(args, state):
+    # analysis/merge_into_parquet.py's readers and writer, so the pipeline and
+    # the script produce the same table; reruns when any input file changed
+    iso_features = None if args.no_iso_features else args.iso_features
+    stamp = digest(file_stamp(args.areas), file_stamp(args.poi_no_list), file_stamp(iso_features))
+    if state.get("merge") == stamp and os.path.exists(args.merged):
+        return None
+
+    areas = merge_into_parquet.read_areas(args.areas)
+    poi = merge_into_parquet.read_poi(args.poi_no_list)
+    features = None if iso_features is None else merge_into_parquet.read_iso_features(iso_features)
+    merged = merge_into_parquet.merge_features(areas, poi, features)
+    merge_into_parquet.write_parquet(merged, args.merged)
+    state["merge"] = stamp
+    return len(merged)
+
+
+# ---- MAIN ----
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally rebuild block group features, recomputing only what changed")
+    parser.add_argument("--census", default=CENSUS_FILE, help=f"Block group GeoJSON (default: {CENSUS_FILE})")
+    parser.add_argument("--yelp", required=True, help="Yelp business NDJSON")
+    parser.add_argument("--yelp-cache", default=None, help="Parquet cache for the filtered Yelp businesses")
+    parser.add_argument("--city", default=None, help="Only count businesses in this city")
+    parser.add_argument("--profiles", nargs="+", default=isochrone.PROFILES, help="Routing profiles")
+    parser.add_argument("--time-limits", type=int, nargs="+", default=isochrone.TIME_LIMITS, help="Isochrone time limits in seconds")
+    parser.add_argument("--projection", choices=sorted(PROJECTIONS), default="web-mercator", help="Projection for areas")
+    parser.add_argument("--fast-points", action="store_true", help="Use shape2points' vectorized ray intersection")
+    parser.add_argument("--url", default=isochrone.GRAPH_HOPPER_URL, help="GraphHopper isochrone endpoint")
+    parser.add_argument("--max-in-flight", type=int, default=isochrone.NUM_WORKERS, help="Upper bound on concurrent requests")
+    parser.add_argument("--timeout", type=float, default=isochrone.READ_TIMEOUT, help="Seconds to wait for a GraphHopper response")
+    parser.add_argument("--batch-buckets", action="store_true", help="One bucketed request per point and profile")
+    parser.add_argument("--cache", default=isochrone.CACHE_FILE, help="GraphHopper response cache")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+    parser.add_argument("--centers", default=CENTERS_FILE)
+    parser.add_argument("--ledger", default=isochrone.LEDGER_FILE)
+    parser.add_argument("--isochrones", default=ISOCHRONES_FILE)
+    parser.add_argument("--areas", default=AREAS_FILE)
+    parser.add_argument("--poi", default=POI_FILE)
+    parser.add_argument("--poi-no-list", default=POI_NO_LIST_FILE)
+    parser.add_argument("--iso-features", default=ISO_FEATURES_FILE, help=f"Isochrone features from the notebook, merged like merge_into_parquet.py (default: {ISO_FEATURES_FILE})")
+    parser.add_argument("--no-iso-features", action="store_true", help="Merge only areas and POI averages")
+    parser.add_argument("--merged", default=MERGED_FILE)
+    parser.add_argument("--state", default=STATE_FILE, help=f"Partition hashes from the last run (default: {STATE_FILE})")
+    parser.add_argument("--force", action="store_true", help="Ignore the saved state and rebuild everything")
+    args = parser.parse_args()
+
+    isochrone.GRAPH_HOPPER_URL = args.url
+    isochrone.PROFILES = args.profiles
+    isochrone.TIME_LIMITS = args.time_limits
+    if args.batch_buckets and isochrone.bucket_limits(args.time_limits) is None:
+        parser.error(f"--batch-buckets needs time limits that are multiples of the smallest one, got {args.time_limits}")
+
+    if not args.no_iso_features and not os.path.exists(args.iso_features):
+        parser.error(f"{args.iso_features} not found; pass --iso-features or --no-iso-features")
+
+    state = {} if args.force else load_state(args.state)
+
+    changed = stage_points(args, state)
+    save_state(args.state, state)
+    print(f"[points] {changed} block groups recomputed")
+
+    tasks, ledger, fetched, task_set_changed = stage_isochrones(args, state)
+    save_state(args.state, state)
+    print(f"[isochrones] {fetched} tasks fetched")
+    if fetched or task_set_changed or not os.path.exists(args.isochrones):
+        rows = write_parquet(ledger, args.isochrones, keys=list(dict.fromkeys(task_key(params) for params in tasks)))
+        print(f"[isochrones] {rows} features written to {args.isochrones}")
+
+    areas_changed, poi_changed = stage_features(args, state, tasks, ledger)
+    save_state(args.state, state)
+    print(f"[features] {areas_changed} area and {poi_changed} POI partitions recomputed")
+
+    rows = stage_merge(args, state)
+    save_state(args.state, state)
+    if rows is not None:
+        print(f"[merge] {rows} rows written to {args.merged}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Persistent cache of GraphHopper responses. Entries are addressed by the
+# SHA-256 of the normalized request parameters, so identical requests from
+# different block groups or different runs share one entry. Least recently
+# used entries are evicted once the stored bodies exceed max_bytes. Hits only
+# note their time in memory; the last_used updates are written in batches,
+# before every put (and so before any eviction) and on close.
+
+TOUCH_BATCH = 256  # hits whose last_used updates are written together
+
+
+def normalize_params(lat, lon, profile, time_limit, departure_time, snap_decimals=None, **extra):
+    lat, lon = float(lat), float(lon)
+    if snap_decimals is not None:
+        lat, lon = round(lat, snap_decimals), round(lon, snap_decimals)
+    params = {
+        "point": [lat, lon],
+        "profile": profile,
+        "time_limit": int(time_limit),
+        "departure_time": departure_time,
+    }
+    params.update(extra)
+    return params
+
+
+def cache_key(params):
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.touched = {}  # key -> time of its latest hit not yet written
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " params TEXT NOT NULL,"
+            " body BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.db.commit()
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, params):
+        key = cache_key(params)
+        with self.lock:
+            row = self.db.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, params, response):
+        key = cache_key(params)
+        body = json.dumps(response, separators=(",", ":")).encode()
+        with self.lock:
+            self._write_touched()
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, params, body, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(params, sort_keys=True), body, len(body), time.time()),
+            )
+            self.total_bytes += len(body)
+            self._evict()
+            self.db.commit()
+
+    def _write_touched(self):
+        self.db.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                            [(used, key) for key, used in self.touched.items()])
+        self.touched = {}
+
+    def _evict(self):
+        # Drop least recently used entries in batches until back under the limit
+        while self.total_bytes > self.max_bytes:
+            rows = self.db.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self._write_touched()
+            self.db.commit()
+            self.db.close()
+
+
+def open_cache(path, max_mb):
+    if path is None:
+        return None
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return ResponseCache(path, max_bytes=int(max_mb * 1024 ** 2))
@@ -0,0 +1,185 @@
+import argparse
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import grid
+
+# Streaming ingest of Philadelphia's real estate transfer (RTT) CSV. Reads
+# only the needed columns in chunks with fixed dtypes, keeps deeds and
+# sheriff's deeds with an assessed value after MIN_YEAR (the filters used in
+# "Isochrone Features Dataset Creation.ipynb"), and writes them to a Parquet
+# dataset partitioned by kind and year. Dates are only parsed for rows that
+# survive the document type filter. With --grid-size each transfer also
+# gets the id of its grid cell (see grid.py), with x = lng and y = lat.
+
+CHUNK_SIZE = 500000
+MIN_YEAR = 2010  # keep transfers with year > MIN_YEAR
+DOCUMENT_KINDS = {
+    "DEED": "deed",
+    "SHERIFF'S DEED": "foreclosure",
+    "DEED SHERIFF": "foreclosure",
+}
+USECOLS = ["document_type", "display_date", "assessed_value", "lat", "lng"]
+DTYPES = {
+    "document_type": str,
+    "display_date": str,
+    "assessed_value": "float64",
+    "lat": "float64",
+    "lng": "float64",
+}
+
+SCHEMA = pa.schema([
+    ("document_type", pa.string()),
+    ("display_date", pa.timestamp("ns")),
+    ("assessed_value", pa.float64()),
+    ("lat", pa.float64()),
+    ("lng", pa.float64()),
+    ("cell", pa.int64()),
+    ("kind", pa.string()),
+    ("year", pa.int32()),
+])
+
+
+def filter_chunk(chunk, min_year, cell_size):
+    chunk = chunk[chunk["document_type"].isin(DOCUMENT_KINDS.keys()) & chunk["assessed_value"].notnull()]
+    chunk = chunk.assign(display_date=pd.to_datetime(chunk["display_date"], errors="coerce"))
+    chunk = chunk[chunk["display_date"].dt.year > min_year]
+    chunk = chunk.dropna(subset=["lat", "lng"])
+    return chunk.assign(
+        cell=grid.cell_ids(chunk["lng"], chunk["lat"], cell_size) if cell_size else None,
+        kind=chunk["document_type"].map(DOCUMENT_KINDS),
+        year=chunk["display_date"].dt.year.astype("int32"),
+    )
+
+
+def iter_batches(path, min_year=MIN_YEAR, cell_size=None, chunk_size=CHUNK_SIZE, verbose=False):
+    rows_read = rows_kept = 0
+    with pd.read_csv(path, usecols=USECOLS, dtype=DTYPES, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            rows_read += len(chunk)
+            chunk = filter_chunk(chunk, min_year, cell_size)
+            rows_kept += len(chunk)
+            if verbose:
+                print(f"Read {rows_read} transfers, kept {rows_kept}")
+            if len(chunk):
+                yield pa.RecordBatch.from_pandas(chunk[SCHEMA.names], schema=SCHEMA, preserve_index=False)
+
+
+def ingest(path, output_dir, min_year=MIN_YEAR, cell_size=None, chunk_size=CHUNK_SIZE, verbose=False):
+    # The dataset is written next to output_dir and swapped in when complete,
+    # so partitions from an earlier run (e.g. with a lower --min-year) don't
+    # linger and a failed run leaves the previous dataset alone
+    tmp_dir = output_dir.rstrip(os.sep) + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    try:
+        ds.write_dataset(
+            iter_batches(path, min_year, cell_size, chunk_size, verbose),
+            tmp_dir,
+            schema=SCHEMA,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("kind", pa.string()), ("year", pa.int32())]), flavor="hive"),
+            file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        )
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)  # nothing survived the filters
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.replace(tmp_dir, output_dir)
+
+
+def aggregate_cells(output_dir, cells_path, cell_size):
+    # Per (kind, year, cell) counts and assessed value sums, for joins that
+    # only need totals and can work on grid cells instead of points
+    table = ds.dataset(output_dir, format="parquet", partitioning="hive").to_table(
+        columns=["kind", "year", "cell", "assessed_value"])
+    df = table.to_pandas()
+    cells = (df.groupby(["kind", "year", "cell"], observed=True)["assessed_value"]
+               .agg(count="count", sum_assessed_value="sum")
+               .reset_index())
+    cells["cell_size"] = float(cell_size)
+    cells.to_parquet(cells_path, index=False, compression="zstd")
+    return cells
+
+
+def load_cells(cells_path, kind, min_year=None):
+    # aggregate_cells output for one kind as a grid.GridLayer, usable as the
+    # deeds or foreclosures layer of spatial_features.approximate_features
+    # (EPSG:4326 isochrones and a Grid of the same cell size)
+    cells = pd.read_parquet(cells_path)
+    cell_size = cells["cell_size"].iloc[0] if len(cells) else None
+    cells = cells[cells["kind"] == kind]
+    if min_year is not None:
+        cells = cells[cells["year"] > min_year]
+    totals = cells.groupby("cell")[["count", "sum_assessed_value"]].sum()
+    ids = totals.index.to_numpy(dtype="int64")
+    values = {
+        "count": totals["count"].to_numpy(dtype=float),
+        "sum:assessed_value": totals["sum_assessed_value"].to_numpy(dtype=float),
+        "count:assessed_value": totals["count"].to_numpy(dtype=float),
+    }
+    return grid.GridLayer(ids, values, ids, cell_size, "EPSG:4326")
+
+
+def iter_transfers(output_dir, kind, min_year=None, columns=None, bbox=None):
+    # Yield GeoDataFrames of one kind ("deed" or "foreclosure") batch by batch;
+    # partition and bbox filters are pushed down to the Parquet scan
+    import geopandas as gpd
+
+    dataset = ds.dataset(output_dir, format="parquet", partitioning="hive")
+    expression = ds.field("kind") == kind
+    if min_year is not None:
+        expression &= ds.field("year") > min_year
+    if bbox is not None:
+        min_lng, min_lat, max_lng, max_lat = bbox
+        expression &= (ds.field("lng") >= min_lng) & (ds.field("lng") <= max_lng)
+        expression &= (ds.field("lat") >= min_lat) & (ds.field("lat") <= max_lat)
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ["lat", "lng"]))
+
+    for batch in dataset.to_batches(columns=columns, filter=expression):
+        df = batch.to_pandas()
+        if len(df):
+            yield gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["lng"], df["lat"]), crs="EPSG:4326")
+
+
+def load_transfers(output_dir, kind, min_year=None, columns=None, bbox=None):
+    import geopandas as gpd
+
+    chunks = list(iter_transfers(output_dir, kind, min_year, columns, bbox))
+    if not chunks:
+        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    return pd.concat(chunks, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream the RTT CSV into a partitioned Parquet dataset of deed and foreclosure points")
+    parser.add_argument("csv", help="Input RTT CSV (e.g. rtt_data.csv)")
+    parser.add_argument("-o", "--output", default="rtt_deeds", help="Output dataset directory (default: rtt_deeds)")
+    parser.add_argument("--min-year", type=int, default=MIN_YEAR, help=f"Keep transfers after this year (default: {MIN_YEAR})")
+    parser.add_argument("--grid-size", type=float, default=None, help="Also bin points into square cells of this many degrees")
+    parser.add_argument("--cells", default=None, help="Write per-cell counts and value sums here (requires --grid-size)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"CSV rows per chunk (default: {CHUNK_SIZE})")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    args = parser.parse_args()
+
+    if args.cells and not args.grid_size:
+        parser.error("--cells requires --grid-size")
+
+    ingest(args.csv, args.output, args.min_year, args.grid_size, args.chunk_size, args.verbose)
+    if args.verbose:
+        print(f"Output saved to {os.path.abspath(args.output)}")
+
+    if args.cells:
+        cells = aggregate_cells(args.output, args.cells, args.grid_size)
+        if args.verbose:
+            print(f"Saved {len(cells)} cell aggregates to {args.cells}")
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,64 @@
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import argparse
+import shapely
 from shapely.geometry import Point
+import metrics
+from parallel import map_by_key
 
-def get_centers(geometry):
-    if geometry.is_empty:
-        return [None] * 5
-
-    centroid = geometry.centroid
+@metrics.timed("border_point_seconds")
+def find_border_point(geometry, centroid, direction):
     minx, miny, maxx, maxy = geometry.bounds
 
-    def find_border_point(centroid, direction):
-        # Start with a reasonable maximum distance
-        if direction in ('north', 'south'):
-            max_distance = (maxy - miny)
-        else:
-            max_distance = (maxx - minx)
-
-        low = 0
-        high = max_distance
-        tolerance = 1e-10  # how precise we want to be
-
-        while high - low > tolerance:
-            mid = (low + high) / 2
-            if direction == 'north':
-                test_point = Point(centroid.x, centroid.y + mid)
-            elif direction == 'south':
-                test_point = Point(centroid.x, centroid.y - mid)
-            elif direction == 'east':
-                test_point = Point(centroid.x + mid, centroid.y)
-            elif direction == 'west':
-                test_point = Point(centroid.x - mid, centroid.y)
-
-            if geometry.contains(test_point):
-                low = mid  # try further
-            else:
-                high = mid  # try closer
-
-        # 3/4 of the final distance
-        final_distance = (low * 3) / 4
+    # Start with a reasonable maximum distance
+    if direction in ('north', 'south'):
+        max_distance = (maxy - miny)
+    else:
+        max_distance = (maxx - minx)
+
+    low = 0
+    high = max_distance
+    tolerance = 1e-10  # how precise we want to be
+
+    while high - low > tolerance:
+        mid = (low + high) / 2
         if direction == 'north':
-            return Point(centroid.x, centroid.y + final_distance)
+            test_point = Point(centroid.x, centroid.y + mid)
         elif direction == 'south':
-            return Point(centroid.x, centroid.y - final_distance)
+            test_point = Point(centroid.x, centroid.y - mid)
         elif direction == 'east':
-            return Point(centroid.x + final_distance, centroid.y)
+            test_point = Point(centroid.x + mid, centroid.y)
         elif direction == 'west':
-            return Point(centroid.x - final_distance, centroid.y)
+            test_point = Point(centroid.x - mid, centroid.y)
+
+        if geometry.contains(test_point):
+            low = mid  # try further
+        else:
+            high = mid  # try closer
+
+    # 3/4 of the final distance
+    final_distance = (low * 3) / 4
+    if direction == 'north':
+        return Point(centroid.x, centroid.y + final_distance)
+    elif direction == 'south':
+        return Point(centroid.x, centroid.y - final_distance)
+    elif direction == 'east':
+        return Point(centroid.x + final_distance, centroid.y)
+    elif direction == 'west':
+        return Point(centroid.x - final_distance, centroid.y)
+
+def get_centers(geometry):
+    if geometry.is_empty:
+        return [None] * 5
+
+    centroid = geometry.centroid
 
     # Calculate points
-    north_point = find_border_point(centroid, 'north')
-    east_point = find_border_point(centroid, 'east')
-    south_point = find_border_point(centroid, 'south')
-    west_point = find_border_point(centroid, 'west')
+    north_point = find_border_point(geometry, centroid, 'north')
+    east_point = find_border_point(geometry, centroid, 'east')
+    south_point = find_border_point(geometry, centroid, 'south')
+    west_point = find_border_point(geometry, centroid, 'west')
 
     return [
         (centroid.y, centroid.x),
@@ -63,12 +69,127 @@ def get_centers(geometry):
     ]
 
 
+COLUMNS = [
+    "GEOID10",
+    "center_lat", "center_lon",
+    "north_lat", "north_lon",
+    "east_lat", "east_lon",
+    "south_lat", "south_lon",
+    "west_lat", "west_lon"
+]
+
+# Unit steps for the directional rays, in (x, y)
+DIRECTIONS = {
+    "north": (0.0, 1.0),
+    "east": (1.0, 0.0),
+    "south": (0.0, -1.0),
+    "west": (-1.0, 0.0),
+}
+
+BISECT_TOLERANCE = 1e-10
+
+
+def ray_intervals(geometries, centroids, direction, lengths):
+    # Distances along each centroid ray that lie inside its polygon, as padded
+    # (n, k) arrays of open intervals (lo, hi); padding never matches
+    dx, dy = DIRECTIONS[direction]
+    cx, cy = shapely.get_x(centroids), shapely.get_y(centroids)
+    rays = shapely.linestrings(np.stack([
+        np.column_stack([cx, cy]),
+        np.column_stack([cx + dx * lengths, cy + dy * lengths]),
+    ], axis=1))
+    inside = shapely.intersection(rays, geometries)
+
+    parts, part_ray = shapely.get_parts(inside, return_index=True)
+    is_line = shapely.get_type_id(parts) == 1  # touching points never count as inside
+    parts, part_ray = parts[is_line], part_ray[is_line]
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    along = (coords[:, 0] - cx[part_ray[coord_part]]) * dx + (coords[:, 1] - cy[part_ray[coord_part]]) * dy
+
+    lo = np.full(len(parts), np.inf)
+    hi = np.full(len(parts), -np.inf)
+    np.minimum.at(lo, coord_part, along)
+    np.maximum.at(hi, coord_part, along)
+
+    n = len(geometries)
+    counts = np.bincount(part_ray, minlength=n)
+    width = max(1, counts.max(initial=0))
+    slot = np.arange(len(parts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    padded_lo = np.full((n, width), np.inf)
+    padded_hi = np.full((n, width), -np.inf)
+    padded_lo[part_ray, slot] = lo
+    padded_hi[part_ray, slot] = hi
+    return padded_lo, padded_hi
+
+
+def bisect_intervals(lo, hi, lengths, tolerance=BISECT_TOLERANCE):
+    # Replays find_border_point's bisection for every ray at once, with the
+    # containment test answered from the precomputed inside intervals. For a
+    # non-convex shape this lands on the same boundary crossing the
+    # point-by-point search does, not merely the first one.
+    low = np.zeros(len(lengths))
+    high = lengths.astype(float)
+    active = high - low > tolerance
+    while active.any():
+        mid = (low + high) / 2
+        contains = ((lo < mid[:, None]) & (mid[:, None] < hi)).any(axis=1)
+        low = np.where(active & contains, mid, low)
+        high = np.where(active & ~contains, mid, high)
+        active = high - low > tolerance
+    return low
+
+
+def get_centers_vectorized(geometries):
+    # Same points as get_centers for a whole array of geometries, returned as
+    # an (n, 10) array of lat/lon pairs (NaN for empty geometries). Agrees with
+    # the bisection to within BISECT_TOLERANCE degrees, and exactly unless a
+    # bisection midpoint falls within float rounding of the boundary.
+    geometries = np.asarray(geometries, dtype=object)
+    centroids = shapely.centroid(geometries)
+    bounds = shapely.bounds(geometries)
+    cx, cy = shapely.get_x(centroids), shapely.get_y(centroids)
+
+    points = [cy, cx]
+    for direction in ("north", "east", "south", "west"):
+        dx, dy = DIRECTIONS[direction]
+        if dy:
+            lengths = bounds[:, 3] - bounds[:, 1]
+        else:
+            lengths = bounds[:, 2] - bounds[:, 0]
+        lengths = np.nan_to_num(lengths)
+        lo, hi = ray_intervals(geometries, centroids, direction, lengths)
+        final_distance = (bisect_intervals(lo, hi, lengths) * 3) / 4
+        points += [cy + dy * final_distance, cx + dx * final_distance] if dy else [cy, cx + dx * final_distance]
+
+    return np.column_stack(points)
+
+
+def centers_partition(state, rows):
+    # (input position, output row) pairs for one partition of block groups
+    gdf = state["gdf"].iloc[rows]
+    results = []
+    for position, (index, row) in zip(rows, gdf.iterrows()):
+        flat_coords = [coord for latlon in get_centers(row["geometry"]) for coord in latlon]
+        results.append((position, [row["GEOID10"]] + flat_coords))
+    return results
+
+
+def fast_centers_partition(state, rows):
+    # (input positions, get_centers_vectorized rows) for one partition
+    return rows, get_centers_vectorized(state["gdf"].geometry.values[rows])
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract block group centers and directional points.")
     parser.add_argument("geojson", help="Input GeoJSON file (e.g. map.geojson)")
+    parser.add_argument("--fast", action="store_true", help="Vectorized ray intersection instead of per-point bisection")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes, partitioned by GEOID10 (default: 1)")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
+    metrics.enable_from_args(args)
+
     gdf = gpd.read_file(args.geojson)
 
     if gdf.crs != "EPSG:4326":
@@ -77,27 +198,40 @@ def main():
             print("Reprojected to EPSG:4326 (WGS84)")
 
     rows = []
-    for index, row in gdf.iterrows():
-        geoid = row["GEOID10"]
-        geometry = row["geometry"]
-        
-        centers = get_centers(geometry)
-        flat_coords = [coord for latlon in centers for coord in latlon]
-        rows.append([geoid] + flat_coords)
-
+    if args.fast:
+        # One ray intersection per direction for all block groups at once,
+        # or for each partition's block groups with workers
+        if args.workers > 1:
+            centers = np.full((len(gdf), len(COLUMNS) - 1), np.nan)
+            for positions, part in map_by_key(fast_centers_partition, {"gdf": gdf}, gdf["GEOID10"], args.workers):
+                centers[positions] = part
+        else:
+            centers = get_centers_vectorized(gdf.geometry.values)
+        rows = [[geoid] + coords for geoid, coords in zip(gdf["GEOID10"], centers.tolist())]
         if args.verbose:
-            print(f"Processed GEOID10: {geoid}, {flat_coords}")
-
-    columns = [
-        "GEOID10",
-        "center_lat", "center_lon",
-        "north_lat", "north_lon",
-        "east_lat", "east_lon",
-        "south_lat", "south_lon",
-        "west_lat", "west_lon"
-    ]
-
-    df = pd.DataFrame(rows, columns=columns)
+            print(f"Processed {len(rows)} block groups with ray intersections")
+        metrics.count("block_groups", len(rows))
+    elif args.workers > 1:
+        # Rows come back per partition; put them back in input order
+        parts = map_by_key(centers_partition, {"gdf": gdf}, gdf["GEOID10"], args.workers)
+        pairs = sorted((pair for part in parts for pair in part), key=lambda pair: pair[0])
+        rows = [row for position, row in pairs]
+        if args.verbose:
+            print(f"Processed {len(rows)} block groups with {args.workers} workers")
+        metrics.count("block_groups", len(rows))
+    else:
+        progress = metrics.Progress("block_groups", len(gdf), unit="block groups", enabled=args.verbose)
+        for index, row in gdf.iterrows():
+            geoid = row["GEOID10"]
+            geometry = row["geometry"]
+
+            centers = get_centers(geometry)
+            flat_coords = [coord for latlon in centers for coord in latlon]
+            rows.append([geoid] + flat_coords)
+            metrics.count("block_groups")
+            progress.update()
+
+    df = pd.DataFrame(rows, columns=COLUMNS)
     df.to_csv("blockgroup_centers.csv", index=False)
 
     if args.verbose:
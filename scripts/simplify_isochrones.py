@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import geopandas as gpd
+import numpy as np
+import shapely
+from geojson2poi import PoiIndex
+from isochrone_store import IsochroneParquetWriter, RaggedStoreWriter, projected_area, read_isochrones
+from yelp_loader import load_businesses
+
+# Optional stage between isochrone.py and the feature scripts: topology
+# preserving simplification plus coordinate quantization of the stored
+# isochrones, with a report of what it cost in accuracy. Areas are compared
+# in the equal-area projection; with --yelp, POI counts per isochrone are
+# compared too, since containment is what geojson2poi and the notebook use.
+
+TOLERANCE_METERS = 10.0
+DECIMALS = 6                # ~0.1 m of latitude
+METRES_PER_DEGREE = 111320  # of latitude; tolerances are converted with it
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def simplify_geometries(geometries, tolerance_meters=TOLERANCE_METERS, decimals=DECIMALS):
+    # Returns (simplified, collapsed); polygons that would vanish on the
+    # precision grid keep their original geometry
+    simplified = geometries
+    if tolerance_meters:
+        simplified = shapely.simplify(simplified, tolerance_meters / METRES_PER_DEGREE, preserve_topology=True)
+    if decimals is not None:
+        simplified = shapely.set_precision(simplified, 10.0 ** -decimals)
+    collapsed = shapely.is_empty(simplified) & ~shapely.is_empty(geometries)
+    return np.where(collapsed, geometries, simplified), collapsed
+
+
+class ErrorReport:
+    """Accumulates size and accuracy statistics over chunks of isochrones."""
+
+    def __init__(self, poi_index=None):
+        self.poi_index = poi_index
+        self.count = 0
+        self.collapsed = 0
+        self.vertices = [0, 0]
+        self.wkb_bytes = [0, 0]
+        self.area_error = []
+        self.difference = []
+        self.poi_counts = [[], []]
+
+    def add(self, original, simplified, collapsed):
+        self.count += len(original)
+        self.collapsed += int(collapsed.sum())
+        self.vertices[0] += int(shapely.get_num_coordinates(original).sum())
+        self.vertices[1] += int(shapely.get_num_coordinates(simplified).sum())
+        self.wkb_bytes[0] += sum(len(wkb) for wkb in shapely.to_wkb(original))
+        self.wkb_bytes[1] += sum(len(wkb) for wkb in shapely.to_wkb(simplified))
+
+        original_area = projected_area(original)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.area_error.append((projected_area(simplified) - original_area) / original_area)
+            self.difference.append(projected_area(shapely.symmetric_difference(original, simplified)) / original_area)
+
+        if self.poi_index is not None:
+            self.poi_counts[0].append(self.poi_index.count(original)[0])
+            self.poi_counts[1].append(self.poi_index.count(simplified)[0])
+
+    @staticmethod
+    def _summary(values):
+        values = np.abs(np.concatenate(values)) if values else np.array([])
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return None
+        summary = {"mean": float(values.mean()), "max": float(values.max())}
+        for q in QUANTILES:
+            summary[f"p{int(q * 100)}"] = float(np.quantile(values, q))
+        return summary
+
+    def summary(self):
+        report = {
+            "isochrones": self.count,
+            "collapsed": self.collapsed,
+            "vertices": {"before": self.vertices[0], "after": self.vertices[1]},
+            "wkb_bytes": {"before": self.wkb_bytes[0], "after": self.wkb_bytes[1]},
+            # Relative to the original area
+            "area_error": self._summary(self.area_error),
+            "symmetric_difference": self._summary(self.difference),
+        }
+        if self.poi_index is not None:
+            before = np.concatenate(self.poi_counts[0]) if self.poi_counts[0] else np.array([], dtype=int)
+            after = np.concatenate(self.poi_counts[1]) if self.poi_counts[1] else np.array([], dtype=int)
+            changed = before != after
+            report["containment"] = {
+                "points": len(self.poi_index.stars),
+                "pairs_before": int(before.sum()),
+                "pairs_after": int(after.sum()),
+                "isochrones_changed": int(changed.sum()),
+                "max_count_change": int(np.abs(after - before).max()) if len(before) else 0,
+                "pair_error": float(np.abs(after - before).sum() / before.sum()) if before.sum() else 0.0,
+            }
+        return report
+
+
+def write_geojson_chunks(chunks, output_path):
+    # Compact FeatureCollection, one chunk at a time, renamed into place when complete
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", buffering=1 << 20) as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        first_feature = True
+        for gdf in chunks:
+            properties = gdf.drop(columns=gdf.geometry.name).to_dict("records")
+            for geometry, props in zip(shapely.to_geojson(gdf.geometry.values), properties):
+                if not first_feature:
+                    f.write(",\n")
+                f.write(f'{{"type": "Feature", "geometry": {geometry}, "properties": {json.dumps(props)}}}')
+                first_feature = False
+        f.write("\n]}")
+    os.replace(tmp_path, output_path)
+
+
+def path_bytes(path):
+    # Size of a file, or of every file in a store directory
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def simplify_chunks(chunks, report, tolerance_meters, decimals, verbose=False):
+    for gdf in chunks:
+        original = gdf.geometry.values
+        simplified, collapsed = simplify_geometries(np.asarray(original, dtype=object), tolerance_meters, decimals)
+        report.add(np.asarray(original, dtype=object), simplified, collapsed)
+        if verbose:
+            print(f"Simplified chunk of {len(gdf)} geometries.")
+        yield gdf.set_geometry(gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simplify and quantize stored isochrones, reporting the area and containment error")
+    parser.add_argument("input", help="Isochrone GeoJSON, parquet store or ragged store (e.g. isochrones.geojson)")
+    parser.add_argument("-o", "--output", required=True, help="Output file; .parquet writes the columnar store, .ragged the ragged store, anything else GeoJSON")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE_METERS, help=f"Simplification tolerance in metres, 0 to skip (default: {TOLERANCE_METERS:g})")
+    parser.add_argument("--decimals", type=int, default=DECIMALS, help=f"Round coordinates to this many decimal degrees (default: {DECIMALS})")
+    parser.add_argument("--no-quantize", action="store_true", help="Keep full coordinate precision")
+    parser.add_argument("--yelp", default=None, help="Yelp business NDJSON to measure the change in POI containment")
+    parser.add_argument("--yelp-cache", default=None, help="Parquet cache for the Yelp businesses")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Read GeoJSON this many isochrones at a time (parquet is read per row group)")
+    parser.add_argument("--report", default=None, help="Also save the error report as JSON here")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    args = parser.parse_args()
+
+    poi_index = None
+    if args.yelp:
+        yelp_df = load_businesses(args.yelp, cache_path=args.yelp_cache, verbose=args.verbose)
+        yelp_geo_df = gpd.GeoDataFrame(yelp_df, geometry=gpd.points_from_xy(yelp_df["longitude"], yelp_df["latitude"]), crs="EPSG:4326")
+        poi_index = PoiIndex(yelp_geo_df)
+
+    report = ErrorReport(poi_index)
+    decimals = None if args.no_quantize else args.decimals
+    chunks = simplify_chunks(read_isochrones(args.input, args.chunk_size), report, args.tolerance, decimals, args.verbose)
+
+    if args.output.endswith((".parquet", ".ragged")):
+        writer = (RaggedStoreWriter if args.output.endswith(".ragged") else IsochroneParquetWriter)(args.output)
+        for gdf in chunks:
+            writer.add_frame(gdf)
+        writer.close()
+    else:
+        write_geojson_chunks(chunks, args.output)
+
+    summary = report.summary()
+    summary["input_bytes"] = path_bytes(args.input)
+    summary["output_bytes"] = path_bytes(args.output)
+    print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+import grid as cells_grid
+
+# Isochrone features from several spatial layers in one pass per layer.
+# The isochrones go into a single STRtree; each layer (points, lines or
+# polygons, whole or in chunks) is queried against it in bulk, and every
+# feature declared for that layer is accumulated from the same match pairs.
+#
+# A feature spec entry is a dict with:
+#   name      output column
+#   layer     key into the layers passed to compute_features
+#   agg       count | sum | mean | length | any | nearest
+#   column    layer column for sum / mean
+#   predicate optional, defaults to "within" for points, "intersects" otherwise
+#
+# count/sum/length are 0 and mean is NaN for isochrones without matches;
+# nearest is the distance to the closest layer geometry (0 if it touches).
+
+# The features built in "Isochrone Features Dataset Creation.ipynb"
+NOTEBOOK_FEATURES = [
+    {"name": "avg_stars", "layer": "yelp", "agg": "mean", "column": "stars"},
+    {"name": "choice", "layer": "choice", "agg": "any"},
+    {"name": "no_truck_length", "layer": "no_trucks", "agg": "sum", "column": "Shape__Length"},
+    {"name": "distance_pool", "layer": "pools", "agg": "nearest"},
+    {"name": "avg_housing_price", "layer": "deeds", "agg": "mean", "column": "assessed_value"},
+    {"name": "foreclosure_count", "layer": "foreclosures", "agg": "count"},
+]
+
+AGGREGATIONS = {"count", "sum", "mean", "length", "any", "nearest"}
+
+
+def _chunks(layer):
+    # A layer is a GeoDataFrame or an iterable of GeoDataFrame chunks
+    if hasattr(layer, "geometry"):
+        yield layer
+    else:
+        yield from layer
+
+
+def _default_predicate(geometries):
+    is_point = shapely.get_type_id(geometries) == 0
+    return "within" if len(geometries) and is_point.all() else "intersects"
+
+
+class _Totals:
+    """Per-isochrone running totals for the features of one layer."""
+
+    def __init__(self, specs, n):
+        self.specs = specs
+        self.n = n
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.sums = {spec["name"]: np.zeros(n) for spec in specs if spec["agg"] in ("sum", "mean")}
+        self.value_counts = {spec["name"]: np.zeros(n, dtype=np.int64) for spec in specs if spec["agg"] == "mean"}
+        self.lengths = {spec["name"]: np.zeros(n) for spec in specs if spec["agg"] == "length"}
+        self.nearest = np.full(n, np.inf)
+        self.wants_nearest = any(spec["agg"] == "nearest" for spec in specs)
+        self.wants_matches = any(spec["agg"] != "nearest" for spec in specs)
+        self.predicate = next((spec["predicate"] for spec in specs if "predicate" in spec), None)
+
+    def add_matches(self, iso_idx, layer_idx, columns, layer_geometries, iso_geometries):
+        # columns maps a layer column to its values, aligned with layer_geometries
+        n = self.n
+        self.counts += np.bincount(iso_idx, minlength=n)
+        for spec in self.specs:
+            name = spec["name"]
+            if name in self.sums:
+                values = columns[spec["column"]][layer_idx]
+                # Like pandas' groupby mean, rows with a missing value don't count
+                valid = ~np.isnan(values)
+                self.sums[name] += np.bincount(iso_idx[valid], weights=values[valid], minlength=n)
+                if name in self.value_counts:
+                    self.value_counts[name] += np.bincount(iso_idx[valid], minlength=n)
+            elif name in self.lengths:
+                clipped = shapely.intersection(layer_geometries[layer_idx], iso_geometries[iso_idx])
+                self.lengths[name] += np.bincount(iso_idx, weights=shapely.length(clipped), minlength=n)
+
+    def add_nearest(self, iso_idx, distances):
+        self.nearest[iso_idx] = np.minimum(self.nearest[iso_idx], distances)
+
+    def features(self):
+        features = {}
+        for spec in self.specs:
+            name, agg = spec["name"], spec["agg"]
+            if agg == "count":
+                features[name] = self.counts.copy()
+            elif agg == "any":
+                features[name] = self.counts > 0
+            elif agg == "sum":
+                features[name] = self.sums[name]
+            elif agg == "mean":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    features[name] = np.where(self.value_counts[name] > 0, self.sums[name] / self.value_counts[name], np.nan)
+            elif agg == "length":
+                features[name] = self.lengths[name]
+            elif agg == "nearest":
+                features[name] = np.where(np.isinf(self.nearest), np.nan, self.nearest)
+        return features
+
+
+def _check_spec(spec):
+    for entry in spec:
+        if entry["agg"] not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {entry['agg']!r} for feature {entry['name']!r}")
+        if entry["agg"] in ("sum", "mean") and "column" not in entry:
+            raise ValueError(f"Feature {entry['name']!r} needs a column for {entry['agg']}")
+
+
+def _by_layer(spec, layers):
+    by_layer = {}
+    for entry in spec:
+        by_layer.setdefault(entry["layer"], []).append(entry)
+    for layer_name, specs in by_layer.items():
+        if layer_name not in layers:
+            raise KeyError(f"No layer named {layer_name!r} for features {[s['name'] for s in specs]}")
+    return by_layer
+
+
+class FeatureEngine:
+    def __init__(self, isochrones):
+        self.isochrones = isochrones
+        self.crs = isochrones.crs
+        self.geometries = isochrones.geometry.values
+        self.tree = shapely.STRtree(np.asarray(self.geometries, dtype=object))
+
+    def layer_features(self, layer, specs):
+        # Stream one layer through the isochrone tree, filling every spec for it
+        totals = _Totals(specs, len(self.geometries))
+
+        for chunk in _chunks(layer):
+            if self.crs is not None and chunk.crs is not None and chunk.crs != self.crs:
+                chunk = chunk.to_crs(self.crs)
+            geometries = np.asarray(chunk.geometry.values, dtype=object)
+            if len(geometries) == 0:
+                continue
+
+            if totals.wants_matches:
+                layer_idx, iso_idx = self.tree.query(geometries, predicate=totals.predicate or _default_predicate(geometries))
+                columns = {spec["column"]: chunk[spec["column"]].to_numpy(dtype=float) for spec in specs if spec["name"] in totals.sums}
+                totals.add_matches(iso_idx, layer_idx, columns, geometries, self.geometries)
+
+            if totals.wants_nearest:
+                # Index-based nearest neighbour: a tree over this chunk, queried with every isochrone
+                chunk_tree = shapely.STRtree(geometries)
+                (iso_idx, _), distances = chunk_tree.query_nearest(self.geometries, return_distance=True, all_matches=False)
+                totals.add_nearest(iso_idx, distances)
+
+        return totals.features()
+
+    def compute(self, layers, spec=NOTEBOOK_FEATURES):
+        _check_spec(spec)
+        features = {}
+        for layer_name, specs in _by_layer(spec, layers).items():
+            features.update(self.layer_features(layers[layer_name], specs))
+
+        return pd.DataFrame(features, index=self.isochrones.index)[[entry["name"] for entry in spec]]
+
+
+def compute_features(isochrones, layers, spec=NOTEBOOK_FEATURES):
+    # DataFrame of features aligned with isochrones' index
+    return FeatureEngine(isochrones).compute(layers, spec)
+
+
+# ---- Preloaded layer indexes ----
+# FeatureEngine indexes the isochrones, which suits many isochrones against
+# layers read once. For a long-lived process that sees a few new isochrones
+# at a time (feature_service.py), the layers are indexed instead: each one is
+# loaded, reprojected and put in an STRtree once, and every call only queries
+# those trees with the new isochrones. Layer predicates are flipped to the
+# isochrone's side of the join, so the features equal compute_features.
+
+# Predicate of (isochrone, layer geometry) equivalent to a layer predicate of
+# (layer geometry, isochrone)
+INVERSE_PREDICATES = {
+    "within": "contains",
+    "contains": "within",
+    "covers": "covered_by",
+    "covered_by": "covers",
+    "intersects": "intersects",
+    "overlaps": "overlaps",
+    "crosses": "crosses",
+    "touches": "touches",
+}
+
+
+class LayerIndex:
+    """One layer's geometries and value columns, with an STRtree over them."""
+
+    def __init__(self, layer, specs, crs=None):
+        chunks = []
+        for chunk in _chunks(layer):
+            if crs is not None and chunk.crs is not None and chunk.crs != crs:
+                chunk = chunk.to_crs(crs)
+            chunks.append(chunk)
+        column_names = sorted({spec["column"] for spec in specs if spec["agg"] in ("sum", "mean")})
+        self.specs = specs
+        self.geometries = np.concatenate([np.asarray(c.geometry.values, dtype=object) for c in chunks]) if chunks else np.array([], dtype=object)
+        self.columns = {
+            column: np.concatenate([c[column].to_numpy(dtype=float) for c in chunks]) if chunks else np.array([])
+            for column in column_names
+        }
+        self.tree = shapely.STRtree(self.geometries)
+        predicate = next((spec["predicate"] for spec in specs if "predicate" in spec), None) or _default_predicate(self.geometries)
+        if predicate not in INVERSE_PREDICATES:
+            raise ValueError(f"Predicate {predicate!r} can't be queried from the isochrone side")
+        self.predicate = INVERSE_PREDICATES[predicate]
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def layer_features(self, geometries):
+        # Same features as FeatureEngine.layer_features, for these isochrones
+        totals = _Totals(self.specs, len(geometries))
+        if len(geometries) == 0 or len(self.geometries) == 0:
+            return totals.features()
+        if totals.wants_matches:
+            iso_idx, layer_idx = self.tree.query(geometries, predicate=self.predicate)
+            totals.add_matches(iso_idx, layer_idx, self.columns, self.geometries, geometries)
+        if totals.wants_nearest:
+            (iso_idx, _), distances = self.tree.query_nearest(geometries, return_distance=True, all_matches=False)
+            totals.add_nearest(iso_idx, distances)
+        return totals.features()
+
+
+class FeatureIndex:
+    """LayerIndexes for every layer a feature spec uses, built once."""
+
+    def __init__(self, layers, spec=NOTEBOOK_FEATURES, crs="EPSG:4326"):
+        _check_spec(spec)
+        self.spec = spec
+        self.crs = crs
+        self.layers = {
+            layer_name: LayerIndex(layers[layer_name], specs, crs)
+            for layer_name, specs in _by_layer(spec, layers).items()
+        }
+
+    def compute(self, geometries, index=None):
+        # DataFrame of features for an array of isochrone geometries in self.crs
+        geometries = np.asarray(geometries, dtype=object)
+        features = {}
+        for layer in self.layers.values():
+            features.update(layer.layer_features(geometries))
+        return pd.DataFrame(features, index=index)[[entry["name"] for entry in self.spec]]
+
+
+# ---- Approximate grid mode ----
+# Square cells of `cell_size` (in the isochrones' CRS units) stand in for the
+# polygon joins. Every layer is aggregated per cell once; an isochrone is the
+# set of cells whose centers it contains, found by scanline as runs of columns
+# on each cell row, and its features are sums over those runs taken from
+# row-wise prefix sums. Layer aggregates are cached on the Grid by layer name,
+# so trying new profiles or time limits only redoes the scanlines.
+#
+# Counts, sums and means take each geometry at its representative point, so
+# lines and polygons should be small next to the cells (street segments, not
+# whole routes); polygons also mark every cell they cover, for `any`. Lines
+# are cut into pieces no longer than half a cell and their length binned by
+# piece midpoint. nearest stays exact. A layer can also be given as a
+# GridLayer aggregated elsewhere, e.g. rtt_ingest.load_cells() on the --cells
+# output, as long as its cell size and CRS match. Cells are those of grid.py.
+#
+# feature_errors() measures the result against compute_features. With 50 m
+# cells and isochrones of 1.5-4 km radius (tests/test_spatial_features.py),
+# means are within 0.5% at the median and 2% at p95, counts and clipped line
+# length within 1% at the median, `any` disagrees on under 5% of isochrones,
+# and sums of line attributes, which take whole lines at one point, within 5%.
+
+CELL_SIZE = 100.0  # metres in a projected CRS; use degrees for EPSG:4326
+
+
+class Grid:
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.layers = {}
+
+    def cell_ids(self, x, y):
+        return cells_grid.cell_ids(x, y, self.cell_size)
+
+    def spans(self, geometries):
+        # (geometry index, row, first col, end col) runs of cells whose centers
+        # lie inside each geometry, from the even-odd crossings of its rings
+        # with the center line of every row
+        size = self.cell_size
+        parts, part_of = shapely.get_parts(np.asarray(geometries, dtype=object), return_index=True)
+        rings, ring_of = shapely.get_rings(parts, return_index=True)
+        coords, vertex_of = shapely.get_coordinates(rings, return_index=True)
+        same = vertex_of[1:] == vertex_of[:-1]
+        x0, y0 = coords[:-1][same].T
+        x1, y1 = coords[1:][same].T
+        edge_of = part_of[ring_of[vertex_of[:-1][same]]]
+
+        # Each edge crosses the rows whose center y is in [min(y0, y1), max(y0, y1))
+        first = np.ceil(np.minimum(y0, y1) / size - 0.5).astype(np.int64)
+        crossings = np.ceil(np.maximum(y0, y1) / size - 0.5).astype(np.int64) - first
+        edge = np.repeat(np.arange(len(x0)), crossings)
+        row = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(crossings) - crossings, crossings)
+        y = (row + 0.5) * size
+        x = x0[edge] + (y - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        geometry = edge_of[edge]
+
+        # Sorted along a row, crossings alternate entering and leaving
+        order = np.lexsort((x, row, geometry))
+        geometry, row, x = geometry[order], row[order], x[order]
+        position = np.arange(len(x))
+        starts = np.ones(len(x), dtype=bool)
+        starts[1:] = (geometry[1:] != geometry[:-1]) | (row[1:] != row[:-1])
+        rank = position - np.maximum.accumulate(np.where(starts, position, 0))
+        enter = position[rank % 2 == 0]
+        col_start = np.ceil(x[enter] / size - 0.5).astype(np.int64)
+        col_end = np.ceil(x[enter + 1] / size - 0.5).astype(np.int64)
+        keep = col_end > col_start
+        return geometry[enter][keep], row[enter][keep], col_start[keep], col_end[keep]
+
+    def cover(self, geometries):
+        # Ids of the cells whose centers lie inside any of the geometries
+        _, row, col_start, col_end = self.spans(geometries)
+        width = col_end - col_start
+        span = np.repeat(np.arange(len(width)), width)
+        col = col_start[span] + np.arange(len(span)) - np.repeat(np.cumsum(width) - width, width)
+        return np.unique(cells_grid.pack_cells(row[span], col))
+
+    def aggregate(self, layer, specs, crs=None):
+        # Per-cell count, column sums / value counts and line lengths of a layer
+        columns = sorted({spec["column"] for spec in specs if spec["agg"] in ("sum", "mean")})
+        wants_length = any(spec["agg"] == "length" for spec in specs)
+        wants_cover = any(spec["agg"] == "any" for spec in specs)
+        collected = {"ids": [], "columns": {column: [] for column in columns}, "length_ids": [], "lengths": [], "covered": []}
+
+        for chunk in _chunks(layer):
+            if crs is not None and chunk.crs is not None and chunk.crs != crs:
+                chunk = chunk.to_crs(crs)
+            geometries = np.asarray(chunk.geometry.values, dtype=object)
+            if len(geometries) == 0:
+                continue
+            points = shapely.point_on_surface(geometries)
+            collected["ids"].append(self.cell_ids(shapely.get_x(points), shapely.get_y(points)))
+            for column in columns:
+                collected["columns"][column].append(chunk[column].to_numpy(dtype=float))
+
+            type_ids = shapely.get_type_id(geometries)
+            is_line = np.isin(type_ids, (1, 2, 5))
+            if wants_length and is_line.any():
+                # Consecutive vertices of the same single line make a segment
+                pieces = shapely.get_parts(shapely.segmentize(geometries[is_line], self.cell_size / 2))
+                coords, index = shapely.get_coordinates(pieces, return_index=True)
+                same = index[1:] == index[:-1]
+                start, end = coords[:-1][same], coords[1:][same]
+                middle = (start + end) / 2
+                collected["length_ids"].append(self.cell_ids(middle[:, 0], middle[:, 1]))
+                collected["lengths"].append(np.hypot(*(end - start).T))
+
+            is_area = np.isin(type_ids, (3, 6))
+            if wants_cover and is_area.any():
+                collected["covered"].append(self.cover(geometries[is_area]))
+
+        empty = np.array([], dtype=np.int64)
+        ids = np.concatenate(collected["ids"]) if collected["ids"] else empty
+        length_ids = np.concatenate(collected["length_ids"]) if collected["length_ids"] else empty
+        cells, codes = np.unique(np.concatenate([ids, length_ids]), return_inverse=True)
+        point_codes, length_codes = codes[:len(ids)], codes[len(ids):]
+
+        values = {"count": np.bincount(point_codes, minlength=len(cells)).astype(float)}
+        for column in columns:
+            column_values = np.concatenate(collected["columns"][column]) if ids.size else np.array([])
+            valid = ~np.isnan(column_values)
+            values[f"sum:{column}"] = np.bincount(point_codes[valid], weights=column_values[valid], minlength=len(cells))
+            values[f"count:{column}"] = np.bincount(point_codes[valid], minlength=len(cells)).astype(float)
+        if wants_length:
+            lengths = np.concatenate(collected["lengths"]) if collected["lengths"] else np.array([])
+            values["length"] = np.bincount(length_codes, weights=lengths, minlength=len(cells))
+        covered = np.unique(np.concatenate(collected["covered"] + [ids])) if wants_cover else ids
+        return cells_grid.GridLayer(cells, values, covered, self.cell_size, crs)
+
+    def layer(self, name, layer, specs, crs=None):
+        # Aggregates for a named layer, computed on first use
+        if isinstance(layer, cells_grid.GridLayer):
+            if layer.cell_size is not None and not np.isclose(layer.cell_size, self.cell_size):
+                raise ValueError(f"Layer {name!r} has cells of {layer.cell_size}, the grid uses {self.cell_size}")
+            if crs is not None and layer.crs is not None and layer.crs != crs:
+                raise ValueError(f"Layer {name!r} was aggregated in {layer.crs}, the isochrones are in {crs}")
+            return layer
+        if name not in self.layers:
+            self.layers[name] = self.aggregate(layer, specs, crs)
+        return self.layers[name]
+
+
+class _Window:
+    """Dense block of cells under a set of spans, for prefix-sum lookups."""
+
+    def __init__(self, rows, col_starts, col_ends):
+        self.rows = rows
+        self.col_starts = col_starts
+        self.col_ends = col_ends
+        self.row0, self.col0 = rows.min(), col_starts.min()
+        self.shape = (rows.max() - self.row0 + 1, col_ends.max() - self.col0 + 1)
+
+    def span_sums(self, ids, values):
+        # Sum of the per-cell values over each span
+        dense = np.zeros(self.shape)
+        row, col = cells_grid.rows_cols(ids)
+        row, col = row - self.row0, col - self.col0
+        inside = (row >= 0) & (row < self.shape[0]) & (col >= 0) & (col < self.shape[1] - 1)
+        np.add.at(dense, (row[inside], col[inside] + 1), values[inside])
+        prefix = np.cumsum(dense, axis=1)
+        rows = self.rows - self.row0
+        return prefix[rows, self.col_ends - self.col0] - prefix[rows, self.col_starts - self.col0]
+
+
+def approximate_features(isochrones, layers, spec=NOTEBOOK_FEATURES, grid=None, cell_size=CELL_SIZE):
+    # Grid counterpart of compute_features; pass the same Grid again to reuse
+    # its layer aggregates
+    grid = grid or Grid(cell_size)
+    geometries = np.asarray(isochrones.geometry.values, dtype=object)
+    n = len(geometries)
+    iso_idx, rows, col_starts, col_ends = grid.spans(geometries)
+
+    # Isochrones too small to contain a cell center get the cell they sit in
+    uncovered = np.setdiff1d(np.arange(n), iso_idx)
+    uncovered = uncovered[~shapely.is_empty(geometries[uncovered])]
+    if len(uncovered):
+        points = shapely.point_on_surface(geometries[uncovered])
+        own_rows, own_cols = cells_grid.rows_cols(grid.cell_ids(shapely.get_x(points), shapely.get_y(points)))
+        iso_idx = np.concatenate([iso_idx, uncovered])
+        rows = np.concatenate([rows, own_rows])
+        col_starts = np.concatenate([col_starts, own_cols])
+        col_ends = np.concatenate([col_ends, own_cols + 1])
+    window = _Window(rows, col_starts, col_ends) if len(rows) else None
+
+    def total(ids, values):
+        if window is None:
+            return np.zeros(n)
+        return np.bincount(iso_idx, weights=window.span_sums(ids, values), minlength=n)
+
+    features = {}
+    for layer_name, specs in _by_layer(spec, layers).items():
+        cells = grid.layer(layer_name, layers[layer_name], specs, isochrones.crs)
+        for entry in specs:
+            name, agg = entry["name"], entry["agg"]
+            if agg == "count":
+                features[name] = total(cells.ids, cells.values["count"]).round().astype(np.int64)
+            elif agg == "any":
+                features[name] = total(cells.covered, np.ones(len(cells.covered))) > 0.5
+            elif agg == "sum":
+                features[name] = total(cells.ids, cells.values[f"sum:{entry['column']}"])
+            elif agg == "mean":
+                sums = total(cells.ids, cells.values[f"sum:{entry['column']}"])
+                value_counts = total(cells.ids, cells.values[f"count:{entry['column']}"]).round()
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    features[name] = np.where(value_counts > 0, sums / value_counts, np.nan)
+            elif agg == "length":
+                features[name] = total(cells.ids, cells.values["length"])
+            elif agg == "nearest":
+                features.update(FeatureEngine(isochrones).layer_features(layers[layer_name], [entry]))
+
+    return pd.DataFrame(features, index=isochrones.index)[[entry["name"] for entry in spec]]
+
+
+def feature_errors(exact, approx):
+    # Error of approximate_features against compute_features, per feature:
+    # absolute error quantiles and relative error for numbers, the share of
+    # disagreeing isochrones for booleans
+    rows = {}
+    for name in exact.columns:
+        a, b = exact[name].to_numpy(), approx[name].to_numpy()
+        if a.dtype == bool:
+            rows[name] = {"mismatch_rate": float((a != b).mean())}
+            continue
+        a, b = a.astype(float), b.astype(float)
+        both = ~np.isnan(a) & ~np.isnan(b)
+        error = np.abs(a[both] - b[both])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            relative = error / np.abs(a[both])
+        relative = relative[np.isfinite(relative)]
+        rows[name] = {
+            "mean_abs": error.mean() if len(error) else np.nan,
+            "p95_abs": np.quantile(error, 0.95) if len(error) else np.nan,
+            "max_abs": error.max() if len(error) else np.nan,
+            "median_rel": np.median(relative) if len(relative) else np.nan,
+            "p95_rel": np.quantile(relative, 0.95) if len(relative) else np.nan,
+            "nan_mismatch": int((np.isnan(a) != np.isnan(b)).sum()),
+        }
+    return pd.DataFrame(rows).T
@@ -0,0 +1,99 @@
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Streaming loader for the Yelp academic business dump. The NDJSON is parsed
+# in chunks, each chunk is cut down to the needed columns and filtered before
+# the next one is read, and the result can be cached as Parquet so later runs
+# skip the JSON entirely.
+
+CHUNK_SIZE = 100000
+POI_COLUMNS = ["business_id", "latitude", "longitude", "stars", "categories"]
+# Numeric fields are cast explicitly; text fields stay as parsed (str or None)
+DTYPES = {
+    "latitude": "float64",
+    "longitude": "float64",
+    "stars": "float64",
+    "review_count": "Int64",
+    "is_open": "Int64",
+}
+CACHE_METADATA_KEY = b"yelp_loader"
+
+
+def _filter_chunk(chunk, columns, required, city, bbox):
+    if city is not None:
+        chunk = chunk[chunk["city"] == city]
+    chunk = chunk.dropna(subset=required)
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        chunk = chunk[
+            chunk["longitude"].between(min_lon, max_lon)
+            & chunk["latitude"].between(min_lat, max_lat)
+        ]
+    return chunk[columns].astype({column: DTYPES[column] for column in columns if column in DTYPES})
+
+
+def _cache_params(path, columns, required, city, bbox):
+    stat = os.stat(path)
+    return {
+        "source": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "columns": columns,
+        "required": required,
+        "city": city,
+        "bbox": list(bbox) if bbox is not None else None,
+    }
+
+
+def _read_cache(cache_path, params):
+    if not os.path.exists(cache_path):
+        return None
+    metadata = pq.read_schema(cache_path).metadata or {}
+    if json.loads(metadata.get(CACHE_METADATA_KEY, b"null")) != params:
+        return None
+    return pd.read_parquet(cache_path)
+
+
+def _write_cache(cache_path, df, params):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CACHE_METADATA_KEY] = json.dumps(params).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), cache_path, compression="zstd")
+
+
+def load_businesses(path, columns=POI_COLUMNS, required=POI_COLUMNS, city=None, bbox=None,
+                    cache_path=None, chunk_size=CHUNK_SIZE, verbose=False):
+    # bbox is (min_lon, min_lat, max_lon, max_lat). Rows keep their file order.
+    columns = list(columns)
+    required = list(required)
+    params = _cache_params(path, columns, required, city, bbox)
+
+    if cache_path is not None:
+        df = _read_cache(cache_path, params)
+        if df is not None:
+            if verbose:
+                print(f"Loaded {len(df)} businesses from cache {cache_path}")
+            return df
+
+    chunks = []
+    rows_read = 0
+    with pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False) as reader:
+        for chunk in reader:
+            rows_read += len(chunk)
+            chunks.append(_filter_chunk(chunk, columns, required, city, bbox))
+            if verbose:
+                print(f"Read {rows_read} businesses, kept {sum(len(c) for c in chunks)}")
+
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        df = pd.DataFrame({column: pd.Series(dtype=DTYPES.get(column, object)) for column in columns})
+
+    if cache_path is not None:
+        _write_cache(cache_path, df, params)
+        if verbose:
+            print(f"Cached {len(df)} businesses to {cache_path}")
+    return df
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+# The scripts import their siblings by module name, so tests put both script
+# directories on the path the way running them from there would
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT_DIR, "scripts")
+for directory in ("scripts", "analysis"):
+    sys.path.insert(0, os.path.join(ROOT_DIR, directory))
+
+import benchmark  # noqa: E402
+import isochrone  # noqa: E402
+import mock_graphhopper  # noqa: E402
+
+BLOCK_GROUPS = 20
+POIS = 3000
+
+
+def run_script(name, *args, cwd):
+    return subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, name)] + [str(arg) for arg in args],
+                          cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture(scope="session")
+def benchmark_dir(tmp_path_factory):
+    # benchmark.py's fixtures for 20 block groups: block_groups.geojson,
+    # yelp.json, blockgroup_centers.csv and mock isochrones.geojson
+    path = tmp_path_factory.mktemp("benchmark")
+    rng = np.random.default_rng(benchmark.SEED)
+    block_groups = benchmark.make_block_groups(benchmark.CENSUS_FILE, BLOCK_GROUPS, str(path / "block_groups.geojson"))
+    categories = benchmark.load_categories(benchmark.CATEGORIES_FILE)
+    benchmark.make_businesses(block_groups.total_bounds, POIS, categories, rng, str(path / "yelp.json"))
+
+    run_script("shape2points.py", "block_groups.geojson", cwd=path)
+    server, url = mock_graphhopper.start_in_thread()
+    try:
+        run_script("isochrone.py", "--csv", "blockgroup_centers.csv", "--output", "isochrones.geojson", "--url", url,
+                   "--profiles", "foot", "car", "--time-limits", 600, 1200, "--fresh", "--no-cache", cwd=path)
+    finally:
+        server.shutdown()
+    return path
+
+
+@pytest.fixture
+def router(monkeypatch, tmp_path):
+    # A mock GraphHopper for in-process isochrone.py calls, run from tmp_path
+    # (error_file.log) with the shared fetcher and cache unset, as in a
+    # notebook that never calls init_fetcher
+    server, url = mock_graphhopper.start_in_thread(latency=0.01, capacity=4)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(isochrone, "GRAPH_HOPPER_URL", url)
+    monkeypatch.setattr(isochrone, "session", None)
+    monkeypatch.setattr(isochrone, "limiter", None)
+    monkeypatch.setattr(isochrone, "cache", None)
+    yield server
+    server.shutdown()
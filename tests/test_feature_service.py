@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+import requests
+import shapely
+from shapely.geometry import shape
+
+import feature_service
+import isochrone
+import mock_graphhopper
+from feature_service import FeatureService, load_layers
+from spatial_features import NOTEBOOK_FEATURES
+
+SPEC = [entry for entry in NOTEBOOK_FEATURES if entry["name"] == "avg_stars"]
+
+
+@pytest.fixture
+def service_url(benchmark_dir, router):
+    service = FeatureService(load_layers(yelp=str(benchmark_dir / "yelp.json")), SPEC, workers=4)
+    server, url = feature_service.start_in_thread(service, port=0)
+    yield url
+    server.shutdown()
+
+
+def centers(benchmark_dir):
+    return pd.read_csv(benchmark_dir / "blockgroup_centers.csv")
+
+
+def brute_force_avg_stars(benchmark_dir, lat, lon, profile, time_limit):
+    businesses = pd.read_json(benchmark_dir / "yelp.json", lines=True)
+    polygon = shape(mock_graphhopper.build_isochrone(lat, lon, profile, time_limit)["polygons"][0]["geometry"])
+    inside = shapely.contains_xy(polygon, businesses["longitude"], businesses["latitude"])
+    return businesses.loc[inside, "stars"].mean() if inside.any() else None
+
+
+def test_features_endpoint(benchmark_dir, router, service_url):
+    lat, lon = centers(benchmark_dir)[["center_lat", "center_lon"]].iloc[0]
+    query = {"lat": lat, "lon": lon, "profile": "car", "time_limit": 600}
+
+    first = requests.get(f"{service_url}/features", params=query).json()
+    assert first["cached"] is False and first["reused"] is False
+    assert first["features"]["avg_stars"] == pytest.approx(brute_force_avg_stars(benchmark_dir, lat, lon, "car", 600), rel=1e-12)
+
+    # The same point is a feature-cache hit, one 10 m north reuses its isochrone
+    again = requests.get(f"{service_url}/features", params=query).json()
+    assert again["cached"] is True and again["features"] == first["features"]
+    nearby = requests.get(f"{service_url}/features", params=dict(query, lat=lat + 10 / feature_service.METRES_PER_DEGREE)).json()
+    assert nearby["reused"] is True and nearby["center"] == first["center"]
+    assert router.request_count == 1
+
+    bad = requests.get(f"{service_url}/features", params={"lat": lat, "profile": "car", "time_limit": 600})
+    assert bad.status_code == 400 and "lon" in bad.json()["error"]
+
+    stats = requests.get(f"{service_url}/stats").json()
+    assert stats["queries"] == 4 and stats["fetched"] == 1 and stats["errors"] == 1
+    assert stats["feature_hits"] == 2 and stats["reused"] == 1
+
+
+def test_batch_endpoint(benchmark_dir, router, service_url):
+    points = centers(benchmark_dir)[["center_lat", "center_lon"]].to_numpy()[:12]
+    queries = [{"lat": lat, "lon": lon, "profile": "foot", "time_limit": 1200} for lat, lon in points]
+    response = requests.post(f"{service_url}/batch", json={"queries": queries + [{"lat": "north"}]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+
+    assert "error" in results[-1]
+    expected = [brute_force_avg_stars(benchmark_dir, lat, lon, "foot", 1200) for lat, lon in points]
+    assert any(value is not None for value in expected)
+    for value, result in zip(expected, results):
+        assert result["features"]["avg_stars"] == (None if value is None else pytest.approx(value, rel=1e-12))
+
+    # The batch's fetch threads shared one lazily created limiter, which must
+    # have been released once per request
+    assert isochrone.limiter.in_flight == 0
+    assert router.request_count == len({(lat, lon) for lat, lon in points})
+    assert requests.post(f"{service_url}/batch", data=b"{").status_code == 400
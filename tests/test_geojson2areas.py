@@ -0,0 +1,22 @@
+import pandas as pd
+
+from conftest import run_script
+
+
+def test_workers_match_serial(benchmark_dir):
+    run_script("geojson2areas.py", "isochrones.geojson", "-o", "areas_1.csv", cwd=benchmark_dir)
+    run_script("geojson2areas.py", "isochrones.geojson", "-w", 2, "-o", "areas_2.csv", cwd=benchmark_dir)
+
+    serial = pd.read_csv(benchmark_dir / "areas_1.csv")
+    assert len(serial) and serial["average_area"].gt(0).all()
+    pd.testing.assert_frame_equal(pd.read_csv(benchmark_dir / "areas_2.csv"), serial, check_exact=True)
+
+
+def test_output_format(benchmark_dir):
+    run_script("geojson2areas.py", "isochrones.geojson", "-o", "areas_1.csv", cwd=benchmark_dir)
+    # Integer GEOID10 and rows sorted by GEOID10, profile, time_limit
+    written = pd.read_csv(benchmark_dir / "areas_1.csv", dtype={"GEOID10": str})
+    assert written["GEOID10"].str.fullmatch(r"\d{12}").all()
+    keys = written[["GEOID10", "profile", "time_limit"]].astype({"GEOID10": "int64"})
+    pd.testing.assert_frame_equal(keys.sort_values(list(keys.columns), ignore_index=True), keys)
+    assert len(keys) == len(keys.drop_duplicates())
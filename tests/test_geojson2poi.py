@@ -0,0 +1,91 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from conftest import run_script
+from geojson2poi import (CATEGORY_METADATA_KEY, aggregate_poi, calculate_poi_averages, category_column, find_poi_in_shape,
+                         shape_results_scan, split_categories)
+from isochrone_store import geoid_int64, read_isochrones
+from yelp_loader import load_businesses
+
+
+def test_strtree_matches_scan(benchmark_dir):
+    run_script("geojson2poi.py", "isochrones.geojson", "yelp.json", "-o", "poi_strtree.csv", cwd=benchmark_dir)
+    run_script("geojson2poi.py", "isochrones.geojson", "yelp.json", "--engine", "scan", "-o", "poi_scan.csv", cwd=benchmark_dir)
+
+    strtree = pd.read_csv(benchmark_dir / "poi_strtree.csv")
+    assert strtree["average_num_poi"].gt(0).any()
+    pd.testing.assert_frame_equal(strtree, pd.read_csv(benchmark_dir / "poi_scan.csv"), check_exact=True)
+
+
+def test_workers_match_serial(benchmark_dir):
+    for engine in ("strtree", "scan"):
+        run_script("geojson2poi.py", "isochrones.geojson", "yelp.json", "--engine", engine, "-o", f"poi_{engine}_1.csv", cwd=benchmark_dir)
+        run_script("geojson2poi.py", "isochrones.geojson", "yelp.json", "--engine", engine, "-w", 2, "-o", f"poi_{engine}_2.csv", cwd=benchmark_dir)
+        pd.testing.assert_frame_equal(pd.read_csv(benchmark_dir / f"poi_{engine}_2.csv"),
+                                      pd.read_csv(benchmark_dir / f"poi_{engine}_1.csv"), check_exact=True)
+
+
+def baseline_rows(shapes):
+    # The original script's grouping loop around calculate_poi_averages
+    rows = []
+    for (geoid, profile, time_limit), group in shapes.groupby(["geoid", "profile", "time_limit"], sort=True):
+        num_poi = group["num_poi"].tolist()
+        rating_poi = [None if pd.isna(rating) else rating for rating in group["rating_poi"]]
+        centers = group[group["point_label"] == "center"]
+        poi_list_center = centers["poi_list"].iloc[-1] if len(centers) else []
+        average_num_poi, average_rating_poi = calculate_poi_averages(num_poi, rating_poi)
+        rows.append([geoid, profile, time_limit, average_num_poi, average_rating_poi, poi_list_center])
+    return pd.DataFrame(rows, columns=["GEOID10", "profile", "time_limit", "average_num_poi", "average_rating_poi", "poi_list_center"])
+
+
+def test_aggregate_matches_baseline_loop(benchmark_dir):
+    gdf = pd.concat(read_isochrones(str(benchmark_dir / "isochrones.geojson")), ignore_index=True)
+    yelp_df = load_businesses(str(benchmark_dir / "yelp.json"))
+    yelp_geo_df = gpd.GeoDataFrame(yelp_df, geometry=gpd.points_from_xy(yelp_df["longitude"], yelp_df["latitude"]), crs="EPSG:4326")
+    shapes = shape_results_scan(gdf, yelp_geo_df)
+    shapes["geoid"] = geoid_int64(shapes["geoid"])
+
+    aggregated = aggregate_poi(shapes)
+    assert aggregated["average_num_poi"].gt(0).any()
+    pd.testing.assert_frame_equal(aggregated, baseline_rows(shapes), check_exact=True, check_dtype=False)
+
+
+def test_category_rollups_match_brute_force(benchmark_dir, tmp_path):
+    yelp_df = load_businesses(str(benchmark_dir / "yelp.json"))
+    yelp_geo_df = gpd.GeoDataFrame(yelp_df, geometry=gpd.points_from_xy(yelp_df["longitude"], yelp_df["latitude"]), crs="EPSG:4326")
+    names = split_categories(yelp_df["categories"])
+    top = names.explode().value_counts().index[:3].tolist()
+    # Overlapping groups, and a business in both categories of a group counts once
+    groups = {"Top Two": top[:2], top[1]: [top[1]], "Top & Third": [top[0], top[2]]}
+    with open(tmp_path / "groups.json", "w") as f:
+        json.dump(groups, f)
+    run_script("geojson2poi.py", benchmark_dir / "isochrones.geojson", benchmark_dir / "yelp.json",
+               "--category-groups", tmp_path / "groups.json", "--categories-output", tmp_path / "categories.parquet",
+               "-o", tmp_path / "poi.csv", cwd=tmp_path)
+
+    table = pq.read_table(tmp_path / "categories.parquet")
+    assert json.loads(table.schema.metadata[CATEGORY_METADATA_KEY]) == groups
+    rollups = table.to_pandas()
+
+    gdf = pd.concat(read_isochrones(str(benchmark_dir / "isochrones.geojson")), ignore_index=True)
+    gdf["geoid"] = geoid_int64(gdf["geoid"])
+    for name, categories in groups.items():
+        members = yelp_geo_df[names.apply(lambda business: not set(business).isdisjoint(categories)).to_numpy()]
+        counts = [find_poi_in_shape(shape, members) for shape in gdf.geometry]
+        per_shape = gdf[["geoid", "profile", "time_limit"]].assign(
+            num_poi=[count for count, _, _ in counts],
+            stars=[count * stars if count else 0.0 for count, stars, _ in counts])
+        sums = per_shape.groupby(["geoid", "profile", "time_limit"]).agg(shapes=("num_poi", "size"), num_poi=("num_poi", "sum"), stars=("stars", "sum"))
+        expected = pd.DataFrame({
+            "num_poi": np.where(sums["num_poi"] > 0, sums["num_poi"] / sums["shapes"], 0),
+            "rating_poi": np.where(sums["num_poi"] > 0, sums["stars"] / sums["num_poi"].where(sums["num_poi"] > 0), 0),
+        }, index=sums.index)
+        assert expected["num_poi"].gt(0).any() and len(expected) == len(rollups)
+
+        actual = rollups.set_index(["GEOID10", "profile", "time_limit"])
+        np.testing.assert_allclose(actual.loc[expected.index, category_column("num_poi", name)], expected["num_poi"], rtol=1e-12)
+        np.testing.assert_allclose(actual.loc[expected.index, category_column("rating_poi", name)], expected["rating_poi"], rtol=1e-12)
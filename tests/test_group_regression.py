@@ -0,0 +1,42 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+
+import benchmark
+from group_regression import BY, FEATURES, TARGET, fit_groups, split_isochrone
+
+
+def run_regression(df, features, target):
+    # Regression.ipynb's per-group model
+    df_clean = df.dropna(subset=features + [target])
+    X = sm.add_constant(df_clean[features].astype(float))
+    return sm.OLS(df_clean[target], X).fit()
+
+
+@pytest.mark.filterwarnings("ignore::statsmodels.tools.sm_exceptions.SingularMatrixWarning")
+def test_matches_statsmodels(benchmark_dir):
+    rng = np.random.default_rng(benchmark.SEED)
+    block_groups = gpd.read_file(benchmark_dir / "block_groups.geojson")
+    benchmark.make_iso_features(block_groups, benchmark.PROFILES, benchmark.TIME_LIMITS, rng, benchmark_dir / "iso_features.csv")
+    df = split_isochrone(pd.read_csv(benchmark_dir / "iso_features.csv", index_col=0))
+    # Rows run_regression's dropna removes
+    df.loc[rng.random(len(df)) < 0.1, "avg_stars"] = np.nan
+
+    fit = fit_groups(df, FEATURES, TARGET)
+    for key, group in df.groupby(BY, sort=False):
+        model = run_regression(group, FEATURES, TARGET)
+        assert fit.nobs.loc[key] == model.nobs
+        assert fit.df_resid.loc[key] == model.df_resid
+        assert fit.rank.loc[key] == model.model.rank
+
+        # An all-zero column (no `choice` isochrones in a group) has no
+        # coefficient; statsmodels leaves SVD round-off there, fit_groups 0
+        clean = group.dropna(subset=FEATURES + [TARGET])
+        zero = [feature for feature in FEATURES if (clean[feature].astype(float) == 0).all()]
+        assert (fit.params.loc[key, zero] == 0).all()
+        terms = [term for term in model.params.index if term not in zero]
+        for ours, theirs in ((fit.params, model.params), (fit.bse, model.bse), (fit.pvalues, model.pvalues)):
+            np.testing.assert_allclose(ours.loc[key, terms].to_numpy(dtype=float), theirs[terms].to_numpy(), rtol=1e-12)
+        np.testing.assert_allclose(fit.rsquared.loc[key], model.rsquared, rtol=1e-12)
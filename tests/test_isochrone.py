@@ -0,0 +1,101 @@
+import subprocess
+import threading
+
+import pytest
+
+import mock_graphhopper
+
+import isochrone
+from conftest import run_script
+from isochrone import AdaptiveLimiter
+from ledger import TaskLedger
+
+
+def tasks(n, profiles=("foot",), time_limits=(600,)):
+    return [
+        {"geoid": 421010000000 + i, "point_label": "center", "profile": profile, "time_limit": time_limit,
+         "coordinates": f"{39.9 + i * 1e-3},{-75.2}"}
+        for i in range(n) for profile in profiles for time_limit in time_limits
+    ]
+
+
+def test_ledger_write_error_stops_the_run(router, tmp_path, monkeypatch):
+    ledger = TaskLedger(str(tmp_path / "ledger.ndjson"))
+
+    def append(records):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(ledger, "append", append)
+
+    with pytest.raises(OSError, match="No space left"):
+        isochrone.run_tasks(tasks(200), ledger, max_in_flight=4)
+    # Only the requests already in flight when the write failed went out
+    assert router.request_count < 20
+
+
+def test_limiter_grows_by_one_per_window():
+    limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=8, latency_target=1.0)
+    # Each fast success adds 1/limit, so a full window of successes adds one
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(0.01, True)
+    assert limiter.limit == pytest.approx(5, abs=0.1)
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.01, True)
+    assert limiter.limit == 8
+    assert limiter.in_flight == 0
+
+
+def test_limiter_halves_once_per_latency_target():
+    limiter = AdaptiveLimiter(initial=16, minimum=2, maximum=16, latency_target=1.0)
+    limiter.acquire()
+    limiter.release(0.01, False)
+    assert limiter.limit == 8
+    # More failures from the same overload don't halve it again
+    for ok, latency in ((False, 0.01), (True, 5.0)):
+        limiter.acquire()
+        limiter.release(latency, ok)
+    assert limiter.limit == 8
+
+    # A latency_target later, a slow success halves it, down to the minimum
+    for expected in (4, 2, 2):
+        limiter.last_decrease -= 2 * limiter.latency_target
+        limiter.acquire()
+        limiter.release(5.0, True)
+        assert limiter.limit == expected
+
+
+def test_limiter_blocks_at_the_limit():
+    limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=2, latency_target=1.0)
+    limiter.acquire()
+    limiter.acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.2)
+    limiter.release(0.01, True)
+    assert acquired.wait(5)
+    waiter.join()
+    assert limiter.in_flight == 2
+
+
+def test_bucketed_output_matches_unbucketed(benchmark_dir, tmp_path):
+    # isochrones.geojson was fetched with one request per time limit
+    server, url = mock_graphhopper.start_in_thread()
+    try:
+        run_script("isochrone.py", "--csv", benchmark_dir / "blockgroup_centers.csv", "--output", "bucketed.geojson",
+                   "--url", url, "--profiles", "foot", "car", "--time-limits", 600, 1200, "--no-cache",
+                   "--batch-buckets", cwd=tmp_path)
+    finally:
+        server.shutdown()
+    # One request per point and profile
+    assert server.request_count == 100 * 2
+    with open(tmp_path / "bucketed.geojson", "rb") as bucketed, open(benchmark_dir / "isochrones.geojson", "rb") as unbucketed:
+        assert bucketed.read() == unbucketed.read()
+
+
+def test_bucketed_time_limits_must_be_multiples(benchmark_dir, tmp_path):
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run_script("isochrone.py", "--csv", benchmark_dir / "blockgroup_centers.csv", "--time-limits", 600, 900,
+                   "--batch-buckets", cwd=tmp_path)
+    assert b"multiples of the smallest one" in error.value.stderr
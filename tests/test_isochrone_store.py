@@ -0,0 +1,101 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from conftest import run_script
+from isochrone_store import RaggedStore, RaggedStoreWriter, geoid_int64, projected_area, read_isochrones, write_parquet
+from ledger import TaskLedger, task_key
+
+KEY_COLUMNS = ["geoid", "point_label", "profile", "time_limit"]
+
+
+def load(path, **kwargs):
+    # All isochrones at path in one frame, labels as plain strings, sorted by task
+    gdf = pd.concat(list(read_isochrones(str(path), **kwargs)), ignore_index=True)
+    for column in ("point_label", "profile"):
+        gdf[column] = gdf[column].astype(str)
+    return gdf.sort_values(KEY_COLUMNS, ignore_index=True)
+
+
+def expected_frame(geojson_path):
+    # What the stores should hold for the isochrones in a GeoJSON file
+    gdf = load(geojson_path)
+    latitude, longitude = zip(*(map(float, center.split(",")) for center in gdf["center"]))
+    gdf["geoid"] = geoid_int64(gdf["geoid"])
+    gdf["center_latitude"] = latitude
+    gdf["center_longitude"] = longitude
+    gdf["isochrone_area_square_meters"] = projected_area(gdf.geometry.values)
+    return gdf.drop(columns="center").sort_values(KEY_COLUMNS, ignore_index=True)
+
+
+def assert_same_isochrones(actual, expected):
+    assert shapely.equals_exact(actual.geometry.values, expected.geometry.values, tolerance=0).all()
+    columns = actual.columns.drop("geometry")
+    pd.testing.assert_frame_equal(actual[columns], expected[columns], check_dtype=False)
+
+
+def test_parquet_round_trip(benchmark_dir, tmp_path):
+    expected = expected_frame(benchmark_dir / "isochrones.geojson")
+    run_script("isochrone_store.py", benchmark_dir / "isochrones.geojson", "-o", tmp_path / "converted.parquet",
+               "--row-group-size", 64, "--chunk-size", 50, cwd=tmp_path)
+    converted = load(tmp_path / "converted.parquet")
+    assert len(converted) == len(expected) == 400
+    assert_same_isochrones(converted, expected)
+
+    # Straight from the ledger, in the requested key order
+    ledger = TaskLedger(str(benchmark_dir / "isochrones.ledger.ndjson"))
+    keys = [task_key(record) for record in ledger.records(status="ok")][::-1]
+    assert write_parquet(ledger, str(tmp_path / "ledger.parquet"), row_group_size=64, keys=keys) == 400
+    ledger.close()
+    in_key_order = pd.concat(list(read_isochrones(str(tmp_path / "ledger.parquet"))), ignore_index=True)
+    assert list(in_key_order[KEY_COLUMNS].astype(object).itertuples(index=False, name=None)) == [
+        (int(float(geoid)), label, profile, time_limit) for geoid, label, profile, time_limit in keys]
+    assert_same_isochrones(load(tmp_path / "ledger.parquet"), converted)
+
+
+def test_ragged_round_trip(benchmark_dir, tmp_path):
+    expected = expected_frame(benchmark_dir / "isochrones.geojson")
+    run_script("isochrone_store.py", benchmark_dir / "isochrones.geojson", "-o", tmp_path / "geojson.ragged",
+               "--row-group-size", 64, cwd=tmp_path)
+    run_script("isochrone_store.py", benchmark_dir / "isochrones.geojson", "-o", tmp_path / "converted.parquet", cwd=tmp_path)
+    run_script("isochrone_store.py", tmp_path / "converted.parquet", "-o", tmp_path / "parquet.ragged",
+               "--row-group-size", 64, cwd=tmp_path)
+    ledger = TaskLedger(str(benchmark_dir / "isochrones.ledger.ndjson"))
+    assert write_parquet(ledger, str(tmp_path / "ledger.ragged"), row_group_size=64) == 400
+    ledger.close()
+
+    for store in ("geojson.ragged", "parquet.ragged", "ledger.ragged"):
+        assert_same_isochrones(load(tmp_path / store, chunk_size=37), expected)
+
+    # Rows taken out of order match the same rows of a contiguous read
+    store = RaggedStore(str(tmp_path / "geojson.ragged"))
+    rows = np.random.default_rng(0).permutation(len(store))[:50]
+    everything = store.geometries()
+    assert shapely.equals_exact(store.geometries(rows), everything[rows], tolerance=0).all()
+    assert shapely.equals_exact(store.geometries(slice(100, 150)), everything[100:150], tolerance=0).all()
+    np.testing.assert_array_equal(store.bounds(rows), shapely.bounds(everything[rows]))
+
+
+def test_ragged_mixed_geometries(tmp_path):
+    # Holes, multipolygons and empty polygons, which the mock server never returns
+    square = shapely.box(-75.2, 39.9, -75.1, 40.0)
+    geometries = [
+        square.difference(shapely.box(-75.17, 39.93, -75.13, 39.97)),
+        shapely.MultiPolygon([square, shapely.box(-75.0, 39.9, -74.9, 40.0)]),
+        shapely.Polygon(),
+        square,
+        shapely.MultiPolygon([shapely.box(-75.3, 39.8, -75.25, 39.85)]),
+    ]
+    gdf = gpd.GeoDataFrame({"geoid": 421010000000 + np.arange(5), "point_label": "center", "profile": "foot",
+                            "time_limit": 600, "center": "39.95,-75.15"}, geometry=geometries, crs="EPSG:4326")
+    for row_group_size in (2, 10):
+        path = str(tmp_path / f"mixed_{row_group_size}.ragged")
+        writer = RaggedStoreWriter(path, row_group_size)
+        writer.add_frame(gdf)
+        writer.close()
+        stored = RaggedStore(path)
+        assert shapely.equals_exact(stored.geometries(), np.array(geometries, dtype=object), tolerance=0).all()
+        assert list(shapely.get_type_id(stored.geometries([4, 2, 1]))) == [
+            shapely.GeometryType.MULTIPOLYGON, shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]
+        assert np.isnan(stored.bounds([2])).all()
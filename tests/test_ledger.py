@@ -0,0 +1,134 @@
+import json
+
+import isochrone
+import ledger as ledger_module
+from ledger import TaskLedger, task_key
+
+
+def params(i, profile="foot"):
+    return {"geoid": 421010000000 + i, "point_label": "center", "profile": profile, "time_limit": 600,
+            "coordinates": f"{39.9 + i * 1e-3},{-75.2}"}
+
+
+def result(i, profile="foot"):
+    return {**params(i, profile), "isochrone": {"polygons": [{"type": "Feature", "properties": {"i": i}}]}}
+
+
+def test_truncated_trailing_line_is_dropped(tmp_path, monkeypatch):
+    # The partial line is longer than a scan block, so the newline search
+    # has to step back more than once
+    monkeypatch.setattr(ledger_module, "SCAN_BLOCK_SIZE", 16)
+    path = str(tmp_path / "ledger.ndjson")
+    ledger = TaskLedger(path)
+    ledger.append([TaskLedger.success_record(result(0)), TaskLedger.success_record(result(1))])
+    ledger.close()
+    with open(path, "ab") as f:
+        f.write(json.dumps(TaskLedger.success_record(result(2))).encode()[:-40])
+
+    ledger = TaskLedger(path)
+    assert ledger.completed == {task_key(params(0)), task_key(params(1))}
+    ledger.record_success(result(2))
+    ledger.close()
+
+    with open(path, "rb") as f:
+        lines = f.read().splitlines()
+    assert [json.loads(line)["geoid"] for line in lines] == [params(i)["geoid"] for i in range(3)]
+    assert TaskLedger(path).completed == {task_key(params(i)) for i in range(3)}
+
+
+def test_success_supersedes_failure(tmp_path):
+    path = str(tmp_path / "ledger.ndjson")
+    ledger = TaskLedger(path)
+    ledger.record_failure(params(0))
+    ledger.record_failure(params(1))
+    ledger.record_success(result(0))
+    ledger.close()
+
+    ledger = TaskLedger(path)
+    assert ledger.completed == {task_key(params(0))}
+    assert ledger.failed == {task_key(params(1))}
+    assert ledger.superseded == 1
+    records = list(ledger.records())
+    assert [(record["geoid"], record["status"]) for record in records] == [
+        (params(1)["geoid"], "failed"), (params(0)["geoid"], "ok")]
+    assert records[1]["polygons"] == result(0)["isochrone"]["polygons"]
+
+
+def test_records_follow_the_given_keys(tmp_path):
+    ledger = TaskLedger(str(tmp_path / "ledger.ndjson"))
+    ledger.append([TaskLedger.success_record(result(i)) for i in range(4)])
+    ledger.record_failure(params(4))
+    ledger.record_success(result(1, "car"))
+
+    keys = [task_key(params(i)) for i in (4, 2, 9, 0)] + [task_key(params(1, "car"))]
+    assert [(record["geoid"], record["status"]) for record in ledger.records(keys=keys)] == [
+        (params(4)["geoid"], "failed"), (params(2)["geoid"], "ok"), (params(0)["geoid"], "ok"), (params(1)["geoid"], "ok")]
+    assert [record["geoid"] for record in ledger.records(status="ok", keys=keys)] == [
+        params(i)["geoid"] for i in (2, 0, 1)]
+    assert [record["profile"] for record in ledger.records(status="ok", keys=keys)] == ["foot", "foot", "car"]
+    ledger.close()
+
+
+def test_compact_keeps_the_latest_records(tmp_path):
+    path = str(tmp_path / "ledger.ndjson")
+    ledger = TaskLedger(path)
+    for i in range(5):
+        ledger.record_failure(params(i))
+    ledger.record_failure(params(3))
+    for i in (0, 3, 4):
+        ledger.record_success(result(i))
+    records = list(ledger.records())
+    digests = dict(ledger.digests)
+    assert ledger.superseded == 4
+
+    ledger.compact()
+    assert ledger.superseded == 0
+    assert list(ledger.records()) == records
+    assert ledger.digests == digests
+    # Appends after compaction land on the rewritten file
+    ledger.record_success(result(1))
+    ledger.close()
+
+    ledger = TaskLedger(path)
+    assert (ledger.line_count, ledger.superseded) == (6, 1)
+    assert ledger.digests == {**digests, task_key(params(1)): ledger.digests[task_key(params(1))]}
+    assert ledger.completed == {task_key(params(i)) for i in (0, 1, 3, 4)}
+    assert [(record["geoid"], record["status"]) for record in ledger.records()] == [
+        (params(2)["geoid"], "failed")] + [(params(i)["geoid"], "ok") for i in (0, 3, 4, 1)]
+    ledger.close()
+
+
+def test_retry_failed_only_completes_the_run(router, benchmark_dir, tmp_path, monkeypatch):
+    # A first run against a flaky server leaves failures in the ledger; a
+    # --retry-failed-only run fetches just those and the output matches a
+    # clean run, after which the superseded failures are compacted away
+    monkeypatch.setattr(isochrone, "RETRIES", 1)
+    monkeypatch.setattr(isochrone, "backoff_delay", lambda attempt: 0)
+    # main() sets these module globals from its arguments
+    monkeypatch.setattr(isochrone, "PROFILES", isochrone.PROFILES)
+    monkeypatch.setattr(isochrone, "TIME_LIMITS", isochrone.TIME_LIMITS)
+
+    def run(*args):
+        monkeypatch.setattr("sys.argv", ["isochrone.py", "--csv", str(benchmark_dir / "blockgroup_centers.csv"),
+                                         "--url", isochrone.GRAPH_HOPPER_URL, "--profiles", "foot",
+                                         "--time-limits", "600", "--no-cache", "--compact-after", "0"] + list(args))
+        isochrone.main()
+
+    router.error_rate = 0.5
+    run("--output", "flaky.geojson", "--ledger", "flaky.ndjson")
+    flaky = TaskLedger("flaky.ndjson")
+    failed = flaky.failed
+    flaky.close()
+    assert failed and len(failed) < 100
+
+    router.error_rate = 0.0
+    before = router.request_count
+    run("--output", "flaky.geojson", "--ledger", "flaky.ndjson", "--retry-failed-only")
+    assert router.request_count - before == len(failed)
+    run("--output", "clean.geojson", "--ledger", "clean.ndjson")
+
+    with open("flaky.geojson", "rb") as flaky_output, open("clean.geojson", "rb") as clean_output:
+        assert flaky_output.read() == clean_output.read()
+    flaky = TaskLedger("flaky.ndjson")
+    assert flaky.superseded == 0 and flaky.line_count == 100 and not flaky.failed
+    flaky.close()
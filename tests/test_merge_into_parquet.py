@@ -0,0 +1,93 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+import merge_into_parquet
+from merge_into_parquet import ANALYSIS_DIR, KEYS, merge_features, parse_geoid, read_areas, read_poi
+
+
+def test_parse_geoid():
+    values = pd.Series(["421010260001.0", "421010260001", "421010369002.00", "421019800001"])
+    assert parse_geoid(values).tolist() == [421010260001, 421010260001, 421010369002, 421019800001]
+    assert parse_geoid(values).dtype == "int64"
+    assert parse_geoid(pd.Series(["421010260001", "421010260002"])).tolist() == [421010260001, 421010260002]
+    with pytest.raises(ValueError, match="Non-integer GEOID10"):
+        parse_geoid(pd.Series(["421010260001.0", "421010260001.5"]))
+
+
+def test_inputs_are_validated(tmp_path):
+    path = tmp_path / "areas.csv"
+    path.write_text("GEOID10,profile,average_area\n421010260001,car,1.5\n")
+    with pytest.raises(ValueError, match=r"missing columns \['time_limit'\]"):
+        read_areas(str(path))
+    path.write_text("GEOID10,profile,time_limit,average_area\n421010260001,car,ten minutes,1.5\n")
+    with pytest.raises(ValueError):
+        read_areas(str(path))
+
+
+def test_integer_and_float_geoids_merge(tmp_path):
+    # geojson2areas.py now writes integer GEOID10s; older POI outputs have floats
+    (tmp_path / "areas.csv").write_text("GEOID10,profile,time_limit,average_area\n"
+                                        "421010260001,car,600,1.5\n421010260002,foot,600,2.5\n")
+    (tmp_path / "poi.csv").write_text("GEOID10,profile,time_limit,average_num_poi,average_rating_poi\n"
+                                      "421010260001.0,car,600,3.0,4.0\n421010260002.0,foot,600,5.0,3.5\n")
+    merged = merge_features(read_areas(str(tmp_path / "areas.csv")), read_poi(str(tmp_path / "poi.csv")))
+    assert merged["GEOID10"].tolist() == [421010260001, 421010260002]
+    assert merged["average_num_poi"].tolist() == [3.0, 5.0]
+
+
+def original_merge():
+    # The original script, with its center_longitude fixed to use the longitude
+    df_1 = pd.read_csv(os.path.join(ANALYSIS_DIR, "blockgroup_areas.csv"), dtype={"GEOID10": str})
+    df_2 = pd.read_csv(os.path.join(ANALYSIS_DIR, "blockgroup_poi-no-list.csv"), dtype={"GEOID10": str})
+    df_3 = pd.read_csv(os.path.join(ANALYSIS_DIR, "iso_features.csv"))
+    df_1["GEOID10"] = df_1["GEOID10"].str.replace(".0", "").astype(int)
+    df_2["GEOID10"] = df_2["GEOID10"].str.replace(".0", "").astype(int)
+    df_3 = df_3.rename(columns={"choice": "is_choice_neighborhood"})
+    df_3["GEOID10"] = df_3["isochrone"].str.split("-").apply(lambda x: x[0]).astype(int)
+    df_3["profile"] = df_3["isochrone"].str.split("-").apply(lambda x: x[2])
+    df_3["time_limit"] = df_3["isochrone"].str.split("-").apply(lambda x: int(x[1]))
+    df_3["center_latitude"] = df_3["center"].str.split(",").apply(lambda x: x[0]).astype(float)
+    df_3["center_longitude"] = df_3["center"].str.split(",").apply(lambda x: x[1]).astype(float)
+    df_3 = df_3.drop(columns=["Unnamed: 0", "isochrone", "center"])
+    df_merged = pd.merge(df_1, df_2, on=KEYS, how="inner")
+    return pd.merge(df_merged, df_3, on=KEYS, how="inner")
+
+
+def test_merge_matches_original(tmp_path, monkeypatch):
+    monkeypatch.setattr("sys.argv", ["merge_into_parquet.py", "-o", str(tmp_path / "merged.parquet"),
+                                     "--partitioned", str(tmp_path / "partitioned"), "--row-group-size", "1000"])
+    merge_into_parquet.main()
+
+    schema = pq.read_schema(tmp_path / "merged.parquet")
+    expected_types = {
+        "GEOID10": pa.int64(),
+        "profile": pa.dictionary(pa.int8(), pa.string()),
+        "time_limit": pa.int64(),
+        "average_area": pa.float64(),
+        "average_num_poi": pa.float64(),
+        "average_rating_poi": pa.float64(),
+        "is_choice_neighborhood": pa.bool_(),
+        "foreclosure_count": pa.int64(),
+        "center_latitude": pa.float64(),
+        "center_longitude": pa.float64(),
+    }
+    assert {name: schema.field(name).type for name in expected_types} == expected_types
+    assert pq.ParquetFile(tmp_path / "merged.parquet").metadata.num_row_groups > 1
+
+    merged = pd.read_parquet(tmp_path / "merged.parquet")
+    original = original_merge()
+    assert len(merged) == len(original) > 0
+    merged = merged.sort_values(KEYS, ignore_index=True)
+    original = original[merged.columns].sort_values(KEYS, ignore_index=True)
+    pd.testing.assert_frame_equal(merged, original, check_dtype=False, check_categorical=False)
+
+    # The partitioned copy holds the same rows
+    partitioned = ds.dataset(tmp_path / "partitioned", format="parquet", partitioning="hive").to_table().to_pandas()
+    assert sorted(os.listdir(tmp_path / "partitioned")) == sorted(f"profile={profile}" for profile in merged["profile"].unique())
+    partitioned = partitioned.astype({"profile": str, "time_limit": "int64"}).sort_values(KEYS, ignore_index=True)
+    pd.testing.assert_frame_equal(partitioned[merged.columns], merged.astype({"profile": str}), check_dtype=False)
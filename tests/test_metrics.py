@@ -0,0 +1,100 @@
+import json
+import re
+
+import pytest
+
+import metrics
+from conftest import run_script
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    # Metrics enabled in-process with empty state and no exporter thread
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_gauges", {})
+    monkeypatch.setattr(metrics, "_histograms", {})
+    monkeypatch.setattr(metrics, "_enabled", False)
+    monkeypatch.setattr(metrics, "_export_path", None)
+    metrics.enable()
+
+
+def test_disabled_records_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_histograms", {})
+    monkeypatch.setattr(metrics, "_enabled", False)
+    metrics.count("requests")
+    metrics.observe("request_seconds", 0.5)
+    with metrics.timer("stage_seconds"):
+        pass
+    assert metrics.timer("stage_seconds") is metrics._NULL_TIMER
+    assert metrics.snapshot()["counters"] == {} and metrics.snapshot()["histograms"] == {}
+
+
+def test_snapshot(recording):
+    metrics.count("requests")
+    metrics.count("requests", 4)
+    metrics.gauge("in_flight_limit", 12.5)
+    for seconds in (0.001, 0.002, 0.003, 0.5):
+        metrics.observe("request_seconds", seconds)
+    with metrics.timer("stage_seconds"):
+        pass
+
+    @metrics.timed("call_seconds")
+    def call(x):
+        return x * 2
+    assert call(21) == 42
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"requests": 5}
+    assert snapshot["gauges"] == {"in_flight_limit": 12.5}
+    summary = snapshot["histograms"]["request_seconds"]
+    assert (summary["count"], summary["min"], summary["max"]) == (4, 0.001, 0.5)
+    assert summary["sum"] == pytest.approx(0.506)
+    # Quantiles are bucket upper bounds, capped at the largest observation
+    assert summary["p50"] == pytest.approx(0.0032) and summary["p99"] == 0.5
+    assert snapshot["histograms"]["stage_seconds"]["count"] == snapshot["histograms"]["call_seconds"]["count"] == 1
+
+
+def test_prometheus_text(recording):
+    metrics.count("isochrone-requests", 3)
+    metrics.gauge("in_flight_limit", 4)
+    for seconds in (0.00005, 0.001, 0.001, 10000.0):
+        metrics.observe("request_seconds", seconds)
+
+    lines = metrics.prometheus_text().splitlines()
+    assert "# TYPE isochrone_requests_total counter" in lines and "isochrone_requests_total 3" in lines
+    assert "# TYPE in_flight_limit gauge" in lines and "in_flight_limit 4" in lines
+    buckets = [(match[1], int(match[2])) for match in map(re.compile(r'request_seconds_bucket\{le="([^"]+)"\} (\d+)').fullmatch, lines) if match]
+    assert len(buckets) == len(metrics.BUCKETS) + 1
+    assert buckets[0] == ("0.0001", 1) and buckets[-1] == ("+Inf", 4)
+    counts = [n for _, n in buckets]
+    assert counts == sorted(counts) and counts[-2] == 3
+    assert "request_seconds_count 4" in lines
+
+
+def test_export_files(benchmark_dir, tmp_path):
+    # geojson2areas.py writes its metrics at exit, as JSON or Prometheus text
+    run_script("geojson2areas.py", benchmark_dir / "isochrones.geojson", "-o", "areas.csv", "--chunk-size", 100,
+               "--metrics", "metrics.json", cwd=tmp_path)
+    run_script("geojson2areas.py", benchmark_dir / "isochrones.geojson", "-o", "areas.csv", "--chunk-size", 100,
+               "--metrics", "metrics.prom", cwd=tmp_path)
+
+    with open(tmp_path / "metrics.json") as f:
+        snapshot = json.load(f)
+    assert snapshot["counters"]["area_features"] == 400
+    assert snapshot["histograms"]["area_chunk_seconds"]["count"] == 4
+
+    with open(tmp_path / "metrics.prom") as f:
+        lines = f.read().splitlines()
+    assert "area_features_total 400" in lines
+    assert "area_chunk_seconds_count 4" in lines
+    assert not (tmp_path / "metrics.prom.tmp").exists()
+
+
+def test_progress_is_rate_limited(capsys):
+    progress = metrics.Progress("tasks", 1000, interval=3600)
+    for _ in range(1000):
+        progress.update()
+    lines = capsys.readouterr().out.splitlines()
+    # Only the final line: the interval never elapsed
+    assert len(lines) == 1 and lines[0].startswith("[100%] 1000/1000 tasks processed")
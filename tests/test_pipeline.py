@@ -0,0 +1,59 @@
+import re
+import shutil
+
+import geopandas as gpd
+import pytest
+
+import mock_graphhopper
+from conftest import run_script
+
+OUTPUTS = ["blockgroup_centers.csv", "blockgroup_areas.csv", "blockgroup_poi.csv", "blockgroup_poi-no-list.csv",
+           "isochrones.parquet", "blockgroup-data.parquet"]
+
+
+@pytest.fixture
+def mock_url():
+    server, url = mock_graphhopper.start_in_thread()
+    yield url
+    server.shutdown()
+
+
+def run_pipeline(path, url):
+    result = run_script("pipeline.py", "--census", "census.geojson", "--yelp", "yelp.json", "--url", url,
+                        "--profiles", "foot", "car", "--time-limits", 600, 1200, "--no-cache", "--no-iso-features",
+                        cwd=path)
+    return result.stdout.decode()
+
+
+def counts(output, pattern):
+    return [int(value) for value in re.search(pattern, output).groups()]
+
+
+def test_incremental_rerun_matches_fresh_build(benchmark_dir, tmp_path, mock_url):
+    incremental, fresh = tmp_path / "incremental", tmp_path / "fresh"
+    for path in (incremental, fresh):
+        path.mkdir()
+        shutil.copy(benchmark_dir / "yelp.json", path)
+    block_groups = gpd.read_file(benchmark_dir / "block_groups.geojson")
+    block_groups.to_file(incremental / "census.geojson", driver="GeoJSON")
+    first = run_pipeline(incremental, mock_url)
+    assert counts(first, r"\[isochrones\] (\d+) tasks fetched") == [len(block_groups) * 5 * 2 * 2]
+
+    # Grow one block group and drop another
+    edited = block_groups.drop(index=7)
+    edited.loc[3, "geometry"] = edited.loc[3, "geometry"].buffer(0.002)
+    for path in (incremental, fresh):
+        edited.to_file(path / "census.geojson", driver="GeoJSON")
+
+    rerun = run_pipeline(incremental, mock_url)
+    assert counts(rerun, r"\[points\] (\d+) block groups recomputed") == [2]
+    assert counts(rerun, r"\[isochrones\] (\d+) tasks fetched") == [5 * 2 * 2]
+    assert counts(rerun, r"\[features\] (\d+) area and (\d+) POI partitions recomputed") == [8, 8]
+
+    run_pipeline(fresh, mock_url)
+    for name in OUTPUTS:
+        assert (incremental / name).read_bytes() == (fresh / name).read_bytes(), name
+
+    again = run_pipeline(incremental, mock_url)
+    assert counts(again, r"\[isochrones\] (\d+) tasks fetched") == [0]
+    assert counts(again, r"\[features\] (\d+) area and (\d+) POI partitions recomputed") == [0, 0]
@@ -0,0 +1,90 @@
+import itertools
+import json
+import sqlite3
+import types
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, cache_key, normalize_params
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # A clock that ticks once per reading, so last_used never ties
+    ticks = itertools.count(1)
+    monkeypatch.setattr(response_cache, "time", types.SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def params(i):
+    return normalize_params(39.9 + i * 1e-3, -75.2, "foot", 600, "2024-01-01T08:00:00Z")
+
+
+def response(i):
+    # Bodies of equal size, so max_bytes counts entries
+    return {"polygons": [{"properties": {"bucket": 0}, "i": f"{i:04d}"}]}
+
+
+BODY_SIZE = len(json.dumps(response(0), separators=(",", ":")))
+
+
+def last_used(path):
+    with sqlite3.connect(path) as db:
+        return dict(db.execute("SELECT key, last_used FROM responses"))
+
+
+def test_evicts_least_recently_used(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=3 * BODY_SIZE)
+    for i in range(3):
+        cache.put(params(i), response(i))
+    # A hit makes 0 the most recently used, so 1 and then 2 go first
+    assert cache.get(params(0)) == response(0)
+    cache.put(params(3), response(3))
+    assert cache.get(params(1)) is None
+    cache.put(params(4), response(4))
+    assert cache.get(params(2)) is None
+    assert [cache.get(params(i)) for i in (0, 3, 4)] == [response(i) for i in (0, 3, 4)]
+    assert cache.evictions == 2
+    cache.close()
+
+
+def test_hits_are_written_in_batches(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(response_cache, "TOUCH_BATCH", 3)
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path)
+    for i in range(4):
+        cache.put(params(i), response(i))
+    stored = last_used(path)
+
+    cache.get(params(0))
+    cache.get(params(1))
+    assert last_used(path) == stored
+    cache.get(params(2))
+    written = last_used(path)
+    assert [written[cache_key(params(i))] > stored[cache_key(params(i))] for i in range(4)] == [True, True, True, False]
+
+    cache.get(params(3))
+    cache.close()
+    assert last_used(path)[cache_key(params(3))] > stored[cache_key(params(3))]
+
+
+def test_stats(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path, max_bytes=2 * BODY_SIZE)
+    assert cache.stats() == {"hits": 0, "misses": 0, "hit_rate": 0.0, "evictions": 0, "entries": 0, "bytes": 0}
+    assert cache.get(params(0)) is None
+    cache.put(params(0), response(0))
+    cache.put(params(0), response(0))  # replacing an entry doesn't count its bytes twice
+    cache.get(params(0))
+    cache.get(params(0))
+    cache.put(params(1), response(1))
+    cache.put(params(2), response(2))
+    assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "evictions": 1, "entries": 2,
+                             "bytes": 2 * BODY_SIZE}
+    cache.close()
+
+    # Counters are per run; the stored entries and their size persist
+    cache = ResponseCache(path, max_bytes=2 * BODY_SIZE)
+    assert cache.stats() == {"hits": 0, "misses": 0, "hit_rate": 0.0, "evictions": 0, "entries": 2,
+                             "bytes": 2 * BODY_SIZE}
+    cache.close()
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from conftest import run_script
+from rtt_ingest import load_transfers
+
+DOCUMENT_TYPES = ["DEED", "SHERIFF'S DEED", "DEED SHERIFF", "MORTGAGE", "DEED OF CONDEMNATION"]
+
+
+def make_rtt(path, n=400):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "objectid": np.arange(n),
+        "document_type": rng.choice(DOCUMENT_TYPES, n),
+        "display_date": [f"{year}-{month:02d}-15 00:00:00" for year, month in zip(rng.integers(2005, 2021, n), rng.integers(1, 13, n))],
+        "street_address": "1 MARKET ST",
+        "assessed_value": rng.uniform(1e4, 1e6, n).round(2),
+        "lat": rng.uniform(39.9, 40.1, n),
+        "lng": rng.uniform(-75.3, -75.0, n),
+    })
+    df.loc[::17, "assessed_value"] = np.nan
+    df.loc[::23, "lat"] = np.nan
+    df.loc[5::29, "display_date"] = "not a date"
+    df.to_csv(path, index=False)
+    return pd.read_csv(path)
+
+
+def expected_transfers(df, kind, min_year):
+    # The notebook's filters on the whole table at once
+    kinds = {"DEED": "deed", "SHERIFF'S DEED": "foreclosure", "DEED SHERIFF": "foreclosure"}
+    df = df.assign(display_date=pd.to_datetime(df["display_date"], errors="coerce"))
+    df = df[(df["document_type"].map(kinds) == kind) & df["assessed_value"].notnull() & df["lat"].notnull()
+            & (df["display_date"].dt.year > min_year)]
+    return df.sort_values("objectid")
+
+
+def partitions(output_dir):
+    return {(kind, year) for kind in os.listdir(output_dir) for year in os.listdir(os.path.join(output_dir, kind))}
+
+
+def test_partitioned_dataset(tmp_path):
+    df = make_rtt(tmp_path / "rtt.csv")
+    run_script("rtt_ingest.py", "rtt.csv", "-o", "rtt_deeds", "--chunk-size", 50, cwd=tmp_path)
+
+    assert partitions(tmp_path / "rtt_deeds") == {
+        (f"kind={kind}", f"year={year}") for kind in ("deed", "foreclosure") for year in range(2011, 2021)}
+    for kind in ("deed", "foreclosure"):
+        expected = expected_transfers(df, kind, 2010)
+        transfers = load_transfers(str(tmp_path / "rtt_deeds"), kind)
+        # Rows come back partition by partition; match them up by value
+        transfers = transfers.sort_values(["display_date", "assessed_value"], ignore_index=True)
+        expected = expected.sort_values(["display_date", "assessed_value"], ignore_index=True)
+        assert len(transfers) == len(expected) > 0
+        for column in ("document_type", "assessed_value", "lat", "lng", "display_date"):
+            assert (transfers[column].to_numpy() == expected[column].to_numpy()).all(), column
+        assert (transfers["year"] == transfers["display_date"].dt.year).all()
+        assert (transfers.geometry.x == transfers["lng"]).all()
+
+    # Partition and bbox filters
+    recent = load_transfers(str(tmp_path / "rtt_deeds"), "deed", min_year=2017, bbox=(-75.2, 39.9, -75.0, 40.0))
+    expected = expected_transfers(df, "deed", 2017)
+    expected = expected[expected["lng"].between(-75.2, -75.0) & expected["lat"].between(39.9, 40.0)]
+    assert sorted(recent["assessed_value"]) == sorted(expected["assessed_value"])
+
+    # A rerun replaces the dataset instead of leaving old partitions behind
+    run_script("rtt_ingest.py", "rtt.csv", "-o", "rtt_deeds", "--min-year", 2018, cwd=tmp_path)
+    assert partitions(tmp_path / "rtt_deeds") == {
+        (f"kind={kind}", f"year={year}") for kind in ("deed", "foreclosure") for year in (2019, 2020)}
+    assert not os.path.exists(tmp_path / "rtt_deeds.tmp")
@@ -0,0 +1,26 @@
+import pandas as pd
+
+from conftest import run_script
+from shape2points import BISECT_TOLERANCE, COLUMNS
+
+
+def centers(benchmark_dir, path, *args):
+    # shape2points.py always writes blockgroup_centers.csv to its working directory
+    path.mkdir()
+    run_script("shape2points.py", benchmark_dir / "block_groups.geojson", *args, cwd=path)
+    return pd.read_csv(path / "blockgroup_centers.csv")
+
+
+def test_workers_match_serial(benchmark_dir, tmp_path):
+    serial = centers(benchmark_dir, tmp_path / "serial")
+    pd.testing.assert_frame_equal(centers(benchmark_dir, tmp_path / "workers", "-w", 2), serial, check_exact=True)
+
+
+def test_fast_matches_bisection(benchmark_dir, tmp_path):
+    bisection = centers(benchmark_dir, tmp_path / "bisection")
+    fast = centers(benchmark_dir, tmp_path / "fast", "--fast")
+    assert fast["GEOID10"].tolist() == bisection["GEOID10"].tolist()
+    coords = [column for column in COLUMNS if column != "GEOID10"]
+    assert (fast[coords] - bisection[coords]).abs().to_numpy().max() <= BISECT_TOLERANCE
+
+    pd.testing.assert_frame_equal(centers(benchmark_dir, tmp_path / "fast_workers", "--fast", "-w", 2), fast, check_exact=True)
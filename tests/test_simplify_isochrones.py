@@ -0,0 +1,71 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from conftest import run_script
+from geojson2poi import PoiIndex
+from isochrone_store import projected_area, read_isochrones
+from simplify_isochrones import ErrorReport, simplify_geometries
+from yelp_loader import load_businesses
+
+
+def test_error_report():
+    circle = shapely.Point(-75.16, 39.95).buffer(0.01, quad_segs=64)
+    square = shapely.box(-75.2, 39.9, -75.19, 39.91)
+    tiny = shapely.box(-75.1, 39.9, -75.1 + 1e-4, 39.9 + 1e-4)
+    original = np.array([circle, square, tiny], dtype=object)
+    points = gpd.GeoDataFrame({"business_id": ["a", "b", "c", "d"], "stars": [1.0, 2.0, 3.0, 4.0]},
+                              geometry=gpd.points_from_xy([-75.16, -75.1505, -75.195, -75.0], [39.95, 39.95, 39.905, 39.0]),
+                              crs="EPSG:4326")
+
+    simplified, collapsed = simplify_geometries(original, tolerance_meters=50, decimals=3)
+    # The tiny square vanishes on a 0.001 degree grid and is kept as it was
+    assert collapsed.tolist() == [False, False, True]
+    assert simplified[2] is tiny
+    assert shapely.get_num_coordinates(simplified[0]) < shapely.get_num_coordinates(circle)
+
+    report = ErrorReport(PoiIndex(points))
+    report.add(original[:2], simplified[:2], collapsed[:2])
+    report.add(original[2:], simplified[2:], collapsed[2:])
+    summary = report.summary()
+
+    assert (summary["isochrones"], summary["collapsed"]) == (3, 1)
+    assert summary["vertices"] == {"before": int(shapely.get_num_coordinates(original).sum()),
+                                   "after": int(shapely.get_num_coordinates(simplified).sum())}
+    assert summary["wkb_bytes"]["after"] < summary["wkb_bytes"]["before"]
+    area_error = np.abs(projected_area(simplified) - projected_area(original)) / projected_area(original)
+    assert summary["area_error"]["max"] == pytest.approx(area_error.max())
+    assert summary["area_error"]["mean"] == pytest.approx(area_error.mean())
+    assert 0 < summary["symmetric_difference"]["max"] < 0.1
+
+    before = [shapely.contains(original, point).sum() for point in points.geometry]
+    after = [shapely.contains(simplified, point).sum() for point in points.geometry]
+    assert summary["containment"]["points"] == 4
+    assert summary["containment"]["pairs_before"] == sum(before)
+    assert summary["containment"]["pairs_after"] == sum(after)
+
+
+def test_simplify_cli(benchmark_dir, tmp_path):
+    run_script("simplify_isochrones.py", benchmark_dir / "isochrones.geojson", "-o", "simplified.parquet",
+               "--decimals", 3, "--chunk-size", 150, "--yelp", benchmark_dir / "yelp.json", "--report", "report.json",
+               cwd=tmp_path)
+    with open(tmp_path / "report.json") as f:
+        report = json.load(f)
+
+    original = pd.concat(read_isochrones(str(benchmark_dir / "isochrones.geojson")), ignore_index=True)
+    simplified = pd.concat(read_isochrones(str(tmp_path / "simplified.parquet")), ignore_index=True)
+    expected, collapsed = simplify_geometries(original.geometry.values, decimals=3)
+    assert shapely.equals_exact(simplified.geometry.values, expected, tolerance=0).all()
+    assert report["isochrones"] == 400 and report["collapsed"] == int(collapsed.sum())
+
+    yelp_df = load_businesses(str(benchmark_dir / "yelp.json"))
+    x, y = yelp_df["longitude"].to_numpy(), yelp_df["latitude"].to_numpy()
+    pairs = [sum(int(shapely.contains_xy(geometry, x, y).sum()) for geometry in geometries)
+             for geometries in (original.geometry.values, expected)]
+    assert [report["containment"]["pairs_before"], report["containment"]["pairs_after"]] == pairs
+    assert report["containment"]["points"] == len(yelp_df)
+    assert report["output_bytes"] > 0 and report["input_bytes"] > report["output_bytes"]
@@ -0,0 +1,124 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import grid
+import rtt_ingest
+from spatial_features import NOTEBOOK_FEATURES, Grid, approximate_features, compute_features, feature_errors
+
+# 100 irregular isochrones of 1.5-4 km radius in a 12 km square (EPSG:3857)
+# over synthetic layers; the bounds asserted below are the ones documented
+# in spatial_features.py for 50 m cells.
+X0, Y0, WIDTH = -8370000.0, 4860000.0, 12000.0
+SPEC = NOTEBOOK_FEATURES + [{"name": "truck_length", "layer": "no_trucks", "agg": "length"}]
+
+
+def star(rng, cx, cy, radius, vertices=24):
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radii = radius * rng.uniform(0.5, 1.0, vertices)
+    return shapely.Polygon(np.c_[cx + radii * np.cos(angles), cy + radii * np.sin(angles)])
+
+
+def points(rng, n, crs=3857, **columns):
+    x = X0 - 2000 + rng.uniform(0, WIDTH + 4000, n)
+    y = Y0 - 2000 + rng.uniform(0, WIDTH + 4000, n)
+    return gpd.GeoDataFrame(columns, geometry=gpd.points_from_xy(x, y), crs=crs)
+
+
+@pytest.fixture(scope="module")
+def fixture():
+    rng = np.random.default_rng(0)
+    isochrones = gpd.GeoDataFrame(geometry=[
+        star(rng, X0 + rng.uniform(0, WIDTH), Y0 + rng.uniform(0, WIDTH), rng.uniform(1500, 4000))
+        for _ in range(100)
+    ], crs=3857)
+
+    streets = points(rng, 4000)
+    angles, lengths = rng.uniform(0, np.pi, 4000), rng.uniform(20, 100, 4000)
+    x, y = streets.geometry.x.to_numpy(), streets.geometry.y.to_numpy()
+    lines = shapely.linestrings(np.stack([np.c_[x, y], np.c_[x + lengths * np.cos(angles), y + lengths * np.sin(angles)]], axis=1))
+    layers = {
+        "yelp": points(rng, 10000, stars=rng.integers(2, 11, 10000) / 2),
+        "choice": gpd.GeoDataFrame(geometry=points(rng, 12).buffer(400), crs=3857),
+        "no_trucks": gpd.GeoDataFrame({"Shape__Length": lengths}, geometry=lines, crs=3857),
+        "pools": points(rng, 20),
+        "deeds": points(rng, 30000, assessed_value=np.where(rng.random(30000) < 0.1, np.nan, rng.uniform(1e4, 1e6, 30000))),
+        "foreclosures": points(rng, 15000),
+    }
+    return isochrones, layers
+
+
+def test_error_bounds(fixture):
+    isochrones, layers = fixture
+    exact = compute_features(isochrones, layers, SPEC)
+    errors = feature_errors(exact, approximate_features(isochrones, layers, SPEC, Grid(50.0)))
+
+    for name in ("avg_stars", "avg_housing_price"):
+        assert errors.loc[name, "median_rel"] < 0.005
+        assert errors.loc[name, "p95_rel"] < 0.02
+    assert errors.loc["foreclosure_count", "median_rel"] < 0.01
+    assert errors.loc["choice", "mismatch_rate"] < 0.05
+    assert errors.loc["truck_length", "median_rel"] < 0.01
+    assert errors.loc["no_truck_length", "median_rel"] < 0.05
+    assert errors.loc["distance_pool", "max_abs"] == 0
+
+
+def test_cover_is_center_containment(fixture):
+    isochrones, _ = fixture
+    cell_size = 50.0
+    geometries = isochrones.geometry.values[:10]
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    rows = np.arange(np.floor(miny / cell_size), np.ceil(maxy / cell_size)).astype(np.int64)
+    cols = np.arange(np.floor(minx / cell_size), np.ceil(maxx / cell_size)).astype(np.int64)
+    row, col = (a.ravel() for a in np.meshgrid(rows, cols, indexing="ij"))
+    centers = shapely.points((col + 0.5) * cell_size, (row + 0.5) * cell_size)
+    inside = shapely.contains(shapely.union_all(geometries), centers)
+
+    expected = grid.pack_cells(row[inside], col[inside])
+    assert np.array_equal(Grid(cell_size).cover(geometries), np.sort(expected))
+
+
+def test_cell_ids_round_trip():
+    ids = grid.cell_ids([-75.16, 0.0, 179.99], [39.95, -0.0005, -89.99], 0.001)
+    row, col = grid.rows_cols(ids)
+    assert row.tolist() == [39950, -1, -89990]
+    assert col.tolist() == [-75160, 0, 179990]
+    with pytest.raises(ValueError):
+        grid.cell_ids([-75.16], [39.95], 1e-8)
+
+
+def test_rtt_cells_layer(fixture, tmp_path):
+    # rtt_ingest --cells aggregates give the same features as the points
+    isochrones, _ = fixture
+    isochrones = isochrones.iloc[:20].to_crs(4326)
+    rng = np.random.default_rng(1)
+    minx, miny, maxx, maxy = isochrones.total_bounds
+    n = 5000
+    transfers = pd.DataFrame({
+        "document_type": rng.choice(["DEED", "SHERIFF'S DEED", "MORTGAGE"], n),
+        "display_date": pd.Timestamp("2008-01-01") + pd.to_timedelta(rng.integers(0, 5000, n), unit="D"),
+        "assessed_value": np.where(rng.random(n) < 0.1, np.nan, rng.uniform(1e4, 1e6, n)),
+        "lat": rng.uniform(miny, maxy, n),
+        "lng": rng.uniform(minx, maxx, n),
+    })
+    transfers.to_csv(tmp_path / "rtt.csv", index=False)
+    cell_size = 0.001
+    rtt_ingest.ingest(str(tmp_path / "rtt.csv"), str(tmp_path / "rtt"), cell_size=cell_size)
+    rtt_ingest.aggregate_cells(str(tmp_path / "rtt"), str(tmp_path / "cells.parquet"), cell_size)
+
+    spec = [entry for entry in NOTEBOOK_FEATURES if entry["layer"] in ("deeds", "foreclosures")]
+    from_points = approximate_features(isochrones, {
+        "deeds": rtt_ingest.load_transfers(str(tmp_path / "rtt"), "deed"),
+        "foreclosures": rtt_ingest.load_transfers(str(tmp_path / "rtt"), "foreclosure"),
+    }, spec, Grid(cell_size))
+    from_cells = approximate_features(isochrones, {
+        "deeds": rtt_ingest.load_cells(str(tmp_path / "cells.parquet"), "deed"),
+        "foreclosures": rtt_ingest.load_cells(str(tmp_path / "cells.parquet"), "foreclosure"),
+    }, spec, Grid(cell_size))
+    pd.testing.assert_frame_equal(from_cells, from_points, rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        approximate_features(isochrones, {"foreclosures": rtt_ingest.load_cells(str(tmp_path / "cells.parquet"), "foreclosure")},
+                             spec[1:], Grid(2 * cell_size))
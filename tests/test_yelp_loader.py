@@ -0,0 +1,75 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import yelp_loader
+from yelp_loader import load_businesses
+
+BUSINESSES = [
+    {"business_id": "a", "city": "Philadelphia", "latitude": 39.95, "longitude": -75.16, "stars": 4.5, "categories": "Bars, Food"},
+    {"business_id": "b", "city": "Philadelphia", "latitude": None, "longitude": -75.17, "stars": 3.0, "categories": "Food"},
+    {"business_id": "c", "city": "Camden", "latitude": 39.94, "longitude": -75.12, "stars": 2.0, "categories": "Gyms"},
+    {"business_id": "d", "city": "Philadelphia", "latitude": 40.05, "longitude": -75.05, "stars": 5, "categories": None},
+    {"business_id": "e", "city": "Philadelphia", "latitude": 40.01, "longitude": -75.20, "stars": 1.5, "categories": "Food"},
+]
+
+
+@pytest.fixture
+def yelp_path(tmp_path):
+    path = tmp_path / "yelp.json"
+    with open(path, "w") as f:
+        for business in BUSINESSES:
+            f.write(json.dumps(business) + "\n")
+    return str(path)
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # Counts the times the JSON itself is parsed
+    calls = []
+    read_json = pd.read_json
+
+    def counting_read_json(*args, **kwargs):
+        calls.append(args[0])
+        return read_json(*args, **kwargs)
+    monkeypatch.setattr(yelp_loader.pd, "read_json", counting_read_json)
+    return calls
+
+
+def test_filters_in_chunks(yelp_path):
+    df = load_businesses(yelp_path, chunk_size=2)
+    assert df["business_id"].tolist() == ["a", "c", "e"]
+    assert df.dtypes[["latitude", "longitude", "stars"]].tolist() == ["float64"] * 3
+    pd.testing.assert_frame_equal(df, load_businesses(yelp_path))
+
+    assert load_businesses(yelp_path, city="Philadelphia", chunk_size=2)["business_id"].tolist() == ["a", "e"]
+    assert load_businesses(yelp_path, bbox=(-75.18, 39.9, -75.1, 40.0))["business_id"].tolist() == ["a", "c"]
+    assert load_businesses(yelp_path, city="Pittsburgh").columns.tolist() == yelp_loader.POI_COLUMNS
+
+
+def test_cache_invalidation(yelp_path, tmp_path, reads):
+    cache_path = str(tmp_path / "yelp.parquet")
+    fresh = load_businesses(yelp_path, cache_path=cache_path)
+    assert len(reads) == 1 and os.path.exists(cache_path)
+    pd.testing.assert_frame_equal(load_businesses(yelp_path, cache_path=cache_path), fresh)
+    assert len(reads) == 1
+
+    # Other filters miss the cache and replace it
+    philadelphia = load_businesses(yelp_path, city="Philadelphia", cache_path=cache_path)
+    assert len(reads) == 2 and philadelphia["business_id"].tolist() == ["a", "e"]
+    load_businesses(yelp_path, city="Philadelphia", cache_path=cache_path)
+    assert len(reads) == 2
+    load_businesses(yelp_path, required=["business_id", "latitude", "longitude"], cache_path=cache_path)
+    assert len(reads) == 3
+
+    # So does a newer source file, even one of the same size
+    load_businesses(yelp_path, cache_path=cache_path)
+    assert len(reads) == 4
+    stat = os.stat(yelp_path)
+    os.utime(yelp_path, (stat.st_atime, stat.st_mtime + 10))
+    pd.testing.assert_frame_equal(load_businesses(yelp_path, cache_path=cache_path), fresh)
+    assert len(reads) == 5
+    load_businesses(yelp_path, cache_path=cache_path)
+    assert len(reads) == 5